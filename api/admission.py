@@ -0,0 +1,93 @@
+import asyncio
+from contextlib import asynccontextmanager
+from time import monotonic
+from weakref import WeakValueDictionary
+
+from api import exceptions
+
+"""
+Goal:
+    Limit the concurrent requests of a view. The requests over `max_concurrency`
+    wait in a queue, and the ones that wait more than `queue_timeout` seconds
+    are rejected fast, before start any query.
+"""
+
+_controllers: WeakValueDictionary[str, 'AdmissionController'] = WeakValueDictionary()
+
+
+class AdmissionController:
+
+    def __init__(self, name: str, max_concurrency: int, queue_timeout: float | None = None) -> None:
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self._semaphore: asyncio.Semaphore | None = None
+        self._loop = None
+        self.waiting = 0
+        self.in_flight = 0
+        self.max_waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        _controllers[name] = self
+        return
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # the asyncio primitives can't be shared between event loops
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+        return self._semaphore
+
+    @asynccontextmanager
+    async def admit(self):
+        """
+        Waits a free slot for the request. Raises `QueueTimeout` if the wait
+        is longer than `queue_timeout`.
+        """
+        semaphore = self.semaphore
+        start = monotonic()
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise exceptions.QueueTimeout(self.name, self.queue_timeout)
+        finally:
+            self.waiting -= 1
+        wait = monotonic() - start
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.in_flight += 1
+        try:
+            yield self
+        finally:
+            self.in_flight -= 1
+            semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            'max_concurrency': self.max_concurrency,
+            'queue_timeout': self.queue_timeout,
+            'in_flight': self.in_flight,
+            'queue_depth': self.waiting,
+            'max_queue_depth': self.max_waiting,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'avg_wait': self.total_wait / self.admitted if self.admitted else 0.0,
+            'max_wait': self.max_wait,
+        }
+    pass
+
+def get_stats() -> dict:
+    """
+    The admission statistics of all the views with concurrency limit.
+    """
+    return {name: controller.stats() for name, controller in sorted(_controllers.items())}
+
+__all__ = ['AdmissionController', 'get_stats']
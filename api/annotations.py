@@ -0,0 +1,113 @@
+from django.db.models import Avg, Count, Max, Min, Sum, Model, OuterRef, Subquery, Value
+from django.db.models.fields.reverse_related import ForeignObjectRel
+from django.db.models.functions import Coalesce
+
+from api.local import LocalField
+from api.relation import Relation
+from api import exceptions
+
+"""
+Goal:
+    fields = {
+        'id',
+        'name',
+        ('players', '__count__'),
+        ('players', '__max__', 'goals'),
+    }
+
+    {"id": 1, "name": "Team A", "players_count": 11, "players_max_goals": 8}
+
+    The summaries of the to many relations are computed by the database in the
+    main query (a correlated subquery by aggregate), without prefetch the related objects.
+"""
+
+AGGREGATES = {
+    '__count__': Count,
+    '__sum__': Sum,
+    '__min__': Min,
+    '__max__': Max,
+    '__avg__': Avg,
+}
+
+
+class AnnotatedField:
+    """
+    A value computed by the database with `annotate()`, serialized as a local field.
+    """
+
+    def __init__(self, name: str, expression, declaration = None) -> None:
+        self._name = name
+        self.expression = expression
+        # the item of `fields` that declares it
+        self.declaration = declaration or name
+        return
+
+    @property
+    def name(self):
+        return self._name
+
+    def __hash__(self) -> int:
+        return hash(self._name)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, AnnotatedField) and other._name == self._name
+
+    def __repr__(self) -> str:
+        return self._name
+    pass
+
+
+def is_aggregate_field(field) -> bool:
+    """
+    If the `fields` item is a relation summary: `('relation', '__count__')` or `('relation', '__max__', 'column')`.
+    """
+    return isinstance(field, tuple) and \
+        len(field) in (2, 3) and \
+        isinstance(field[1], str) and \
+        field[1] in AGGREGATES
+
+def get_remote_lookup(relation: Relation) -> str:
+    """
+    The lookup from the related model to the model of the relation.
+    """
+    model_field = relation._model_field
+    if isinstance(model_field, ForeignObjectRel) and model_field.related_model is not relation.from_m:
+        # reverse relation, the field is in the related model
+        return model_field.field.name
+    field = getattr(model_field, 'field', model_field)
+    return field.related_query_name()
+
+def build_aggregate_field(model: type[Model], field: tuple) -> AnnotatedField:
+    relation_name, aggregate, *column = field
+    relation = Relation(model, relation_name)
+    if not relation.is_to_many:
+        raise exceptions.InvalidAggregateField(field, 'only the to many relations can be aggregated')
+    function = AGGREGATES[aggregate]
+    if function is Count:
+        if column:
+            raise exceptions.InvalidAggregateField(field, '__count__ has not column')
+        column_name = 'pk'
+        name = '%s_count'%relation_name
+    else:
+        if not column:
+            raise exceptions.InvalidAggregateField(field, '%s requires a column'%aggregate)
+        column_name = LocalField(column[0], relation.to_m).name
+        name = '%s_%s_%s'%(relation_name, aggregate.strip('_'), column_name)
+    remote_lookup = get_remote_lookup(relation)
+    summary = relation.to_m._default_manager.filter(**{remote_lookup: OuterRef('pk')}).\
+        order_by().\
+        values(remote_lookup).\
+        annotate(_summary=function(column_name)).\
+        values('_summary')
+    expression = Subquery(summary)
+    if function is Count:
+        # without related objects the subquery is empty
+        expression = Coalesce(expression, Value(0))
+    return AnnotatedField(name, expression, field)
+
+__all__ = [
+    'AGGREGATES',
+    'AnnotatedField',
+    'is_aggregate_field',
+    'build_aggregate_field',
+]
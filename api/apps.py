@@ -1,6 +1,17 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.utils.module_loading import autodiscover_modules
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self) -> None:
+        from api import checks, registry
+        # the views are registered when their modules are imported
+        if getattr(settings, 'DARC_AUTODISCOVER_VIEWS', True):
+            autodiscover_modules('views')
+        # the invalid declarations are reported by the system checks
+        registry.compile_views()
+        return
@@ -1,17 +1,27 @@
 from django.db import transaction, DEFAULT_DB_ALIAS
-from asgiref.sync import sync_to_async
+from api.executor import db_sync_to_async, get_database_executor
 
 class AsyncAtomicTransaction(transaction.Atomic):
     def __init__(self, using= None, savepoint= True, durable= False):
         super().__init__(using, savepoint, durable)
+        self._lane_tokens = []
         return
 
     async def __aenter__(self):
-            await sync_to_async(super().__enter__)()
+            # the statements of the block must run in the thread that opened it
+            self._lane_tokens.append(await get_database_executor().acquire_lane())
+            try:
+                await db_sync_to_async(super().__enter__)()
+            except BaseException:
+                get_database_executor().release_lane(self._lane_tokens.pop())
+                raise
             return self
 
     async def __aexit__(self, exc_type, exc_value, traceback):
-        await sync_to_async(super().__exit__)(exc_type, exc_value, traceback)
+        try:
+            await db_sync_to_async(super().__exit__)(exc_type, exc_value, traceback)
+        finally:
+            get_database_executor().release_lane(self._lane_tokens.pop())
         return
     pass
 
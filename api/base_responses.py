@@ -30,10 +30,26 @@ invalid_fields_response = lambda fields: JsonResponse(
     status=400
 )
 
+invalid_data_response = lambda errors: JsonResponse(
+    {'message': 'The request data is invalid', 'errors': errors},
+    status=400
+)
+
+def service_unavailable_response(retry_after: int):
+    response = JsonResponse(
+        {'message': 'The service is busy, retry later'},
+        status=503
+    )
+    response['Retry-After'] = str(retry_after)
+    return response
+
 __all__= [
     'permission_denied_response',
     'login_required_response',
     'must_be_json_response',
     'no_request_body_response',
-    'missing_fields_response'
+    'missing_fields_response',
+    'invalid_fields_response',
+    'invalid_data_response',
+    'service_unavailable_response',
 ]
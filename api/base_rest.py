@@ -1,15 +1,21 @@
-from asyncio import gather
+from functools import wraps
+from time import perf_counter
+from asgiref.sync import sync_to_async
 from types import NoneType
 from typing import Literal
 from django.http import HttpRequest, JsonResponse
-from django.db.models import Model, QuerySet
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Expression, Model, QuerySet
 
-from api.async_transaction import async_atomic
+from api.admission import AdmissionController
+from api.executor import db_sync_to_async
+from api.unit_of_work import UnitOfWork
 from api.pagination import Pagination
 from api.relation import Relation, RelationManager
 from api.local import LocalField
+from api.annotations import AnnotatedField, is_aggregate_field, build_aggregate_field
 from api.filtersets import FilterURLBuilder
-from api import exceptions, utils, base_responses
+from api import exceptions, utils, base_responses, counting, m2m, metrics, nested, routing, registry, profiling, projection, sync, validation, versioning
 
 class BaseREST:
     """
@@ -49,13 +55,285 @@ class BaseREST:
     Set of fields that will not be represented in the responses.
     Can be empty.
     """
+    computed_fields: dict[str, Expression] = {}
+    """
+    Values computed by the database, by name:
+    `{'full_name': Concat('first_name', Value(' '), 'last_name')}`.
+    Their names can be added to `fields` and are usable in `filterBy` and `orderBy`.
+    """
+    order_url_param = 'orderBy'
+    """
+    The GET request URL parameter for the ordering: comma separated fields, with `-` for descending order.
+    """
+    read_using: str | None = None
+    """
+    The database alias for the reads (e.g. a replica). The default database if `None`.
+    """
+    write_using: str | None = None
+    """
+    The database alias for the writes (the primary). The default database if `None`.
+    """
+    read_your_writes_window: int | float = 0
+    """
+    Seconds that the reads of a client are pinned to `write_using` after a write.
+    `0` disables the pin.
+    """
+    primary_pin_cookie = 'readPrimaryUntil'
+    """
+    The cookie that carries the pin to the primary database.
+    """
+    primary_pin_header = 'X-Read-Primary-Until'
+    """
+    The header that carries the pin to the primary database, for clients without cookies.
+    """
+    sync_field: str | None = None
+    """
+    A timestamp (e.g. `updated_at` with `auto_now`) or an increasing sequence field of the model,
+    that enables the incremental synchronization with the `since` GET request URL param.
+    The deletions of the model are recorded as tombstones.
+    """
+    since_url_param = 'since'
+    """
+    The GET request URL parameter with the synchronization token.
+    """
+    sync_overlap = None
+    """
+    The window before the token whose objects are fetched again, for the objects committed late
+    with an older `sync_field` value (a `timedelta` for the timestamps, a number for the sequences).
+    The objects already sent are skipped. By default, 5 seconds for the timestamps and none for the sequences.
+    """
+    max_concurrency: int | None = None
+    """
+    Maximum of requests of this view running at the same time. Without limit if `None`.
+    """
+    queue_timeout: float | None = 5
+    """
+    Seconds that a request waits for be admitted when `max_concurrency` is reached,
+    after them it's rejected with 503. Waits forever if `None`.
+    """
+    retry_after = 1
+    """
+    Seconds in the `Retry-After` header of the rejected requests.
+    """
+    count_strategy: Literal['exact', 'cached', 'estimated'] = 'exact'
+    """
+    How the total of objects of the paginated responses is counted: `exact` (a `COUNT(*)` by request),
+    `cached` (by query, invalidated by the writes of the model) or `estimated` (by the database statistics).
+    """
+    count_cache_ttl = 60
+    """
+    Seconds that a count is cached with the `cached` strategy.
+    """
+    exact_count_threshold = 1000
+    """
+    With the `estimated` strategy, the estimations below it are replaced by the exact count.
+    """
+    version_field: str | None = None
+    """
+    An integer field of the model (e.g. `version` with `default=0`) for the optimistic concurrency control.
+    The updates are conditioned to the version in the `If-Match` header, and increment it.
+    The retrieved objects have the version as `ETag`.
+    """
+    send_m2m_signals = True
+    """
+    Sends the `m2m_changed` signals of the many to many writes, that are done in the through tables.
+    """
+    collect_metrics = True
+    """
+    Measures the requests of the view (latency, queries, serialized objects, response bytes, caches
+    and errors) for the metrics registry, served by `api.views.metrics_exposition`.
+    """
+    profile_sample_rate = 0.0
+    """
+    The fraction of the requests (0 to 1) profiled by sampling. The `.pstats` and `.collapsed` files
+    of each profiled request are written in `DARC_PROFILE_DIR`.
+    """
+    profile_header = 'X-Darc-Profile'
+    """
+    The request header (with `1`) that profiles a request of a staff user, or any request with `DEBUG`.
+    The profiled responses have the request id of the files in the same header.
+    """
+    profile_interval = profiling.DEFAULT_INTERVAL
+    """
+    Seconds between the samples of the stacks of a profiled request.
+    """
+
+    _field_plan_attributes = (
+        'required_model_fields',
+        'model_fields',
+        'optional_model_fields',
+        'relations',
+        'local_fields',
+        'annotated_fields',
+        'related_selections',
+        'prefetch_selections',
+        'request_validator',
+    )
+    """
+    The attributes set by `initialize_fields` that are compiled once by class.
+    """
+    _compiled_fields: dict | None = None
+    _admission_controller: AdmissionController | None = None
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls._compiled_fields = None
+        cls._admission_controller = None
+        if cls.__dict__.get('_derived_from'):
+            # the views derived by the package (e.g. the events) aren't registered again
+            return
+        if getattr(cls, 'model', None) is not None and getattr(cls, 'fields', None):
+            registry.register(cls)
+            if cls.sync_field:
+                sync.track_deletions(cls.model)
+            if cls.count_strategy == counting.CACHED:
+                counting.invalidate_on_writes(cls.model)
+        return
 
     def __init__(self, **kwargs) -> None:
         if not self.model or not self.fields:
             raise Exception('model and fields is required')
-        self.initialize_fields(self.fields)
+        self.__dict__.update(self.compile_fields())
+        # the keyword arguments of `as_view`, as the `View` of Django
+        for key, value in kwargs.items():
+            setattr(self, key, value)
         return
 
+    @classmethod
+    def compile_fields(cls) -> dict:
+        """
+        Validates the `fields` of the class once, and returns the compiled field plan
+        shared by all the instances.
+        """
+        if cls._compiled_fields is None and (base := cls.__dict__.get('_derived_from')):
+            cls._compiled_fields = base.compile_fields()
+        if cls._compiled_fields is None:
+            # the plan doesn't depend of the request, __init__ isn't required
+            view = object.__new__(cls)
+            view.initialize_fields(cls.fields)
+            cls._compiled_fields = {
+                attribute: getattr(view, attribute)
+                for attribute in cls._field_plan_attributes
+            }
+        return cls._compiled_fields
+
+    @classmethod
+    def derive_view(cls, mixin, suffix: str):
+        """
+        A subclass of the view with `mixin`, that shares the field plan of the view.
+        """
+        return type(
+            '%s%s'%(cls.__name__, suffix),
+            (mixin, cls),
+            {'_derived_from': cls, '__module__': cls.__module__}
+        )
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # the cached counts of `as_view(count_strategy='cached')` are invalidated too
+        if initkwargs.get('count_strategy', cls.count_strategy) == counting.CACHED:
+            counting.invalidate_on_writes(cls.model)
+        return super().as_view(**initkwargs)
+
+    @classmethod
+    def as_events_view(cls, **initkwargs):
+        """
+        A Server-Sent Events view with the changes of the model, serialized with the fields of this view.
+        """
+        from api.events import EventStreamMixin, publish_model_changes
+        publish_model_changes(cls.model)
+        return cls.derive_view(EventStreamMixin, 'Events').as_view(**initkwargs)
+
+    @classmethod
+    def as_export_view(cls, **initkwargs):
+        """
+        A view that exports the objects of this view to files in background jobs.
+        The URL pattern must capture the job identificator as `job`.
+        """
+        from api.exports import ExportMixin
+        return cls.derive_view(ExportMixin, 'Export').as_view(**initkwargs)
+
+    @classmethod
+    def as_import_view(cls, **initkwargs):
+        """
+        A view that creates or updates objects of this view from a NDJSON body, by batches.
+        """
+        from api.imports import ImportMixin
+        view_class = cls.derive_view(ImportMixin, 'Import')
+        # with the URL patterns, not in the requests
+        if invalid_fields := view_class(**initkwargs).get_invalid_unique_fields():
+            raise exceptions.InvalidImportUniqueFields(invalid_fields)
+        return view_class.as_view(**initkwargs)
+
+    @classmethod
+    def get_admission_controller(cls) -> AdmissionController | None:
+        if not cls.max_concurrency:
+            return None
+        if cls._admission_controller is None:
+            cls._admission_controller = AdmissionController(
+                registry.get_label(cls),
+                cls.max_concurrency,
+                cls.queue_timeout
+            )
+        return cls._admission_controller
+
+    async def dispatch(self, request: HttpRequest, *args, **kwargs):
+        """
+        Measures the request for the metrics registry, according `collect_metrics`.
+        """
+        if not self.collect_metrics:
+            return await self.profile(request, *args, **kwargs)
+        tracker, token = metrics.start()
+        start = perf_counter()
+        response = None
+        try:
+            response = await self.profile(request, *args, **kwargs)
+        except Exception as exp:
+            metrics.record_error(exp)
+            raise
+        finally:
+            metrics.stop(token)
+            metrics.metrics_registry.observe_request(
+                registry.get_label(type(self)),
+                request.method,
+                perf_counter() - start,
+                tracker,
+                None if response is None or response.streaming else len(response.content)
+            )
+        if metrics.metrics_registry.should_flush():
+            await sync_to_async(metrics.metrics_registry.flush, thread_sensitive=False)()
+        return response
+
+    async def profile(self, request: HttpRequest, *args, **kwargs):
+        """
+        Profiles the request according `profile_sample_rate` or `profile_header`.
+        """
+        if not await profiling.should_profile(request, self.profile_sample_rate, self.profile_header):
+            return await self.admit(request, *args, **kwargs)
+        profiler, token = profiling.start(self.profile_interval)
+        try:
+            response = await self.admit(request, *args, **kwargs)
+        finally:
+            profiling.stop(token)
+        request_id = profiling.get_request_id(request)
+        # the files are written out of the event loop
+        if await sync_to_async(profiler.dump, thread_sensitive=False)(registry.get_label(type(self)), request_id):
+            response[self.profile_header] = request_id
+        return response
+
+    async def admit(self, request: HttpRequest, *args, **kwargs):
+        """
+        Admits the request according `max_concurrency` before the dispatch of the view.
+        """
+        if not (admission_controller := self.get_admission_controller()):
+            return await super().dispatch(request, *args, **kwargs)
+        try:
+            async with admission_controller.admit():
+                return await super().dispatch(request, *args, **kwargs)
+        except exceptions.QueueTimeout as exp:
+            metrics.record_error(exp)
+            return base_responses.service_unavailable_response(self.retry_after)
+
     def initialize_fields(self, fields):
         """
         Initialize the fields for works the model instances with relations and local changes.
@@ -65,9 +343,18 @@ class BaseREST:
         # the defined field names in the model
         self.model_fields = utils.get_model_fields(self.model)
         self.optional_model_fields = set(self.model_fields) - set(self.required_model_fields)
+        # the values computed by the database, e.g. the summaries of the relations
+        self.annotated_fields: set[AnnotatedField] = set()
         # fields validation obtains the relations and the local fields
         # this last, are the fields that doesn't express a relation
         self.relations, self.local_fields = self.validate_fields(fields)
+        # the validators of the request data, compiled from the model fields
+        self.request_validator = validation.RequestValidator(
+            self.local_fields,
+            self.relations,
+            self.required_model_fields,
+            self.nonupdatable_fields
+        )
         self.related_selections = set()
         self.prefetch_selections = set()
         if not self.relations:
@@ -78,6 +365,24 @@ class BaseREST:
         self.prefetch_selections = self.relations.prefetch_selections
         return
 
+    def add_annotated_field(self, annotated_field: AnnotatedField):
+        """
+        Adds a value computed by the database. The names of the summaries of the relations
+        can't be the names of fields of the model, of computed fields or of other annotations.
+        """
+        name = annotated_field.name
+        for other in self.annotated_fields:
+            if other.name == name and other.declaration != annotated_field.declaration:
+                raise exceptions.AnnotationNameConflict(name, 'the annotation %s'%(other.declaration,))
+        if isinstance(annotated_field.declaration, tuple):
+            if name in self.computed_fields:
+                raise exceptions.AnnotationNameConflict(name, 'a computed field')
+            for model_field in self.model._meta.get_fields():
+                if name in (model_field.name, getattr(model_field, 'attname', None)):
+                    raise exceptions.AnnotationNameConflict(name, 'a field of the model')
+        self.annotated_fields.add(annotated_field)
+        return
+
     def validate_fields(
         self,
         fields: set[str] | set[tuple[str, list[str]]] | str,
@@ -98,10 +403,15 @@ class BaseREST:
             relations = RelationManager()
         if isinstance(fields, str):
             if fields == '__all__':
-                return self.validate_fields(model_fields)
+                return self.validate_fields(model_fields | set(self.computed_fields))
         _fields = set()
         if isinstance(fields, set):
             for field in fields:
+                if is_aggregate_field(field):
+                    if parent_relation is not None:
+                        raise exceptions.InvalidFieldFormat(field)
+                    self.add_annotated_field(build_aggregate_field(model, field))
+                    continue
                 if isinstance(field, tuple):
                     related_field, related_fields = field
                     relation= Relation(model, related_field, parent_relation)
@@ -117,6 +427,9 @@ class BaseREST:
                 if isinstance(field, str):
                     if field in self.privated_fields:
                         raise exceptions.FieldIsPrivated(field)
+                    if parent_relation is None and field in self.computed_fields:
+                        self.add_annotated_field(AnnotatedField(field, self.computed_fields[field]))
+                        continue
                     if field == '__all__':
                         _, ml_fields = self.validate_fields(
                             model_fields,
@@ -135,6 +448,29 @@ class BaseREST:
             return relations or None, _fields
         raise Exception('fields is not valid, must be a set or a string')
 
+    def get_read_using(self) -> str:
+        """
+        The database alias for the reads of the current request.
+        """
+        request = getattr(self, 'request', None)
+        if request is not None and self.read_your_writes_window and routing.is_pinned_to_primary(
+            request, self.primary_pin_cookie, self.primary_pin_header, self.read_your_writes_window
+        ):
+            return self.get_write_using()
+        return self.read_using or DEFAULT_DB_ALIAS
+
+    def get_write_using(self) -> str:
+        return self.write_using or DEFAULT_DB_ALIAS
+
+    def get_read_queryset(self) -> QuerySet:
+        return self.build_query_relations(
+            self.model.objects.using(self.get_read_using()),
+            projection=True
+        )
+
+    def get_write_queryset(self) -> QuerySet:
+        return self.build_query_relations(self.model.objects.using(self.get_write_using()))
+
     def resolve_pagination(self, request : HttpRequest, objects : list):
         pagination = Pagination(objects)
         if pages := int(request.GET.get('pages', 0)):
@@ -144,10 +480,42 @@ class BaseREST:
 
         return pagination.pages or objects
 
-    def build_query_relations(self, initial_query: QuerySet):
+    def build_query_relations(self, initial_query: QuerySet, projection = False):
+        """
+        With `projection`, only the columns of the fields are fetched. The writes need the full rows.
+        """
+        initial_query= self.__build_q_annotations(initial_query)
         initial_query= self.__build_q_related_selections(initial_query)
+        if projection:
+            return self.__build_q_projection(initial_query)
         return self.__build_q_prefetched_selections(initial_query)
 
+    def __build_q_projection(self, initial_query: QuerySet):
+        only_fields, prefetches = projection.build_projection(
+            self.model,
+            self.local_fields,
+            self.relations,
+            # read by the conditional responses and the synchronization
+            [field for field in (self.version_field, self.sync_field) if field]
+        )
+        if prefetches:
+            initial_query = initial_query.prefetch_related(*prefetches)
+        return initial_query.only(*only_fields)
+
+    def __build_q_annotations(self, initial_query: QuerySet):
+        if self.annotated_fields:
+            initial_query = initial_query.annotate(**{
+                field.name: field.expression for field in self.annotated_fields
+            })
+        annotated_names = {field.name for field in self.annotated_fields}
+        if aliases := {
+            name: expression for name, expression in self.computed_fields.items()
+            if name not in annotated_names
+        }:
+            # the computed fields out of the response, still usable in filters and ordering
+            initial_query = initial_query.alias(**aliases)
+        return initial_query
+
     def __build_q_related_selections(self, initial_query: QuerySet):
         if self.related_selections:
             initial_query = initial_query.select_related(*self.related_selections)
@@ -159,9 +527,12 @@ class BaseREST:
         return initial_query
 
     async def retrieve(self, pk):
-        object_ = await self.build_query_relations(self.model.objects).aget(pk = pk)
+        object_ = await db_sync_to_async(self.get_read_queryset().get)(pk = pk)
         parsed_object = await self.parse_object(object_)
-        return JsonResponse(parsed_object)
+        response = JsonResponse(parsed_object)
+        if self.version_field:
+            response['ETag'] = versioning.get_etag(getattr(object_, self.version_field))
+        return response
 
     async def parse_objects(self, objects):
         return [await self.parse_object(obj) for obj in objects]
@@ -170,7 +541,10 @@ class BaseREST:
         model_instance,
         fields: set[LocalField] | None = None,
     ):
+        metrics.add_rows(1)
         parsed_object = self.parse_local_fields(model_instance)
+        if self.annotated_fields:
+            parsed_object |= self.parse_local_fields(model_instance, self.annotated_fields)
         await self.parse_relations(model_instance, parsed_object)
         return parsed_object
 
@@ -188,7 +562,7 @@ class BaseREST:
     def parse_local_fields(
         self,
         model_instance,
-        fields: set[LocalField] | None = None
+        fields: set[LocalField] | set[AnnotatedField] | None = None
     ):
         parsed_object = {}
         if fields is None:
@@ -201,44 +575,101 @@ class BaseREST:
         return parsed_object
 
 
+    def initialize_request_fields(self, request: HttpRequest):
+        """
+        Initializes the fields requested in the `onlyFields` URL param, if it's allowed.
+        """
+        if not self.allow_only_fields:
+            return
+        of_str = request.GET.get('onlyFields', None)
+        if of_str and not isinstance(of_str, str):
+            of_str=str(of_str)
+        only_fields = self.resolve_only_fields(
+            of_str
+        )
+        if only_fields:
+            self.initialize_fields(only_fields)
+        return
+
     def resolve_only_fields(self, only_fields : str | None = None):
         """
         Resolve the fields to be included in the response.
 
-        If `only_fields` is None, it will return None.
-        If `only_fields` is '__all__', it will return the validated fields of the model.
-        If `only_fields` is a string, it will be split by commas and each field will be processed.
+        If `only_fields` is None or '__all__', it will return None (the fields of the view).
+        If `only_fields` is a string, it will be split by commas, and each dotted path
+        (e.g. `team.league.name`) will be checked with the fields declared in the view.
 
         Returns:
-            list: A list of fields to be included in the response.
+            set: The fields to be included in the response, in the syntax of `fields`.
         """
-        if not only_fields:
+        if not only_fields or only_fields == '__all__':
             return None
-        if only_fields == '__all__':
-            return self.model_fields
-        fields = set()
-        relations = {}
-        # sepparated comma fields
-        sprtd_cmm_flds = only_fields.split(',')
+        declared = self.get_fields_tree()
+        requested = {}
+        aggregates = set()
+        for path in only_fields.split(','):
+            parts = path.strip().split('.')
+            if is_aggregate_field(tuple(parts)):
+                # e.g. players.__count__ or players.__max__.goals
+                aggregates.add(tuple(parts))
+                continue
+            node = requested
+            for part in parts[:-1]:
+                if not isinstance(node.get(part), dict):
+                    node[part] = {}
+                node = node[part]
+            # a relation requested before with some fields keeps them
+            node.setdefault(parts[-1], None)
+        fields = self._select_fields(declared, requested)
+        for aggregate in aggregates:
+            if aggregate not in {
+                value.declaration for value in declared.values() if isinstance(value, AnnotatedField)
+            }:
+                raise exceptions.FieldNotInView('.'.join(aggregate))
+            fields.add(aggregate)
+        return fields
 
-        for formated_field in sprtd_cmm_flds:
-            if '.' in formated_field:
-                try:
-                    relation_name, related_field = formated_field.split('.')
-                except ValueError:
-                    raise exceptions.MultipleLevelRelation(formated_field)
-                if related_field == '__all__':
-                    relations[relation_name] = related_field
-                    continue
-                if relations.get(relation_name):
-                    relations[relation_name].append(related_field)
-                else:
-                    relations[relation_name] = [related_field]
+    def get_fields_tree(self) -> dict:
+        """
+        The fields declared in the view as a tree: `None` for the local fields,
+        the `AnnotatedField` for the annotations and a tree for each relation.
+        """
+        plan = type(self).compile_fields()
+        tree = {field.name: None for field in plan['local_fields']}
+        tree |= {field.name: field for field in plan['annotated_fields']}
+        for relation in plan['relations'] or ():
+            if not relation.parent:
+                tree[relation._field_name] = self.__get_relation_tree(relation)
+        return tree
+
+    def __get_relation_tree(self, relation: Relation) -> dict:
+        tree = {field.name: None for field in relation.relation_fields or ()}
+        for daughter in relation.daughters:
+            tree[daughter._field_name] = self.__get_relation_tree(daughter)
+        return tree
+
+    def _select_fields(self, declared: dict, requested: dict | None = None, path: str = '') -> set:
+        """
+        The `requested` subtree of the `declared` fields in the syntax of `fields`, all of them if it's None.
+        """
+        if requested is None or '__all__' in requested:
+            requested = {name: None for name in declared} | {
+                name: subtree for name, subtree in (requested or {}).items() if name != '__all__'
+            }
+        fields = set()
+        for name, subtree in requested.items():
+            if not path and name in self.privated_fields:
+                raise exceptions.FieldIsPrivated(name)
+            if name not in declared:
+                raise exceptions.FieldNotInView(path + name)
+            value = declared[name]
+            if isinstance(value, dict):
+                fields.add((name, tuple(self._select_fields(value, subtree, '%s%s.'%(path, name)))))
                 continue
-            fields.add(formated_field)
-        for relation_name, relation_fields in relations.items():
-            fields.add((relation_name, tuple(relation_fields)))
-        del relations, sprtd_cmm_flds
+            if subtree is not None:
+                # a local field hasn't fields
+                raise exceptions.FieldNotInView('%s%s.%s'%(path, name, next(iter(subtree))))
+            fields.add(value.declaration if isinstance(value, AnnotatedField) else name)
         return fields
 
     def _clean_relations_in_data(self, data :dict):
@@ -257,6 +688,23 @@ class BaseREST:
                         relation.get_related_fk(_data[relation._field_name])
         return _data, related_names
 
+    def pin_reads_after_write(view_func):
+        """
+        Pins the following reads of the client to the primary database after a successful write.
+        """
+        @wraps(view_func)
+        async def wrapper(self: 'BaseREST', *args, **kwargs):
+            response = await view_func(self, *args, **kwargs)
+            if self.read_your_writes_window and response.status_code < 400:
+                routing.pin_to_primary(
+                    response,
+                    self.read_your_writes_window,
+                    self.primary_pin_cookie,
+                    self.primary_pin_header
+                )
+            return response
+        return wrapper
+
     def validate_pk_provided(view_func):
         async def wrapper(*args, **kwargs):
             pk = kwargs.get('id', None)
@@ -272,12 +720,19 @@ class BaseREST:
     async def dispatch_update(self, data: dict, pk, clean=True):
         status = 200
         body_response = {}
+        version = None
         try:
-            body_response= await self._update_model_instance(pk, data, clean)
-        except exceptions.ObjectDoesNotExist:
+            body_response, version = await self._update_model_instance(pk, data, clean)
+        except exceptions.PreconditionFailed as exp:
+            metrics.record_error(exp)
+            body_response['error'] = exp.message
+            status = 412
+        except exceptions.ObjectDoesNotExist as exp:
+            metrics.record_error(exp)
             body_response['error'] = f'The requested object identified by {pk} does not exists'
             status = 404
         except exceptions.IntegrityError as exp:
+            metrics.record_error(exp)
             body_response['error'] = str(exp)
             status = 400
         except (
@@ -288,10 +743,15 @@ class BaseREST:
             exceptions.InvalidRelationField,
             exceptions.Invalid2ManyRelationMode,
             exceptions.ObjectToRelateDoesNotExists,
+            exceptions.Invalid2ManyRelationFormat,
         ) as exp:
+            metrics.record_error(exp)
             body_response['error'] = exp.message
             status = 400
-        return JsonResponse(body_response, status=status)
+        response = JsonResponse(body_response, status=status)
+        if version is not None:
+            response['ETag'] = versioning.get_etag(version)
+        return response
 
     def get_filter_from_request(self, request: HttpRequest):
         if not request.method == 'GET':
@@ -299,54 +759,99 @@ class BaseREST:
         query_filter= FilterURLBuilder(request.GET, self.model, self.filter_url_param)
         return query_filter.build_node_filter()
 
+    def get_ordering_from_request(self, request: HttpRequest) -> list:
+        """
+        The ordering of the `orderBy` URL param, by model fields, computed fields or annotations.
+        """
+        if not (order_by := request.GET.get(self.order_url_param, None)):
+            return []
+        orderable_names = self.model_fields | set(self.computed_fields) | \
+            {field.name for field in self.annotated_fields}
+        ordering = []
+        for order_field in order_by.split(','):
+            name = order_field.removeprefix('-')
+            if name in self.privated_fields:
+                raise exceptions.FieldIsPrivated(name)
+            if name not in orderable_names:
+                raise exceptions.InvalidOrderField(name)
+            ordering.append(order_field)
+        return ordering
+
     async def _update_model_instance(self, pk, data: dict, clean = True):
         update_body={}
-        # build query for retrieve the object
-        queryset = self.build_query_relations(self.model.objects)
-        #retrieve the model instance identified by pk
-        model_instance = await queryset.aget(pk=pk)
-        # update the local attributes
-        local_fields_updated = self._update_local_fields_in_model_instance(model_instance, data, clean)
-        # promove the relations in a gather
-        relations_updated, gather_coroutine = self._update_relation_fields_in_model_instance(model_instance, data)
-        gathering_process = []
-        if local_fields_updated or relations_updated:
-            gathering_process.append(model_instance.asave(force_update=True))
-        if gather_coroutine:
-            gathering_process.append(gather_coroutine)
-        if gathering_process:
-            #in an atomic...
-            async with async_atomic():
-                # save the model instance
-                await gather(*gathering_process)
+        expected_version = None
+        if self.version_field:
+            expected_version = versioning.get_expected_version(
+                getattr(self, 'request', None),
+                self.model._meta.get_field(self.version_field),
+                data
+            )
+        # the read, the writes and the transaction in one call to the database
+        unit_of_work = UnitOfWork(self.get_write_using())
+        unit_of_work.add(self._apply_update, pk, data, clean, unit_of_work, expected_version)
+        model_instance, fields_updated = (await unit_of_work.commit())[0]
+        if fields_updated:
             update_body['message'] = f'\'{model_instance}\' updated sucessfully'
-            update_body['observation'] = f'Fields updated: {local_fields_updated | relations_updated}'
+            update_body['observation'] = f'Fields updated: {fields_updated}'
         else:
             update_body['message'] = 'Nothing for update'
         parsed_object = await self.parse_object(model_instance, self.local_fields)
         update_body['object'] = parsed_object
+        version = getattr(model_instance, self.version_field) if self.version_field else None
         del model_instance
-        return update_body
+        return update_body, version
+
+    def _apply_update(self, pk, data: dict, clean: bool, unit_of_work: UnitOfWork, expected_version=None):
+        # build query for retrieve the object
+        queryset = self.get_write_queryset()
+        #retrieve the model instance identified by pk
+        model_instance = queryset.get(pk=pk)
+        if self.version_field:
+            current_version = getattr(model_instance, self.version_field)
+            if expected_version is not None and current_version != expected_version:
+                raise exceptions.PreconditionFailed(expected_version)
+        # update the local attributes
+        local_fields_updated = self._update_local_fields_in_model_instance(model_instance, data, clean)
+        # the related objects are checked before save, the to many relations after
+        relations_updated = self._update_relation_fields_in_model_instance(
+            model_instance, data, unit_of_work
+        )
+        if self.version_field and (local_fields_updated or relations_updated):
+            # fails if other client changed the object after the read
+            unit_of_work.add(
+                versioning.save_versioned,
+                model_instance,
+                self.version_field,
+                local_fields_updated | relations_updated,
+                current_version,
+                self.get_write_using()
+            )
+        elif local_fields_updated or relations_updated:
+            unit_of_work.add(model_instance.save, force_update=True)
+        return model_instance, local_fields_updated | relations_updated
 
     def _update_local_fields_in_model_instance(self, model_instance, data: dict, clean = True):
         fields_updated = set()
         for local_field in self.local_fields:
             if local_field.name in data and \
                 not local_field._model_field.primary_key and \
+                local_field.name != self.version_field and \
                 (not clean or \
                     getattr(model_instance, local_field.name) != data[local_field.name]):
-                setattr(model_instance, local_field.name, data[local_field.name] or None)
+                value = data[local_field.name]
+                # the empty strings of the nullable fields are saved as null, the validated falsy values (0, False) aren't
+                setattr(
+                    model_instance,
+                    local_field.name,
+                    None if value == '' and local_field._model_field.null else value
+                )
                 fields_updated.add(local_field.name)
         return fields_updated
 
-    def __get_async_function_r_manager(self, relation: Relation, model_instance, relation_data: dict | list):
-        r_manager = getattr(model_instance, relation._field_name, None)
+    def __get_r_manager_operation(self, relation: Relation, relation_data: dict | list):
         valid_modes = 'add', 'set', 'remove'
-        if not r_manager:
-            return
-        async_func = None
         if isinstance(relation_data, list):
-            return r_manager.aset(relation_data)
+            return 'set', relation_data
         if isinstance(relation_data, dict):
             if not (to_rel:=relation_data.get('to', None)):
                 raise exceptions.EmptyToObjectsForRelate(relation._field_name)
@@ -355,26 +860,63 @@ class BaseREST:
             mode= relation_data.get('mode', None) or 'set'
             if not mode in valid_modes:
                 raise exceptions.Invalid2ManyRelationMode(mode, valid_modes, relation._field_name)
-            async_func = getattr(r_manager, 'a%s'%mode)
-            if mode != valid_modes[1]:
-                return async_func(*to_rel)
-            return async_func(to_rel)
+            return mode, to_rel
         raise exceptions.Invalid2ManyRelationFormat(relation_data)
 
-    def _update_relation_fields_in_model_instance(self, model_instance, data: dict):
+    def _write_to_many_relation(self, changes: list[tuple], relation: Relation):
+        """
+        Applies the `(instance, mode, pks)` changes of a to many relation.
+        """
+        field_name = relation._field_name
+        if writer := m2m.get_writer(relation):
+            # the differences with the current links of all the objects, in the through table
+            writer.write(changes, changes[0][0]._state.db, self.send_m2m_signals)
+            for model_instance, _, _ in changes:
+                m2m.clear_prefetched(model_instance, field_name)
+            return
+        for model_instance, mode, pks in changes:
+            r_manager = getattr(model_instance, field_name, None)
+            if not r_manager:
+                continue
+            if mode == 'set':
+                r_manager.set(pks)
+            else:
+                getattr(r_manager, mode)(*pks)
+        return
+
+    def _write_nested_relation(self, model_instance, relation: Relation, objects: list[dict], delete_missing: bool):
+        writer = nested.OneToManyWriter(relation)
+        writer.write(model_instance, objects, delete_missing, model_instance._state.db)
+        m2m.clear_prefetched(model_instance, relation._field_name)
+        return
+
+    def _update_relation_fields_in_model_instance(self, model_instance, data: dict, unit_of_work: UnitOfWork):
+        """
+        Applies the relations in `data` to the model instance. The checks of the related
+        objects are added to `unit_of_work`, and the writes of the to many relations
+        are deferred after the save of the instance.
+        """
         relations_updated = set()
-        gathered_process = []
-        gather_rel = None
         if not self.relations:
-            return relations_updated, gather_rel
+            return relations_updated
         for relation in self.relations:
             if relation.parent or relation._field_name not in data:
                 continue
-            if relation.is_to_many:
-                async_func = self.__get_async_function_r_manager(
-                    relation, model_instance, data[relation._field_name]
+            if relation.is_to_many and nested.is_nested_relation(relation) and \
+                    (payload := nested.get_nested_payload(data[relation._field_name])):
+                # the objects of the relation are created, updated or deleted after the save of the instance
+                objects, delete_missing = payload
+                unit_of_work.defer(
+                    self._write_nested_relation,
+                    model_instance,
+                    relation,
+                    objects,
+                    delete_missing
                 )
-                gathered_process.append(async_func)
+            elif relation.is_to_many:
+                mode, pks = self.__get_r_manager_operation(relation, data[relation._field_name])
+                # the links of all the objects of the unit are written together, by relation
+                unit_of_work.batch(self._write_to_many_relation, (model_instance, mode, pks), relation)
             if relation.is_to_one:
                 if isinstance((value:=data[relation._field_name]), (str, int)):
                     original_value = relation._model_field.value_from_object(model_instance)
@@ -385,26 +927,43 @@ class BaseREST:
                         relation._field_name,
                         relation.get_related_fk(value)
                     )
-                    gathered_process.append(
-                        self.assign_related_data(
-                            model_instance,
-                            relation._field_name,
-                            relation.get_related_fk(value)
-                        )
+                    unit_of_work.add(
+                        self.assign_related_data,
+                        model_instance,
+                        relation._field_name,
+                        relation.get_related_fk(value)
                     )
             relations_updated.add(relation._field_name)
+        return relations_updated
 
-        if gathered_process:
-            gather_rel = gather(*gathered_process)
-        return relations_updated, gather_rel
-
-    async def assign_related_data(self, model_instance, field_name, value):
+    def assign_related_data(self, model_instance, field_name, value):
         try:
-            value = await value._meta.model.objects.aget(pk=value.pk)
+            value = value._meta.model._default_manager.db_manager(
+                model_instance._state.db
+            ).get(pk=value.pk)
             setattr(model_instance, field_name, value)
         except exceptions.ObjectDoesNotExist:
             raise exceptions.ObjectToRelateDoesNotExists(field_name, value.pk)
 
+    def validate_request_data(mode: str):
+        """
+        Validates and coerces the JSON body with the compiled validator of the view, before any query.
+        """
+        def decorator(view_func):
+            @wraps(view_func)
+            async def wrapper(self: 'BaseREST', request: HttpRequest, *args, **kwargs):
+                json_data = getattr(request, 'json_data', None)
+                if not json_data or not isinstance(json_data, dict):
+                    return base_responses.no_request_body_response
+                try:
+                    self.request_validator.validate(json_data, mode)
+                except exceptions.InvalidRequestData as exp:
+                    metrics.record_error(exp)
+                    return base_responses.invalid_data_response(exp.errors)
+                return await view_func(self, request, *args, **kwargs)
+            return wrapper
+        return decorator
+
     def clean_possible_fields(view_func):
         async def wrapper(self: 'BaseREST', *args, **kwargs):
             req=args[0]
@@ -419,13 +978,25 @@ class BaseREST:
                 return await view_func(self, *args, **kwargs)
         return wrapper
 
+    def _delete_objects(self, model, pks: list) -> int:
+        using = self.get_write_using()
+        queryset = model.objects.using(using).filter(pk__in=pks)
+        if not sync.is_tracked(model):
+            return queryset.delete()[0]
+        # one insert by model for the tombstones, of the cascaded deletions too
+        with sync.bulk_deletion():
+            deletions, _ = queryset.delete()
+        return deletions
+
     async def bulk_delete(self, pks : list, model = None):
         if not model:
             model = self.model
         response_body = {}
         status = 200
         try:
-            deletions, _ = await model.objects.filter(pk__in=pks).adelete()
+            unit_of_work = UnitOfWork(self.get_write_using())
+            unit_of_work.add(self._delete_objects, model, pks)
+            deletions = (await unit_of_work.commit())[0]
             if not deletions:
                 response_body['error']= 'Impossible delete element(s) identified by: %s'%str(pks)
                 status = 404
@@ -435,6 +1006,7 @@ class BaseREST:
                     response_body['message'] = 'Some elements identified in %s deleted sucessfully'%str(pks)
                     response_body['observation'] = 'Some elements in %s does not exists'%str(pks)
         except exceptions.IntegrityError as exp:
+            metrics.record_error(exp)
             response_body['error']= 'Impossible delete element(s) identified by: %s. Error: %s'%(str(pks), str(exp))
             status=500
         return JsonResponse(response_body, status=status)
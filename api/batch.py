@@ -0,0 +1,221 @@
+import json
+from asyncio import gather
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.core.handlers.exception import response_for_exception
+from django.db import DEFAULT_DB_ALIAS
+from django.http import HttpRequest, HttpResponse, JsonResponse, QueryDict
+from django.urls import Resolver404, resolve
+from django.views import View
+
+from api.async_transaction import async_atomic
+from api import base_responses
+
+"""
+Goal:
+    POST /batch/?atomic=true
+    [
+        {"method": "GET", "path": "/teams/1/"},
+        {"method": "PATCH", "path": "/players/3/", "body": {"team": 1}, "headers": {"If-Match": "\"2\""}}
+    ]
+
+    Resolves each operation against the URL patterns and returns all the results
+    in one response. The consecutive reads run concurrently, the writes in order.
+    With `atomic`, the writes share one transaction, rolled back if some of them fails.
+"""
+
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+# the headers of the batch request that aren't of its operations: of its body, and its conditions
+OPERATION_HEADERS = (
+    'CONTENT_TYPE',
+    'CONTENT_LENGTH',
+    'HTTP_CONTENT_ENCODING',
+    'HTTP_IF_MATCH',
+    'HTTP_IF_NONE_MATCH',
+    'HTTP_IF_MODIFIED_SINCE',
+    'HTTP_IF_UNMODIFIED_SINCE',
+    'HTTP_IF_RANGE',
+    'HTTP_RANGE',
+)
+
+
+class _RollBack(Exception):
+    pass
+
+
+class BatchView(View):
+    http_method_names = ['post']
+    max_operations = 50
+    """
+    Maximum of operations by batch.
+    """
+    allowed_methods = ('GET', *WRITE_METHODS)
+    """
+    The HTTP methods allowed in the operations.
+    """
+    atomic_url_param = 'atomic'
+
+    async def post(self, request: HttpRequest, *args, **kwargs):
+        try:
+            operations = json.loads(request.body)
+        except json.JSONDecodeError:
+            return base_responses.no_request_body_response
+        if not isinstance(operations, list) or not operations:
+            return JsonResponse({'message': 'The body must be a list of operations'}, status=400)
+        if len(operations) > self.max_operations:
+            return JsonResponse(
+                {'message': 'Maximum %d operations by batch'%self.max_operations},
+                status=400
+            )
+        for operation in operations:
+            if not isinstance(operation, dict) or \
+                not isinstance(operation.get('path'), str) or \
+                str(operation.get('method', 'GET')).upper() not in self.allowed_methods or \
+                not self.is_valid_headers(operation.get('headers', {})):
+                return JsonResponse({'message': 'Invalid operation %s'%operation}, status=400)
+        results: list[dict | None] = [None] * len(operations)
+        # the cookies of the operations, in order
+        self.cookies = SimpleCookie()
+        if request.GET.get(self.atomic_url_param) not in ('true', '1'):
+            await self.run_operations(request, operations, results)
+            return self.build_response({'results': results})
+        aliases = self.get_write_aliases(request, operations)
+        if len(aliases) > 1:
+            return JsonResponse(
+                {'message': 'The atomic writes must be of one database, not %s'%sorted(aliases)},
+                status=400
+            )
+        committed = True
+        try:
+            async with async_atomic(aliases.pop() if aliases else DEFAULT_DB_ALIAS):
+                await self.run_operations(request, operations, results, stop_on_error=True)
+        except _RollBack:
+            committed = False
+        return self.build_response({'results': results, 'committed': committed})
+
+    def build_response(self, body: dict) -> JsonResponse:
+        response = JsonResponse(body)
+        for key, morsel in self.cookies.items():
+            response.cookies[key] = morsel
+        return response
+
+    def is_valid_headers(self, headers) -> bool:
+        return isinstance(headers, dict) and \
+            all(isinstance(key, str) and isinstance(value, str) for key, value in headers.items())
+
+    def get_write_aliases(self, request: HttpRequest, operations: list) -> set[str]:
+        """
+        The databases of the write operations, by the `get_write_using` of their views.
+        """
+        aliases = set()
+        for operation in operations:
+            if str(operation.get('method', 'GET')).upper() not in WRITE_METHODS:
+                continue
+            try:
+                match = resolve(urlsplit(operation['path']).path, getattr(request, 'urlconf', None))
+            except Resolver404:
+                continue
+            view_class = getattr(match.func, 'view_class', None)
+            if view_class is None or not hasattr(view_class, 'get_write_using'):
+                aliases.add(DEFAULT_DB_ALIAS)
+                continue
+            aliases.add(view_class(**match.func.view_initkwargs).get_write_using())
+        return aliases
+
+    async def run_operations(self, request: HttpRequest, operations: list, results: list, stop_on_error=False):
+        """
+        Runs the consecutive reads concurrently, and the writes one by one in order.
+        """
+        reads = []
+        for index, operation in enumerate(operations):
+            if str(operation.get('method', 'GET')).upper() not in WRITE_METHODS:
+                reads.append(index)
+                continue
+            await self._run_reads(request, operations, results, reads)
+            reads = []
+            results[index] = await self.run_operation(request, operation)
+            if stop_on_error and results[index]['status'] >= 400:
+                raise _RollBack()
+        await self._run_reads(request, operations, results, reads)
+        return results
+
+    async def _run_reads(self, request, operations, results, indexes):
+        if not indexes:
+            return
+        for index, result in zip(indexes, await gather(*[
+            self.run_operation(request, operations[index]) for index in indexes
+        ])):
+            results[index] = result
+        return
+
+    async def run_operation(self, request: HttpRequest, operation: dict) -> dict:
+        method = str(operation.get('method', 'GET')).upper()
+        url = urlsplit(operation['path'])
+        try:
+            match = resolve(url.path, getattr(request, 'urlconf', None))
+        except Resolver404:
+            return {'status': 404, 'body': {'message': 'not found'}}
+        if getattr(match.func, 'view_class', None) is type(self):
+            return {'status': 400, 'body': {'message': 'Nested batches are not allowed'}}
+        sub_request = self.build_sub_request(
+            request, method, url, operation.get('body'), operation.get('headers', {})
+        )
+        view = match.func if iscoroutinefunction(match.func) else sync_to_async(match.func)
+        try:
+            response: HttpResponse = await view(sub_request, *match.args, **match.kwargs)
+        except Exception as exp:
+            # the response of the handler of Django, a failed operation doesn't fail the batch
+            response = await sync_to_async(response_for_exception, thread_sensitive=False)(sub_request, exp)
+        for key, morsel in response.cookies.items():
+            self.cookies[key] = morsel
+        return {
+            'status': response.status_code,
+            'headers': dict(response.headers),
+            'body': self.decode_body(response),
+        }
+
+    def build_sub_request(self, request: HttpRequest, method: str, url, body, headers: dict | None = None) -> HttpRequest:
+        """
+        A request for the operation, with the headers, cookies and user of the batch request,
+        but its body and conditional headers, and with the `headers` of the operation.
+        """
+        sub_request = HttpRequest()
+        sub_request.method = method
+        sub_request.path = sub_request.path_info = url.path
+        sub_request.META = {
+            **{key: value for key, value in request.META.items() if key not in OPERATION_HEADERS},
+            'REQUEST_METHOD': method,
+            'PATH_INFO': url.path,
+            'QUERY_STRING': url.query,
+        }
+        for name, value in (headers or {}).items():
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_%s'%key
+            sub_request.META[key] = value
+        sub_request.GET = QueryDict(url.query)
+        sub_request.COOKIES = request.COOKIES
+        sub_request._body = b''
+        if body is not None:
+            sub_request._body = json.dumps(body).encode()
+            sub_request.META['CONTENT_TYPE'] = 'application/json'
+        sub_request.META['CONTENT_LENGTH'] = str(len(sub_request._body))
+        for attribute in ('user', 'auser', 'session', 'urlconf'):
+            if hasattr(request, attribute):
+                setattr(sub_request, attribute, getattr(request, attribute))
+        return sub_request
+
+    def decode_body(self, response: HttpResponse):
+        if getattr(response, 'streaming', False):
+            return None
+        if not response.content:
+            return None
+        if response.get('Content-Type', '').startswith('application/json'):
+            return json.loads(response.content)
+        return response.content.decode(response.charset)
+    pass
+
+__all__ = ['BatchView']
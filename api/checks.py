@@ -0,0 +1,87 @@
+from django.core.checks import Error, register
+from django.core.exceptions import FieldDoesNotExist
+from api import registry, versioning
+
+@register('darc')
+def check_rest_views(app_configs=None, **kwargs):
+    """
+    Reports the invalid `fields` declarations of the registered views.
+    """
+    errors = []
+    for view_class in registry.get_registered_views():
+        if app_configs is not None and \
+            view_class.model._meta.app_config not in app_configs:
+            continue
+        if view_class.model._meta.abstract:
+            errors.append(Error(
+                'The model of %s is abstract'%registry.get_label(view_class),
+                hint='Use a concrete model.',
+                obj=view_class,
+                id='darc.E001',
+            ))
+            continue
+        if view_class.sync_field:
+            try:
+                view_class.model._meta.get_field(view_class.sync_field)
+            except FieldDoesNotExist:
+                errors.append(Error(
+                    'The sync_field \'%s\' of %s is not a field of the model'%(
+                        view_class.sync_field,
+                        registry.get_label(view_class)
+                    ),
+                    obj=view_class,
+                    id='darc.E003',
+                ))
+        if view_class.version_field:
+            try:
+                if not versioning.is_version_field(view_class.model, view_class.version_field):
+                    errors.append(Error(
+                        'The version_field \'%s\' of %s must be an integer field'%(
+                            view_class.version_field,
+                            registry.get_label(view_class)
+                        ),
+                        obj=view_class,
+                        id='darc.E004',
+                    ))
+            except FieldDoesNotExist:
+                errors.append(Error(
+                    'The version_field \'%s\' of %s is not a field of the model'%(
+                        view_class.version_field,
+                        registry.get_label(view_class)
+                    ),
+                    obj=view_class,
+                    id='darc.E004',
+                ))
+        if conflicts := sorted(set(view_class.computed_fields) & {
+            field.name for field in view_class.model._meta.get_fields()
+        }):
+            errors.append(Error(
+                'The computed fields %s of %s conflict with fields of the model'%(
+                    conflicts,
+                    registry.get_label(view_class)
+                ),
+                obj=view_class,
+                id='darc.E005',
+            ))
+        for search_field in getattr(view_class, 'search_fields', ()):
+            try:
+                view_class.model._meta.get_field(search_field)
+            except FieldDoesNotExist:
+                errors.append(Error(
+                    'The search field \'%s\' of %s is not a field of the model'%(
+                        search_field,
+                        registry.get_label(view_class)
+                    ),
+                    obj=view_class,
+                    id='darc.E006',
+                ))
+        try:
+            view_class.compile_fields()
+        except Exception as exp:
+            errors.append(Error(
+                'Invalid fields in %s: %s'%(registry.get_label(view_class), exp),
+                hint='Check the fields declaration of the view.',
+                obj=view_class,
+                id='darc.E002',
+            ))
+    return errors
@@ -0,0 +1,56 @@
+import asyncio
+
+from api import metrics
+
+"""
+Goal:
+    The identical requests in flight at the same time share one computation.
+    The first request (the leader) computes the response, the others await it.
+    The computation runs in its own task, so a cancelled leader doesn't cancel
+    the others.
+"""
+
+class SingleFlight:
+
+    def __init__(self) -> None:
+        self._flights: dict[tuple, asyncio.Future] = {}
+        self.executed = 0
+        self.shared = 0
+        return
+
+    def __len__(self):
+        return len(self._flights)
+
+    async def do(self, key: tuple, func):
+        """
+        Returns the result of `await func()`, shared by the concurrent calls with the same key.
+        """
+        loop = asyncio.get_running_loop()
+        flight = self._flights.get(key)
+        if flight is not None and flight.get_loop() is loop:
+            self.shared += 1
+            metrics.record_cache('coalescing', True)
+            return await asyncio.shield(flight)
+        flight = asyncio.ensure_future(func())
+        self._flights[key] = flight
+        flight.add_done_callback(lambda done: self._forget(key, done))
+        self.executed += 1
+        metrics.record_cache('coalescing', False)
+        return await asyncio.shield(flight)
+
+    def _forget(self, key: tuple, flight: asyncio.Future):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        return
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self._flights),
+            'executed': self.executed,
+            'shared': self.shared,
+        }
+    pass
+
+single_flight = SingleFlight()
+
+__all__ = ['SingleFlight', 'single_flight']
@@ -0,0 +1,124 @@
+from operator import attrgetter
+from types import NoneType
+from django.db.models import ObjectDoesNotExist
+
+from api.local import LocalField
+from api.relation import Relation, RelationManager
+
+"""
+Goal:
+    /my/url/path/?format=columns
+
+    {
+        "fields": ["id", "name", {"players": ["first_name", "id"]}],
+        "rows": [[1, "Team A", [["Juan", 1], ["Pedro", 2]]], ...]
+    }
+
+    The field names are sent once, and each object is a tuple of values.
+    The relations are groups of columns: a tuple for the to one relations,
+    and a list of tuples for the to many relations.
+"""
+
+def _getter(names: list[str]):
+    if not names:
+        return lambda instance: ()
+    getter = attrgetter(*names)
+    if len(names) == 1:
+        return lambda instance: (getter(instance),)
+    return getter
+
+
+class RelationColumns:
+
+    def __init__(self, relation: Relation) -> None:
+        self.relation = relation
+        self.name = relation._field_name
+        self.names = sorted(field.name for field in relation.relation_fields or ())
+        self._values = _getter(self.names)
+        self.groups = [
+            RelationColumns(daughter)
+            for daughter in sorted(relation.daughters, key=str)
+        ]
+        return
+
+    @property
+    def header(self) -> dict:
+        return {self.name: [*self.names, *(group.header for group in self.groups)]}
+
+    def _row(self, instance) -> tuple:
+        return (
+            *self._values(instance),
+            *(group.value(instance) for group in self.groups)
+        )
+
+    def to_dict(self, value):
+        if value is None:
+            return None
+        if self.relation.is_to_many:
+            return [self._to_dict(row) for row in value]
+        return self._to_dict(value)
+
+    def _to_dict(self, row: tuple) -> dict:
+        parsed_object = dict(zip(self.names, row))
+        for group, value in zip(self.groups, row[len(self.names):]):
+            parsed_object[group.name] = group.to_dict(value)
+        return parsed_object
+
+    def value(self, parent_instance):
+        try:
+            value = getattr(parent_instance, self.name)
+        except ObjectDoesNotExist:
+            return None
+        if value is None:
+            return None
+        if self.relation.is_to_many:
+            return [self._row(item) for item in value.all()]
+        return self._row(value)
+    pass
+
+
+class ColumnPlan:
+    """
+    Serializer of model instances to tuples, built with the fields of a view.
+    """
+
+    def __init__(self, local_fields: set[LocalField], relations: RelationManager | None = None) -> None:
+        self.names = sorted(field.name for field in local_fields)
+        self._values = _getter(self.names)
+        self.groups = [
+            RelationColumns(relation)
+            for relation in sorted(relations or (), key=str)
+            if not relation.parent
+        ]
+        return
+
+    @property
+    def header(self) -> list:
+        return [*self.names, *(group.header for group in self.groups)]
+
+    def row(self, instance) -> tuple:
+        return (
+            *(
+                value if isinstance(value, (str, int, float, bool, NoneType)) else str(value)
+                for value in self._values(instance)
+            ),
+            *(group.value(instance) for group in self.groups)
+        )
+
+    def to_dict(self, row: tuple) -> dict:
+        """
+        The row as the dict of the objects format.
+        """
+        parsed_object = dict(zip(self.names, row))
+        for group, value in zip(self.groups, row[len(self.names):]):
+            parsed_object[group.name] = group.to_dict(value)
+        return parsed_object
+
+    def rows(self, objects) -> list[tuple]:
+        """
+        Must be called in a synchronous context, the relations must be selected or prefetched.
+        """
+        return [self.row(instance) for instance in objects]
+    pass
+
+__all__ = ['ColumnPlan', 'RelationColumns']
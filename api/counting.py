@@ -0,0 +1,128 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, transaction
+from django.db.models import Model, QuerySet
+from django.db.models.signals import post_save, post_delete
+
+from api import metrics
+
+"""
+Goal:
+    /my/url/path/?page=3&itemsPerPage=50
+
+    {"count": 120483, "count_exact": false, "page": 3, "items_per_page": 50, "results": [...]}
+
+    The total of objects is computed by the `count_strategy` of the view:
+
+    - `exact`: a `COUNT(*)` by request.
+    - `cached`: the exact count, cached by model and query for `count_cache_ttl` seconds,
+      and invalidated by the saves and deletions of the model.
+    - `estimated`: the estimation of the database planner (PostgreSQL) or of `sqlite_stat1`
+      (SQLite, without filters). Below `exact_count_threshold` or without estimation, the count is exact.
+"""
+
+EXACT = 'exact'; CACHED = 'cached'; ESTIMATED = 'estimated'
+STRATEGIES = (EXACT, CACHED, ESTIMATED)
+
+
+def get_cache():
+    return caches[getattr(settings, 'DARC_COUNT_CACHE', 'default')]
+
+def _generation_key(model: type[Model]) -> str:
+    return 'darc-count-generation:%s'%model._meta.label_lower
+
+def invalidate(model: type[Model]):
+    """
+    Discards the cached counts of the model, in all the processes that share the cache.
+    """
+    cache = get_cache()
+    key = _generation_key(model)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # the key expired or was never set
+        cache.set(key, 1, None)
+    return
+
+def invalidate_on_commit(model: type[Model], using=None):
+    # before the commit, other requests could cache the old count again
+    transaction.on_commit(lambda: invalidate(model), using=using)
+
+def _invalidate(sender, using=None, **kwargs):
+    invalidate_on_commit(sender, using)
+
+def invalidate_on_writes(model: type[Model]):
+    """
+    Invalidates the cached counts of `model` when its objects are saved or deleted.
+    """
+    uid = 'darc_count_%s'%model._meta.label_lower
+    post_save.connect(_invalidate, sender=model, weak=False, dispatch_uid=uid)
+    post_delete.connect(_invalidate, sender=model, weak=False, dispatch_uid=uid)
+    return
+
+def count_cached(queryset: QuerySet, ttl: int) -> int:
+    cache = get_cache()
+    generation = cache.get(_generation_key(queryset.model), 0)
+    sql, params = queryset.order_by().query.sql_with_params()
+    query_hash = hashlib.sha1(
+        json.dumps([queryset.db, sql, [str(param) for param in params]]).encode()
+    ).hexdigest()
+    key = 'darc-count:%s:%s:%s'%(queryset.model._meta.label_lower, generation, query_hash)
+    count = cache.get(key)
+    metrics.record_cache('count', count is not None)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, ttl)
+    return count
+
+def estimate(queryset: QuerySet) -> int | None:
+    """
+    The number of objects estimated by the database statistics, `None` without them.
+    """
+    connection = connections[queryset.db]
+    queryset = queryset.order_by()
+    filtered = bool(queryset.query.where)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            sql, params = queryset.query.sql_with_params()
+            cursor.execute('EXPLAIN (FORMAT JSON) %s'%sql, params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]['Plan']['Plan Rows'])
+        if connection.vendor == 'sqlite' and not filtered:
+            cursor.execute('SELECT 1 FROM sqlite_master WHERE name = %s', ['sqlite_stat1'])
+            if not cursor.fetchone():
+                # without ANALYZE there aren't statistics
+                return None
+            # the first number of each stat is the rows of the table
+            cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s', [queryset.model._meta.db_table])
+            if row := cursor.fetchone():
+                return int(row[0].split()[0])
+    return None
+
+def count(queryset: QuerySet, strategy: str = EXACT, ttl: int = 60, exact_threshold: int = 1000) -> tuple[int, bool]:
+    """
+    Returns the count of the queryset and if it's exact. Must be called in a synchronous context.
+    """
+    if strategy == CACHED:
+        # exact, although it can be late until the invalidation
+        return count_cached(queryset, ttl), True
+    if strategy == ESTIMATED:
+        estimation = estimate(queryset)
+        if estimation is not None and estimation >= exact_threshold:
+            return estimation, False
+    return queryset.count(), True
+
+__all__ = [
+    'EXACT',
+    'CACHED',
+    'ESTIMATED',
+    'invalidate',
+    'invalidate_on_commit',
+    'invalidate_on_writes',
+    'count',
+]
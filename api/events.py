@@ -0,0 +1,237 @@
+import asyncio
+import json
+import threading
+from contextlib import asynccontextmanager
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Model
+from django.db.models.signals import post_save, post_delete
+from django.http import HttpRequest, StreamingHttpResponse
+from django.utils.module_loading import import_string
+
+from api.base_rest import BaseREST
+from api.executor import db_sync_to_async
+
+"""
+Goal:
+    A Server-Sent Events stream by view, with the created, updated and deleted
+    objects of its model, serialized with the `fields` of the view:
+
+        re_path(r'^teams/events/$', TeamREST.as_events_view()),
+
+    The saves and deletions of the models (the writes of the views included) are
+    published in a broker when their transaction is committed. The bulk writes of
+    the package (imports, many to many links and nested objects) don't send the
+    signals, they publish their changes with `publish_changes`. The broker is
+    in process by default; `DARC_EVENT_BROKER` is the dotted path of another
+    implementation of `BaseEventBroker` (e.g. for a shared backend).
+"""
+
+CREATED = 'created'; UPDATED = 'updated'; DELETED = 'deleted'
+
+_published_models: set[str] = set()
+
+
+class ChangeEvent:
+
+    def __init__(self, model_label: str, action: str, pk) -> None:
+        self.model_label = model_label
+        self.action = action
+        self.pk = pk
+        return
+
+    def __repr__(self) -> str:
+        return '<%s %s: %s>'%(self.action, self.model_label, self.pk)
+    pass
+
+
+class Subscription:
+    """
+    The events of a model for one consumer, in its event loop.
+    """
+
+    def __init__(self, model_label: str, max_size: int = 1000) -> None:
+        self.model_label = model_label
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue[ChangeEvent] = asyncio.Queue(max_size)
+        # the events were lost by a full queue
+        self.overflowed = False
+        return
+
+    def put(self, event: ChangeEvent):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+        return
+
+    async def get(self) -> ChangeEvent:
+        return await self.queue.get()
+    pass
+
+
+class BaseEventBroker:
+
+    def publish(self, event: ChangeEvent):
+        """
+        Sends the event to the subscribers of its model. Can be called from any thread.
+        """
+        raise NotImplementedError
+
+    def subscribe(self, model_label: str):
+        """
+        Async context manager that yields a `Subscription` to the events of the model.
+        """
+        raise NotImplementedError
+    pass
+
+
+class InProcessEventBroker(BaseEventBroker):
+
+    def __init__(self) -> None:
+        self._subscriptions: dict[str, set[Subscription]] = {}
+        self._lock = threading.Lock()
+        return
+
+    def publish(self, event: ChangeEvent):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(event.model_label, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:
+                # the event loop of the consumer is closed, it will never read again
+                with self._lock:
+                    self._subscriptions.get(event.model_label, set()).discard(subscription)
+        return
+
+    @asynccontextmanager
+    async def subscribe(self, model_label: str):
+        subscription = Subscription(model_label)
+        with self._lock:
+            self._subscriptions.setdefault(model_label, set()).add(subscription)
+        try:
+            yield subscription
+        finally:
+            with self._lock:
+                self._subscriptions[model_label].discard(subscription)
+    pass
+
+_broker: BaseEventBroker | None = None
+
+def get_broker() -> BaseEventBroker:
+    global _broker
+    if _broker is None:
+        broker_path = getattr(settings, 'DARC_EVENT_BROKER', None)
+        _broker = import_string(broker_path)() if broker_path else InProcessEventBroker()
+    return _broker
+
+def _publish_on_commit(model: type[Model], action: str, pks, using):
+    events = [ChangeEvent(model._meta.label_lower, action, pk) for pk in pks]
+    def publish():
+        broker = get_broker()
+        for event in events:
+            broker.publish(event)
+    # the transaction is already committed, a failure of the broker is logged, not raised
+    transaction.on_commit(publish, using=using, robust=True)
+
+def _saved(sender, instance, created, using, raw=False, **kwargs):
+    if raw:
+        return
+    _publish_on_commit(sender, CREATED if created else UPDATED, [instance.pk], using)
+
+def _deleted(sender, instance, using, **kwargs):
+    _publish_on_commit(sender, DELETED, [instance.pk], using)
+
+def is_published(model: type[Model]) -> bool:
+    return model._meta.label_lower in _published_models
+
+def publish_changes(model: type[Model], action: str, pks, using=None):
+    """
+    Publishes the changes of the writes that don't send `post_save` and `post_delete`
+    (the bulk operations) when their transaction is committed.
+    """
+    if not is_published(model):
+        return
+    if pks := [pk for pk in pks if pk is not None]:
+        _publish_on_commit(model, action, pks, using)
+    return
+
+def publish_model_changes(model: type[Model]):
+    """
+    Publishes the saves and deletions of `model` in the broker.
+    """
+    uid = 'darc_events_%s'%model._meta.label_lower
+    post_save.connect(_saved, sender=model, weak=False, dispatch_uid=uid)
+    post_delete.connect(_deleted, sender=model, weak=False, dispatch_uid=uid)
+    _published_models.add(model._meta.label_lower)
+    return
+
+
+class EventStreamMixin(BaseREST):
+    http_method_names = ['get', 'options']
+    event_heartbeat = 15
+    """
+    Seconds between the comments that keep alive the connection.
+    """
+
+    async def get(self, request: HttpRequest, *args, **kwargs):
+        filter_query = self.get_filter_from_request(request)
+        response = StreamingHttpResponse(
+            self.stream_events(filter_query),
+            content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    async def stream_events(self, filter_query=None):
+        async with get_broker().subscribe(self.model._meta.label_lower) as subscription:
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.get(), self.event_heartbeat)
+                except asyncio.TimeoutError:
+                    yield ': heartbeat\n\n'
+                    continue
+                if subscription.overflowed:
+                    # the client must read again the resource
+                    subscription.overflowed = False
+                    yield 'event: reset\ndata: {}\n\n'
+                data = await self.serialize_event(event, filter_query)
+                if data is None:
+                    continue
+                yield 'event: %s\ndata: %s\n\n'%(
+                    event.action,
+                    json.dumps(data, cls=DjangoJSONEncoder)
+                )
+
+    async def serialize_event(self, event: ChangeEvent, filter_query=None):
+        """
+        The object of the event with the fields of the view, or None if it doesn't match the filter.
+        """
+        if event.action == DELETED:
+            return {self.model._meta.pk.name: event.pk}
+        # the primary has the object although the replicas lag
+        query = self.get_write_queryset().filter(pk=event.pk)
+        if filter_query:
+            query = query.filter(filter_query)
+        objects = await db_sync_to_async(list)(query)
+        if not objects:
+            return None
+        return await self.parse_object(objects[0])
+    pass
+
+__all__ = [
+    'ChangeEvent',
+    'Subscription',
+    'BaseEventBroker',
+    'InProcessEventBroker',
+    'get_broker',
+    'is_published',
+    'publish_changes',
+    'publish_model_changes',
+    'EventStreamMixin',
+]
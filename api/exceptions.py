@@ -1,4 +1,4 @@
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.db.utils import IntegrityError
 
 class BaseException(Exception):
@@ -123,3 +123,107 @@ class ObjectToRelateDoesNotExists(BaseException):
             'Doesn\'t exists the identified %s with %s'%(relation_field_name, objected_pk),
             *args
         )
+
+class QueueTimeout(BaseException):
+
+    def __init__(self, view_name: str, timeout: float, *args) -> None:
+        super().__init__(
+            'The request waited more than %ss for be admitted in %s'%(timeout, view_name),
+            *args
+        )
+        return
+    pass
+
+class InvalidSyncToken(BaseException):
+
+    def __init__(self, token: str, *args) -> None:
+        super().__init__('Invalid synchronization token \'%s\''%token, *args)
+        return
+    pass
+
+class ExpiredSyncToken(BaseException):
+
+    def __init__(self, *args) -> None:
+        super().__init__(
+            'The synchronization token is older than the kept tombstones, a full synchronization is required',
+            *args
+        )
+        return
+    pass
+
+class ExportJobNotFound(BaseException):
+
+    def __init__(self, job_id: str, *args) -> None:
+        super().__init__('The export job \'%s\' does not exists'%job_id, *args)
+        return
+    pass
+
+class InvalidImportUniqueFields(BaseException):
+
+    def __init__(self, fields: list[str], *args) -> None:
+        super().__init__(
+            'The import unique fields %s must be local fields or to one relations of the view'%fields,
+            *args
+        )
+        return
+    pass
+
+class PreconditionFailed(BaseException):
+
+    def __init__(self, expected_version, *args) -> None:
+        super().__init__(
+            'The object was modified, its version is not %s anymore'%expected_version,
+            *args
+        )
+        return
+    pass
+
+class InvalidAggregateField(BaseException):
+
+    def __init__(self, expression, reason: str, *args) -> None:
+        super().__init__(f'Invalid aggregate expression {expression}: {reason}', *args)
+        return
+    pass
+
+class AnnotationNameConflict(BaseException):
+
+    def __init__(self, name: str, reason: str, *args) -> None:
+        super().__init__('The annotation \'%s\' conflicts with %s'%(name, reason), *args)
+        return
+    pass
+
+class InvalidOrderField(BaseException):
+
+    def __init__(self, field_name: str, *args) -> None:
+        super().__init__('Can\'t order by \'%s\''%field_name, *args)
+        return
+    pass
+
+class FieldNotInView(BaseException):
+
+    def __init__(self, path: str, *args) -> None:
+        super().__init__('\'%s\' is not a field of the view'%path, *args)
+        return
+    pass
+
+class InvalidPage(BaseException):
+
+    def __init__(self, page, *args) -> None:
+        super().__init__('Invalid page \'%s\', the pages and items by page start at 1'%page, *args)
+        return
+    pass
+
+class InvalidOffset(BaseException):
+
+    def __init__(self, offset, *args) -> None:
+        super().__init__('Invalid offset \'%s\', the objects start at 0'%offset, *args)
+        return
+    pass
+
+class InvalidRequestData(BaseException):
+
+    def __init__(self, errors: dict[str, list[str]], *args) -> None:
+        super().__init__('The request data is invalid', *args)
+        self.errors = errors
+        return
+    pass
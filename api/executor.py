@@ -0,0 +1,204 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from functools import wraps
+from queue import SimpleQueue, Empty
+from threading import Barrier, BoundedSemaphore, Lock
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from . import explain, metrics, profiling
+
+"""
+Goal:
+    Every ORM call of the package crosses the async/sync boundary with
+    `db_sync_to_async`. By default this is the thread sensitive
+    `sync_to_async` of asgiref (one thread for all). Configuring
+
+        DARC_DB_EXECUTOR_WORKERS = 8        # or 'auto'
+
+    in the settings, the calls are executed in a bounded thread pool, where
+    every thread keeps its own connection, reused until `CONN_MAX_AGE` and
+    closed when it becomes unusable or obsolete.
+
+    The transactions are pinned to lanes (threads of one worker) taken from the
+    same budget: with N workers, the pool has N - N // 2 threads and there are
+    at most N // 2 lanes, so at most N connections are open.
+"""
+
+_pinned_lane: ContextVar[ThreadPoolExecutor | None] = ContextVar('darc_pinned_lane', default=None)
+
+
+def _in_atomic_block():
+    return any(
+        connection.in_atomic_block
+        for connection in connections.all(initialized_only=True)
+    )
+
+def _close_old_connections():
+    # closing a connection inside an atomic block drops the transaction
+    if _in_atomic_block():
+        return
+    for connection in connections.all(initialized_only=True):
+        connection.close_if_unusable_or_obsolete()
+
+
+class DatabaseExecutor:
+    """
+    Bounded pool of threads for run the database work of the async views.
+    """
+
+    def __init__(self, max_workers: int | None = None) -> None:
+        self._max_workers = max_workers
+        # with one worker, the blocks run in the only thread of the pool
+        self._max_lanes = (max_workers or 0) // 2
+        self._executor: ThreadPoolExecutor | None = None
+        self._lanes: SimpleQueue[ThreadPoolExecutor] = SimpleQueue()
+        self._lane_slots = BoundedSemaphore(self._max_lanes or 1)
+        self._lock = Lock()
+        return
+
+    @property
+    def enabled(self):
+        return bool(self._max_workers)
+
+    @property
+    def max_workers(self):
+        return self._max_workers
+
+    @property
+    def max_lanes(self):
+        return self._max_lanes
+
+    @property
+    def pool_size(self):
+        return self._max_workers - self._max_lanes
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.pool_size,
+                        thread_name_prefix='darc-db',
+                    )
+        return self._executor
+
+    def wrap(self, func):
+        """
+        Returns an awaitable version of `func` executed in the database threads.
+        """
+        # the statements of the requests are counted, and recorded for the explained ones,
+        # and the threads of the profiled requests are sampled
+        func = profiling.tracking(explain.recording(metrics.counting_queries(func)))
+        if not self.enabled:
+            return sync_to_async(func)
+        @wraps(func)
+        def inner(*args, **kwargs):
+            _close_old_connections()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _close_old_connections()
+        @wraps(func)
+        async def call(*args, **kwargs):
+            # the lane is resolved when the call is awaited, not when it's wrapped
+            return await sync_to_async(
+                inner,
+                thread_sensitive=False,
+                executor=_pinned_lane.get() or self.executor
+            )(*args, **kwargs)
+        return call
+
+    async def acquire_lane(self):
+        """
+        Pins the following calls of the current context to one thread (and one connection),
+        required by the statements that must share a transaction.
+        Returns a token for `release_lane`.
+        """
+        if not self._max_lanes or _pinned_lane.get() is not None:
+            return None
+        # waiting a free lane never blocks the event loop
+        await sync_to_async(self._lane_slots.acquire, thread_sensitive=False)()
+        try:
+            lane = self._lanes.get_nowait()
+        except Empty:
+            lane = ThreadPoolExecutor(max_workers=1, thread_name_prefix='darc-db-lane')
+        return _pinned_lane.set(lane)
+
+    def release_lane(self, token):
+        if token is None:
+            return
+        lane = _pinned_lane.get()
+        _pinned_lane.reset(token)
+        self._lanes.put(lane)
+        self._lane_slots.release()
+        return
+
+    def shutdown(self):
+        """
+        Closes the connections of every thread and stops the pool.
+        """
+        if self._executor is not None:
+            # the barrier forces one task in each thread of the pool
+            barrier = Barrier(self.pool_size)
+            def close_all():
+                connections.close_all()
+                barrier.wait()
+            for future in [
+                self._executor.submit(close_all)
+                for _ in range(self.pool_size)
+            ]:
+                future.result()
+            self._executor.shutdown()
+            self._executor = None
+        while True:
+            try:
+                lane = self._lanes.get_nowait()
+            except Empty:
+                break
+            lane.submit(connections.close_all).result()
+            lane.shutdown()
+        return
+    pass
+
+
+def resolve_max_workers(value=None, using=DEFAULT_DB_ALIAS):
+    """
+    Resolves the `DARC_DB_EXECUTOR_WORKERS` setting.
+    With 'auto', the size is taken from the connection pool of the database
+    (`OPTIONS['pool']['max_size']`), or from the number of CPUs.
+    """
+    if value is None:
+        value = getattr(settings, 'DARC_DB_EXECUTOR_WORKERS', None)
+    if value != 'auto':
+        return int(value) if value else None
+    options = settings.DATABASES.get(using, {}).get('OPTIONS', {})
+    pool = options.get('pool')
+    if isinstance(pool, dict) and pool.get('max_size'):
+        return int(pool['max_size'])
+    return os.cpu_count() or 1
+
+_database_executor: DatabaseExecutor | None = None
+
+def get_database_executor() -> DatabaseExecutor:
+    global _database_executor
+    if _database_executor is None:
+        _database_executor = DatabaseExecutor(resolve_max_workers())
+    return _database_executor
+
+def db_sync_to_async(func):
+    """
+    `sync_to_async` for the ORM calls of the package.
+    """
+    return get_database_executor().wrap(func)
+
+__all__ = [
+    'DatabaseExecutor',
+    'get_database_executor',
+    'db_sync_to_async',
+    'resolve_max_workers',
+]
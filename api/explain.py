@@ -0,0 +1,145 @@
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections, DatabaseError, NotSupportedError
+from django.http import HttpRequest
+
+from api import utils
+
+"""
+Goal:
+    /my/url/path/?filterBy=name[contains]a&explain=1
+
+    {
+        "status": 200,
+        "duration_ms": 8.31,
+        "statements": [
+            {"using": "default", "sql": "SELECT ...", "params": ["%a%"], "duration_ms": 1.02, "plan": "SCAN ..."},
+            ...
+        ]
+    }
+
+    Instead of the data, the statements executed by the request (the main query, the prefetches
+    and the counts) with their plans and timing. Only for the staff users, or with `DEBUG`.
+"""
+
+_recorder: ContextVar['StatementRecorder | None'] = ContextVar('darc_statement_recorder', default=None)
+
+EXPLAINABLE = ('SELECT', 'WITH')
+
+
+class StatementRecorder:
+    """
+    The `execute_wrapper` that records the statements of a request.
+    """
+
+    def __init__(self) -> None:
+        self.statements: list[dict] = []
+        return
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.statements.append({
+                'using': context['connection'].alias,
+                'sql': sql,
+                'params': params,
+                'many': many,
+                'duration_ms': round((time.perf_counter() - start) * 1000, 3),
+            })
+    pass
+
+
+async def is_allowed(request: HttpRequest) -> bool:
+    if settings.DEBUG:
+        return True
+    # `request.user` can't load the user in the event loop
+    user = await utils.get_request_user(request)
+    return bool(user is not None and user.is_staff)
+
+def recording(func):
+    """
+    Wraps a function of the database threads for record its statements
+    when the calling context is explained.
+    """
+    @wraps(func)
+    def inner(*args, **kwargs):
+        if (recorder := _recorder.get()) is None:
+            return func(*args, **kwargs)
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            return func(*args, **kwargs)
+    return inner
+
+def start() -> tuple[StatementRecorder, object]:
+    """
+    Records the statements of the current context until `stop`.
+    """
+    recorder = StatementRecorder()
+    return recorder, _recorder.set(recorder)
+
+def stop(token):
+    _recorder.reset(token)
+    return
+
+def _serialize_params(params):
+    if params is None:
+        return None
+    return [
+        param if isinstance(param, (int, float, str, bool, type(None))) else str(param)
+        for param in params
+    ]
+
+def explain_statement(using: str, sql: str, params) -> str | None:
+    """
+    The plan of the statement by the database, `None` for the statements that aren't queries.
+    Must be called in a synchronous context.
+    """
+    if not sql.lstrip().upper().startswith(EXPLAINABLE):
+        return None
+    connection = connections[using]
+    try:
+        prefix = connection.ops.explain_query_prefix()
+        with connection.cursor() as cursor:
+            cursor.execute('%s %s'%(prefix, sql), params)
+            rows = cursor.fetchall()
+    except (DatabaseError, NotSupportedError):
+        return None
+    # as `QuerySet.explain()`, a line by row
+    return '\n'.join(
+        row if isinstance(row, str) else ' '.join(str(column) for column in row)
+        for row in rows
+    )
+
+def build_report(recorder: StatementRecorder) -> list[dict]:
+    """
+    The recorded statements with their plans. Must be called in a synchronous context.
+    """
+    return [
+        {
+            'using': statement['using'],
+            'sql': statement['sql'],
+            'params': _serialize_params(statement['params']) if not statement['many'] else None,
+            'duration_ms': statement['duration_ms'],
+            'plan': None if statement['many'] else explain_statement(
+                statement['using'], statement['sql'], statement['params']
+            ),
+        }
+        for statement in recorder.statements
+    ]
+
+__all__ = [
+    'StatementRecorder',
+    'is_allowed',
+    'recording',
+    'start',
+    'stop',
+    'explain_statement',
+    'build_report',
+]
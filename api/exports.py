@@ -0,0 +1,343 @@
+import asyncio
+import csv
+import json
+import os
+import tempfile
+import uuid
+from time import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import FileResponse, HttpRequest, JsonResponse
+
+from api.base_rest import BaseREST
+from api.columns import ColumnPlan
+from api.executor import db_sync_to_async
+from api.filtersets import FilterURLBuilder
+from api import exceptions, registry
+
+"""
+Goal:
+    POST /teams/exports/?filterBy=...&onlyFields=...    {"format": "csv"}
+    GET  /teams/exports/<job>/                          status and progress
+    GET  /teams/exports/<job>/?download=1               the file
+
+    The query runs by chunks in a background task, writing NDJSON or CSV files
+    in `DARC_EXPORT_DIR`. The status of each job is a JSON file beside its data,
+    so every worker that shares the directory can answer for it.
+
+    The status is saved after each chunk: a job without progress for `STALE_AFTER`
+    seconds was interrupted (e.g. its worker stopped), and is reported as failed.
+    The files of the finished jobs are removed after `DARC_EXPORT_RETENTION` seconds.
+"""
+
+PENDING = 'pending'; RUNNING = 'running'; DONE = 'done'; FAILED = 'failed'
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+STALE_AFTER = 600
+DEFAULT_RETENTION = 24 * 60 * 60
+
+
+def get_export_dir() -> str:
+    export_dir = getattr(settings, 'DARC_EXPORT_DIR', None) or \
+        os.path.join(tempfile.gettempdir(), 'darc-exports')
+    os.makedirs(export_dir, exist_ok=True)
+    return export_dir
+
+def get_export_retention() -> float:
+    return getattr(settings, 'DARC_EXPORT_RETENTION', DEFAULT_RETENTION)
+
+
+class ExportJob:
+
+    def __init__(self, name: str, format: str, id: str | None = None, view: str | None = None, **state) -> None:
+        self.id = id or uuid.uuid4().hex
+        self.name = name
+        self.format = format
+        # the label of the view that started the job, only that view answers for it
+        self.view = view
+        self.status = state.get('status', PENDING)
+        self.total = state.get('total', None)
+        self.written = state.get('written', 0)
+        self.error = state.get('error', None)
+        self.created_at = state.get('created_at', time())
+        self.updated_at = state.get('updated_at', self.created_at)
+        self.finished_at = state.get('finished_at', None)
+        return
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    @property
+    def path(self) -> str:
+        return os.path.join(get_export_dir(), '%s.%s'%(self.id, self.format))
+
+    @property
+    def status_path(self) -> str:
+        return os.path.join(get_export_dir(), '%s.json'%self.id)
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'name': self.name,
+            'format': self.format,
+            'view': self.view,
+            'status': self.status,
+            'total': self.total,
+            'written': self.written,
+            'error': self.error,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+            'finished_at': self.finished_at,
+        }
+
+    def finish(self, status: str, error: str | None = None, finished_at: float | None = None):
+        self.status = status
+        self.error = error
+        self.finished_at = finished_at or time()
+        return
+
+    def save(self):
+        self.updated_at = time()
+        # replaced at once, the readers never see a partial file
+        temporal_path = '%s.tmp'%self.status_path
+        with open(temporal_path, 'w') as status_file:
+            json.dump(self.to_dict(), status_file)
+        os.replace(temporal_path, self.status_path)
+        return
+
+    @classmethod
+    def load(cls, id: str, view: str | None = None) -> 'ExportJob':
+        """
+        The job of the identificator. With `view`, raises `ExportJobNotFound` for the jobs of other views.
+        """
+        if not id.isalnum():
+            raise exceptions.ExportJobNotFound(id)
+        try:
+            with open(os.path.join(get_export_dir(), '%s.json'%id)) as status_file:
+                job = cls(**json.load(status_file))
+        except FileNotFoundError:
+            raise exceptions.ExportJobNotFound(id)
+        if view is not None and job.view != view:
+            raise exceptions.ExportJobNotFound(id)
+        if not job.finished and time() - job.updated_at > STALE_AFTER:
+            # the task of the job stopped without saving its end
+            job.finish(FAILED, 'The export was interrupted', job.updated_at)
+        return job
+
+    def open(self):
+        """
+        The file of the job for read. Raises `ExportJobNotFound` if it was removed.
+        """
+        try:
+            return open(self.path, 'rb')
+        except FileNotFoundError:
+            raise exceptions.ExportJobNotFound(self.id)
+    pass
+
+
+def remove_expired_jobs(retention: float) -> int:
+    """
+    Removes the files of the jobs finished (or interrupted) more than `retention` seconds ago.
+    Returns the number of removed jobs.
+    """
+    removed = 0
+    for entry in os.scandir(get_export_dir()):
+        if not entry.name.endswith('.json'):
+            continue
+        try:
+            job = ExportJob.load(entry.name.removesuffix('.json'))
+        except (exceptions.ExportJobNotFound, ValueError, TypeError):
+            continue
+        if not job.finished or time() - job.finished_at <= retention:
+            continue
+        for path in (job.path, job.status_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # removed by other worker
+                pass
+        removed += 1
+    return removed
+
+
+class ExportWriter:
+    """
+    Writes the rows of a `ColumnPlan` in a file, must be used in a synchronous context.
+    The queries (`fetch`) and the file (`start` and `write`) run in different threads.
+    """
+
+    def __init__(self, job: ExportJob, column_plan: ColumnPlan) -> None:
+        self.job = job
+        self.column_plan = column_plan
+        return
+
+    def start(self, total: int):
+        self.job.status = RUNNING
+        self.job.total = total
+        with open(self.job.path, 'w', newline='') as export_file:
+            if self.job.format == 'csv':
+                csv.writer(export_file).writerow(
+                    [*self.column_plan.names, *(group.name for group in self.column_plan.groups)]
+                )
+        self.job.save()
+        return
+
+    def fetch(self, queryset) -> tuple[list, object]:
+        """
+        The rows of the objects of the queryset and the last pk, None if it's empty.
+        """
+        objects = list(queryset)
+        if not objects:
+            return [], None
+        return self.column_plan.rows(objects), objects[-1].pk
+
+    def write(self, rows: list):
+        """
+        Appends the rows to the file and saves the progress.
+        """
+        with open(self.job.path, 'a', newline='') as export_file:
+            if self.job.format == 'csv':
+                writer = csv.writer(export_file)
+                local_columns = len(self.column_plan.names)
+                for row in rows:
+                    writer.writerow([
+                        *row[:local_columns],
+                        *(
+                            json.dumps(group.to_dict(value), cls=DjangoJSONEncoder)
+                            for group, value in zip(self.column_plan.groups, row[local_columns:])
+                        )
+                    ])
+            else:
+                for row in rows:
+                    export_file.write(json.dumps(self.column_plan.to_dict(row), cls=DjangoJSONEncoder))
+                    export_file.write('\n')
+        self.job.written += len(rows)
+        self.job.save()
+        return
+    pass
+
+
+class ExportManager:
+    """
+    Runs the export jobs in background tasks of the event loop.
+    """
+
+    def __init__(self) -> None:
+        self._tasks: dict[str, asyncio.Task] = {}
+        return
+
+    async def start(self, job: ExportJob, queryset, column_plan: ColumnPlan, chunk_size: int) -> asyncio.Task:
+        await sync_to_async(job.save, thread_sensitive=False)()
+        # the reference keeps the task alive until it's done
+        task = asyncio.create_task(self.run(job, queryset, column_plan, chunk_size))
+        self._tasks[job.id] = task
+        task.add_done_callback(lambda task: self._done(job, task))
+        await sync_to_async(remove_expired_jobs, thread_sensitive=False)(get_export_retention())
+        return task
+
+    def get_task(self, job_id: str) -> asyncio.Task | None:
+        return self._tasks.get(job_id)
+
+    def _done(self, job: ExportJob, task: asyncio.Task):
+        self._tasks.pop(job.id, None)
+        if task.cancelled() and not job.finished:
+            # e.g. by the shutdown of the event loop, that can't run more threads
+            job.finish(FAILED, 'The export was cancelled')
+            job.save()
+        return
+
+    async def run(self, job: ExportJob, queryset, column_plan: ColumnPlan, chunk_size: int):
+        writer = ExportWriter(job, column_plan)
+        try:
+            total = await db_sync_to_async(queryset.count)()
+            # the file I/O out of the database threads
+            await sync_to_async(writer.start, thread_sensitive=False)(total)
+            queryset = queryset.order_by('pk')
+            last_pk = None
+            while True:
+                chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+                rows, last_pk = await db_sync_to_async(writer.fetch)(chunk[:chunk_size])
+                if last_pk is None:
+                    break
+                await sync_to_async(writer.write, thread_sensitive=False)(rows)
+            job.finish(DONE)
+        except Exception as exp:
+            job.finish(FAILED, str(exp))
+        await sync_to_async(job.save, thread_sensitive=False)()
+        return job
+    pass
+
+export_manager = ExportManager()
+
+
+class ExportMixin(BaseREST):
+    http_method_names = ['get', 'post', 'options']
+    export_chunk_size = 2000
+    """
+    Objects by query in the export jobs.
+    """
+
+    async def post(self, request: HttpRequest, *args, **kwargs):
+        export_format = 'ndjson'
+        if request.body:
+            try:
+                export_format = json.loads(request.body).get('format', export_format)
+            except (json.JSONDecodeError, AttributeError):
+                return JsonResponse({'message': 'The request has not valid body'}, status=400)
+        if export_format not in FORMATS:
+            return JsonResponse(
+                {'message': 'Invalid format, must be one of %s'%list(FORMATS)},
+                status=400
+            )
+        try:
+            self.initialize_request_fields(request)
+        except (exceptions.FieldNotInView, exceptions.FieldIsPrivated) as exp:
+            return JsonResponse({'message': exp.message}, status=400)
+        queryset = self.get_read_queryset()
+        query_filter = FilterURLBuilder(request.GET, self.model, self.filter_url_param)
+        if filter_query := query_filter.build_node_filter():
+            queryset = queryset.filter(filter_query)
+        job = ExportJob(self.model._meta.model_name, export_format, view=registry.get_label(type(self)))
+        await export_manager.start(
+            job,
+            queryset,
+            ColumnPlan(self.local_fields | self.annotated_fields, self.relations),
+            self.export_chunk_size
+        )
+        response = JsonResponse(job.to_dict(), status=202)
+        response['Location'] = '%s%s/'%(request.path.rstrip('/') + '/', job.id)
+        return response
+
+    async def get(self, request: HttpRequest, *args, **kwargs):
+        if not (job_id := kwargs.get('job', None)):
+            return JsonResponse({'message': 'No job identificator provided'}, status=400)
+        try:
+            job = await sync_to_async(ExportJob.load, thread_sensitive=False)(
+                job_id, registry.get_label(type(self))
+            )
+            if not request.GET.get('download'):
+                return JsonResponse(job.to_dict())
+            if job.status != DONE:
+                return JsonResponse({'message': 'The export is %s'%job.status}, status=409)
+            export_file = await sync_to_async(job.open, thread_sensitive=False)()
+        except exceptions.ExportJobNotFound as exp:
+            return JsonResponse({'message': exp.message}, status=404)
+        return FileResponse(
+            export_file,
+            as_attachment=True,
+            filename='%s.%s'%(job.name, job.format),
+            content_type=FORMATS[job.format]
+        )
+    pass
+
+__all__ = [
+    'ExportJob',
+    'ExportWriter',
+    'ExportManager',
+    'remove_expired_jobs',
+    'export_manager',
+    'ExportMixin',
+]
@@ -0,0 +1,306 @@
+import json
+from functools import reduce
+from operator import or_
+
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError
+from django.db.models import F, Field, Q
+from django.http import HttpRequest, JsonResponse
+
+from api.base_rest import BaseREST
+from api.unit_of_work import UnitOfWork
+from api import counting, events, exceptions
+
+"""
+Goal:
+    POST /teams/imports/            Content-Type: application/x-ndjson
+    {"id": 1, "name": "Team A", "city": 3}
+    {"name": "Team B"}
+
+    {"inserted": 1, "updated": 1, "unchanged": 0, "rejected": 0, "errors": []}
+
+    The body is read line by line, each line is validated with the fields of
+    the view and the valid objects are written by batches with one upsert
+    (`bulk_create` with `update_conflicts`) by set of fields.
+    The invalid lines are reported with their number and don't stop the import.
+    A batch rejected by the database is written again by halves, so only
+    the lines rejected by themselves are reported.
+"""
+
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/jsonlines')
+
+
+class ImportSummary:
+
+    def __init__(self, max_errors: int) -> None:
+        self.inserted = 0
+        self.updated = 0
+        # the existing objects of the lines without fields to update
+        self.unchanged = 0
+        self.rejected = 0
+        self.errors: list[dict] = []
+        self.max_errors = max_errors
+        return
+
+    def reject(self, line: int, error):
+        self.rejected += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line, 'error': error})
+        return
+
+    def to_dict(self) -> dict:
+        return {
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'unchanged': self.unchanged,
+            'rejected': self.rejected,
+            'errors': self.errors,
+        }
+    pass
+
+
+class ImportMixin(BaseREST):
+    http_method_names = ['post', 'options']
+    import_unique_fields: tuple[str, ...] | None = None
+    """
+    The fields that identify an existing object for update it, unique together in the database.
+    The primary key if `None`.
+    """
+    import_batch_size = 500
+    """
+    Objects by batch in the imports.
+    """
+    max_import_errors = 100
+    """
+    Maximum of line errors in the import response, the rejected lines are counted anyway.
+    """
+
+    @BaseREST.pin_reads_after_write
+    async def post(self, request: HttpRequest, *args, **kwargs):
+        if request.content_type not in NDJSON_CONTENT_TYPES:
+            return JsonResponse(
+                {'message': 'Content type must be one of %s'%list(NDJSON_CONTENT_TYPES)},
+                status=400
+            )
+        import_fields = self.get_import_fields()
+        unique_fields = self.get_import_unique_fields()
+        if invalid_fields := self.get_invalid_unique_fields():
+            return JsonResponse({'message': exceptions.InvalidImportUniqueFields(invalid_fields).message}, status=400)
+        summary = ImportSummary(self.max_import_errors)
+        batch: list[tuple[int, object]] = []
+        batch_keys = set()
+        # the body isn't loaded in memory, it's read line by line
+        for line_number, line in enumerate(request, start=1):
+            if not line.strip():
+                continue
+            try:
+                instance = self.build_import_instance(json.loads(line), import_fields)
+            except json.JSONDecodeError:
+                summary.reject(line_number, 'Invalid JSON')
+                continue
+            except ValidationError as exp:
+                summary.reject(line_number, exp.message_dict if hasattr(exp, 'error_dict') else exp.messages)
+                continue
+            key = self._get_unique_key(instance, unique_fields)
+            if key is not None and key in batch_keys:
+                # an upsert can't change the same row twice
+                await self.write_import_batch(batch, unique_fields, summary)
+                batch, batch_keys = [], set()
+            batch.append((line_number, instance))
+            if key is not None:
+                batch_keys.add(key)
+            if len(batch) >= self.import_batch_size:
+                await self.write_import_batch(batch, unique_fields, summary)
+                batch, batch_keys = [], set()
+        await self.write_import_batch(batch, unique_fields, summary)
+        return JsonResponse(summary.to_dict())
+
+    def get_import_fields(self) -> dict[str, Field]:
+        """
+        The fields that can be imported: the local fields of the view (but the `version_field`)
+        and its forward to one relations (by the identificator of the related object).
+        """
+        import_fields = {
+            field.name: field.model_field for field in self.local_fields
+            # the versions are incremented by the updates, never written
+            if field.name != self.version_field
+        }
+        for relation in self.relations or ():
+            if not relation.parent and relation.is_to_one and relation._model_field.concrete:
+                import_fields[relation._field_name] = relation._model_field
+        return import_fields
+
+    def get_import_unique_fields(self) -> tuple[str, ...]:
+        return tuple(self.import_unique_fields or (self.model._meta.pk.name,))
+
+    def get_invalid_unique_fields(self) -> list[str]:
+        import_fields = self.get_import_fields()
+        return [field for field in self.get_import_unique_fields() if field not in import_fields]
+
+    def get_import_save_fields(self) -> list[Field]:
+        """
+        The fields that the upserts update with the value of `pre_save`, as `save()`:
+        the `auto_now` fields and the `sync_field`, so the imported changes are synchronized.
+        """
+        save_fields = [
+            field for field in self.model._meta.concrete_fields
+            if getattr(field, 'auto_now', False) and not field.primary_key
+        ]
+        if self.sync_field:
+            sync_field = self.model._meta.get_field(self.sync_field)
+            if not sync_field.primary_key and sync_field not in save_fields:
+                save_fields.append(sync_field)
+        return save_fields
+
+    def build_import_instance(self, data, import_fields: dict[str, Field]):
+        """
+        A model instance with the values of the line, validated and converted by the model fields.
+        Raises `ValidationError` with the errors by field.
+        """
+        if not isinstance(data, dict):
+            raise ValidationError('Each line must be a JSON object')
+        if invalid_keys := [key for key in data if key not in import_fields]:
+            raise ValidationError({key: 'Unknown field' for key in invalid_keys})
+        values = {}
+        for key, value in data.items():
+            model_field = import_fields[key]
+            if model_field.is_relation and value is not None:
+                # the existence of the related objects is checked by the database
+                try:
+                    value = model_field.target_field.to_python(value)
+                except ValidationError as exp:
+                    raise ValidationError({key: exp.messages})
+            values[model_field.attname] = value
+        instance = self.model(**values)
+        instance._import_fields = frozenset(import_fields[key] for key in data)
+        instance.clean_fields(exclude={
+            field.name for field in self.model._meta.concrete_fields
+            if field.name not in import_fields or field.is_relation
+        })
+        return instance
+
+    def _get_unique_key(self, instance, unique_fields: tuple[str, ...]):
+        key = tuple(
+            getattr(instance, self.model._meta.get_field(name).attname)
+            for name in unique_fields
+        )
+        if None in key:
+            return None
+        return key
+
+    async def write_import_batch(self, batch: list[tuple[int, object]], unique_fields: tuple[str, ...], summary: ImportSummary):
+        """
+        Writes the batch in one transaction. If the database rejects it, its halves are written
+        in their own transactions, until the rejected lines are found.
+        """
+        if not batch:
+            return
+        pks = [instance.pk for _, instance in batch]
+        unit_of_work = UnitOfWork(self.get_write_using())
+        unit_of_work.add(self._upsert_batch, [instance for _, instance in batch], unique_fields)
+        try:
+            inserted, updated, unchanged = (await unit_of_work.commit())[0]
+        except DatabaseError as exp:
+            # the pks of the rolled back inserts
+            for (_, instance), pk in zip(batch, pks):
+                instance.pk = pk
+            if len(batch) == 1:
+                summary.reject(batch[0][0], str(exp))
+                return
+            middle = len(batch) // 2
+            await self.write_import_batch(batch[:middle], unique_fields, summary)
+            await self.write_import_batch(batch[middle:], unique_fields, summary)
+            return
+        summary.inserted += inserted
+        summary.updated += updated
+        summary.unchanged += unchanged
+        return
+
+    def _upsert_batch(self, instances: list, unique_fields: tuple[str, ...]) -> tuple[int, int, int]:
+        """
+        Returns the inserted, updated and unchanged objects.
+        """
+        queryset = self.model._default_manager.db_manager(self.get_write_using())
+        attnames = [self.model._meta.get_field(name).attname for name in unique_fields]
+        keys = [
+            key for instance in instances
+            if (key := self._get_unique_key(instance, unique_fields)) is not None
+        ]
+        existing = set()
+        if keys:
+            existing = set(
+                queryset.filter(reduce(or_, (Q(**dict(zip(attnames, key))) for key in keys))).\
+                    values_list(*attnames)
+            )
+        # the upsert updates the fields of the lines, so the lines are grouped by their fields
+        groups: dict[frozenset, list] = {}
+        for instance in instances:
+            groups.setdefault(instance._import_fields, []).append(instance)
+        save_fields = self.get_import_save_fields()
+        updated_keys = []
+        for import_fields, group in groups.items():
+            update_fields = [
+                field.name for field in import_fields
+                if field.name not in unique_fields and not field.primary_key
+            ]
+            if update_fields:
+                for field in save_fields:
+                    for instance in group:
+                        setattr(instance, field.attname, field.pre_save(instance, False))
+                    if field.name not in update_fields and field.name not in unique_fields:
+                        update_fields.append(field.name)
+                updated_keys += [
+                    key for instance in group
+                    if (key := self._get_unique_key(instance, unique_fields)) in existing
+                ]
+                queryset.bulk_create(
+                    group,
+                    update_conflicts=True,
+                    unique_fields=unique_fields,
+                    update_fields=update_fields
+                )
+            else:
+                # the existing objects are left as they are
+                queryset.bulk_create(group, ignore_conflicts=True)
+        if self.version_field and updated_keys:
+            # as the updates of the views, the updated objects get a new version
+            queryset.filter(reduce(or_, (Q(**dict(zip(attnames, key))) for key in updated_keys))).\
+                update(**{self.version_field: F(self.version_field) + 1})
+        # bulk_create doesn't send the signals that invalidate the cached counts and publish the events
+        counting.invalidate_on_commit(self.model, self.get_write_using())
+        self._publish_import_changes(instances, unique_fields, existing, set(updated_keys))
+        unchanged = len([key for key in keys if key in existing]) - len(updated_keys)
+        return len(instances) - len(updated_keys) - unchanged, len(updated_keys), unchanged
+
+    def _publish_import_changes(self, instances: list, unique_fields: tuple[str, ...], existing: set, updated_keys: set):
+        if not events.is_published(self.model):
+            return
+        queryset = self.model._default_manager.db_manager(self.get_write_using())
+        attnames = [self.model._meta.get_field(name).attname for name in unique_fields]
+        # the unsaved instances aren't hashable
+        keys = [(instance, self._get_unique_key(instance, unique_fields)) for instance in instances]
+        pks_by_key = {}
+        if missing := [key for instance, key in keys if instance.pk is None and key is not None]:
+            # the databases that don't return the rows of the upserts
+            pks_by_key = {
+                tuple(values[1:]): values[0]
+                for values in queryset.filter(
+                    reduce(or_, (Q(**dict(zip(attnames, key))) for key in missing))
+                ).values_list('pk', *attnames)
+            }
+        created, updated = [], []
+        for instance, key in keys:
+            if key in existing and key not in updated_keys:
+                # unchanged
+                continue
+            pk = instance.pk if instance.pk is not None else pks_by_key.get(key)
+            (updated if key in existing else created).append(pk)
+        events.publish_changes(self.model, events.CREATED, created, self.get_write_using())
+        events.publish_changes(self.model, events.UPDATED, updated, self.get_write_using())
+        return
+    pass
+
+__all__ = [
+    'ImportSummary',
+    'ImportMixin',
+]
@@ -0,0 +1,168 @@
+from collections import defaultdict
+from functools import lru_cache, reduce
+from operator import or_
+
+from django.db.models import Model, Q
+from django.db.models.fields.related_descriptors import ManyToManyDescriptor
+from django.db.models.fields.reverse_related import ManyToManyRel
+from django.db.models.signals import m2m_changed
+
+from api.relation import Relation
+
+"""
+Goal:
+    PATCH /teams/1/     {"sponsors": [1, 2, 5]}
+
+    SELECT team_id, sponsor_id FROM team_sponsors WHERE team_id IN (1)
+    DELETE FROM team_sponsors WHERE (team_id = 1 AND sponsor_id IN (3))
+    INSERT INTO team_sponsors (team_id, sponsor_id) VALUES (1, 5) ON CONFLICT DO NOTHING
+
+    The many to many writes of any number of objects are three statements by relation:
+    the current links of all the objects, one delete of the removed links and one
+    insert of the new ones, computed as the differences with the requested links.
+"""
+
+SET = 'set'; ADD = 'add'; REMOVE = 'remove'
+
+
+class ManyToManyWriter:
+    """
+    Writes the links of a many to many relation directly in its through table.
+    """
+
+    def __init__(self, rel: ManyToManyRel, reverse: bool) -> None:
+        field = rel.field
+        self.reverse = reverse
+        self.through: type[Model] = rel.through
+        if reverse:
+            # from the model of the `ManyToManyField` to the model of the relation
+            self.model, self.related_model = field.remote_field.model, field.model
+            source_name, target_name = field.m2m_reverse_field_name(), field.m2m_field_name()
+        else:
+            self.model, self.related_model = field.model, field.remote_field.model
+            source_name, target_name = field.m2m_field_name(), field.m2m_reverse_field_name()
+        self.source = self.through._meta.get_field(source_name).attname
+        self.target = self.through._meta.get_field(target_name).attname
+        return
+
+    def get_current_links(self, parents: list, using: str) -> dict[object, set]:
+        links = defaultdict(set)
+        for source, target in self.through._default_manager.db_manager(using).\
+            filter(**{'%s__in'%self.source: parents}).\
+            values_list(self.source, self.target):
+            links[source].add(target)
+        return links
+
+    def diff(self, mode: str, current: set, pks: set) -> tuple[set, set]:
+        """
+        The links to add and to remove for apply `mode` with `pks`.
+        """
+        if mode == SET:
+            return pks - current, current - pks
+        if mode == ADD:
+            return pks - current, set()
+        return set(), pks & current
+
+    def send(self, action: str, changes: dict, using: str):
+        for instance, pk_set in changes.values():
+            if pk_set:
+                m2m_changed.send(
+                    sender=self.through,
+                    instance=instance,
+                    action=action,
+                    reverse=self.reverse,
+                    model=self.related_model,
+                    pk_set=pk_set,
+                    using=using,
+                )
+        return
+
+    def publish(self, additions: dict, removals: dict, using: str):
+        """
+        Publishes the objects of both sides of the changed links, the through table doesn't send `post_save`.
+        """
+        # the events module imports the views
+        from api import events
+        events.publish_changes(self.model, events.UPDATED, [
+            pk for pk in additions if additions[pk][1] or removals[pk][1]
+        ], using)
+        events.publish_changes(self.related_model, events.UPDATED, set().union(*(
+            pk_set for changes in (additions, removals) for _, pk_set in changes.values()
+        )), using)
+        return
+
+    def write(self, changes: list[tuple[Model, str, list]], using: str, send_signals: bool = True) -> tuple[int, int]:
+        """
+        Applies the `(instance, mode, pks)` changes, with the modes of the related managers: `set`, `add`
+        and `remove`. Returns the number of links added and removed. Must be called in a synchronous context.
+        """
+        current_links = self.get_current_links([instance.pk for instance, _, _ in changes], using)
+        # the changes of an object apply in order, its writes are the difference with its final links
+        instances, final_links = {}, {}
+        for instance, mode, pks in changes:
+            links = final_links.setdefault(instance.pk, set(current_links[instance.pk]))
+            added, removed = self.diff(mode, links, set(pks))
+            final_links[instance.pk] = (links | added) - removed
+            instances[instance.pk] = instance
+        additions = {pk: (instance, final_links[pk] - current_links[pk]) for pk, instance in instances.items()}
+        removals = {pk: (instance, current_links[pk] - final_links[pk]) for pk, instance in instances.items()}
+        removed_count = sum(len(pk_set) for _, pk_set in removals.values())
+        added_count = sum(len(pk_set) for _, pk_set in additions.values())
+        manager = self.through._default_manager.db_manager(using)
+        # as `set()` of the related managers, the removals first
+        if removed_count:
+            if send_signals:
+                self.send('pre_remove', removals, using)
+            manager.filter(reduce(or_, (
+                Q(**{self.source: pk, '%s__in'%self.target: pk_set})
+                for pk, (_, pk_set) in removals.items() if pk_set
+            ))).delete()
+            if send_signals:
+                self.send('post_remove', removals, using)
+        if added_count:
+            if send_signals:
+                self.send('pre_add', additions, using)
+            manager.bulk_create([
+                self.through(**{self.source: pk, self.target: target})
+                for pk, (_, pk_set) in additions.items()
+                for target in pk_set
+            ], ignore_conflicts=True)
+            if send_signals:
+                self.send('post_add', additions, using)
+        if added_count or removed_count:
+            self.publish(additions, removals, using)
+        return added_count, removed_count
+    pass
+
+
+@lru_cache(maxsize=None)
+def _get_writer(rel: ManyToManyRel, reverse: bool) -> ManyToManyWriter:
+    return ManyToManyWriter(rel, reverse)
+
+def get_writer(relation: Relation) -> ManyToManyWriter | None:
+    """
+    The writer of a many to many relation, `None` for the relations that must be written by their managers:
+    the symmetrical ones, and the ones with a custom through model (it can require more columns).
+    """
+    rel = relation._model_field
+    if not isinstance(rel, ManyToManyRel) or not isinstance(relation._descriptor, ManyToManyDescriptor):
+        return None
+    if not rel.through._meta.auto_created or rel.symmetrical:
+        return None
+    return _get_writer(rel, relation._descriptor.reverse)
+
+def clear_prefetched(instance: Model, field_name: str):
+    """
+    Discards the prefetched objects of the relation, as the related managers after a write.
+    """
+    getattr(instance, field_name)._remove_prefetched_objects()
+    return
+
+__all__ = [
+    'SET',
+    'ADD',
+    'REMOVE',
+    'ManyToManyWriter',
+    'get_writer',
+    'clear_prefetched',
+]
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from api import sync
+
+
+class Command(BaseCommand):
+    help = 'Deletes the tombstones older than the DARC_TOMBSTONE_RETENTION setting.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='The database of the tombstones.')
+        return
+
+    def handle(self, *args, **options):
+        # the tokens older than the setting are rejected, so a shorter retention would lose deletions
+        if (retention := sync.get_tombstone_retention()) is None:
+            raise CommandError('DARC_TOMBSTONE_RETENTION is not set, the tombstones are kept forever.')
+        deleted = sync.prune_tombstones(retention, options['database'])
+        self.stdout.write('%d tombstones deleted.'%deleted)
+        return
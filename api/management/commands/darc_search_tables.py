@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from api import registry, search
+
+
+class Command(BaseCommand):
+    help = 'Creates the tables of the search backends (e.g. the FTS5 tables of SQLite) for the registered views.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='The database where the views write.')
+        parser.add_argument(
+            '--recreate',
+            action='store_true',
+            help='Drops and creates the tables again, after a change of the search_fields.'
+        )
+        return
+
+    def handle(self, *args, **options):
+        using = options['database']
+        # the search fields of all the views of a model share its table
+        searches: dict[tuple, list[str]] = {}
+        for view_class in registry.get_registered_views():
+            if not getattr(view_class, 'search_fields', ()):
+                continue
+            backend = search.get_search_backend(using, view_class.search_backend)
+            fields = searches.setdefault((backend, view_class.model), [])
+            fields += [field for field in view_class.search_fields if field not in fields]
+        for (backend, model), fields in searches.items():
+            backend.setup(model, tuple(fields), using, options['recreate'])
+            self.stdout.write('%s: %s'%(model._meta.label, ', '.join(fields)))
+        self.stdout.write('%d models set up.'%len(searches))
+        return
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from api import registry
+
+
+class Command(BaseCommand):
+    help = 'Prints the compiled field plan of every registered REST view.'
+
+    def handle(self, *args, **options):
+        views = registry.get_registered_views()
+        if not views:
+            self.stdout.write('No REST views registered.')
+            return
+        for view_class in views:
+            plan = registry.describe_view(view_class)
+            self.stdout.write(self.style.MIGRATE_HEADING(plan['view']))
+            self.stdout.write('  model: %s'%plan['model'])
+            self.stdout.write('  fields: %s'%', '.join(plan['fields']))
+            if plan['annotations']:
+                self.stdout.write('  annotations: %s'%', '.join(plan['annotations']))
+            for relation in plan['relations']:
+                self.stdout.write('  relation: %s'%relation)
+            self.stdout.write('  select_related: %s'%(', '.join(plan['select_related']) or '-'))
+            self.stdout.write('  prefetch_related: %s'%(', '.join(plan['prefetch_related']) or '-'))
+            self.stdout.write('  expected queries: %d'%plan['queries'])
+        return
@@ -0,0 +1,292 @@
+import json
+import os
+import tempfile
+import threading
+from bisect import bisect_left
+from contextlib import ExitStack
+from contextvars import ContextVar
+from functools import wraps
+from time import monotonic
+
+from django.conf import settings
+from django.db import connections
+
+"""
+Goal:
+    path('metrics/', api.views.metrics_exposition)
+
+    # TYPE darc_request_duration_seconds histogram
+    darc_request_duration_seconds_bucket{view="teams.views.TeamView",method="GET",le="0.05"} 120
+    ...
+    darc_errors_total{view="teams.views.TeamView",method="POST",exception="IntegrityError"} 3
+
+    Each process keeps its metrics in memory. With `DARC_METRICS_DIR`, each process writes
+    them to its own file in the directory (at most each `DARC_METRICS_FLUSH_INTERVAL` seconds),
+    and the endpoint of any process serves the sum of all the files.
+"""
+
+COUNTER = 'counter'; HISTOGRAM = 'histogram'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+_tracker: ContextVar['RequestTracker | None'] = ContextVar('darc_request_tracker', default=None)
+
+
+class Metric:
+
+    def __init__(self, name: str, kind: str, help: str, labels: tuple[str, ...], buckets: tuple = ()) -> None:
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # by label values, the value of the counters or the bucket counts, sum and count of the histograms
+        self.values: dict[tuple, float | list] = {}
+        return
+
+    def inc(self, label_values: tuple, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+        return
+
+    def observe(self, label_values: tuple, value: float):
+        if (state := self.values.get(label_values)) is None:
+            # the buckets, the +Inf bucket, the sum and the count
+            state = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0, 0]
+        state[bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+        return
+
+    def merge(self, values: dict):
+        for label_values, value in values.items():
+            if self.kind == COUNTER:
+                self.inc(label_values, value)
+                continue
+            state = self.values.setdefault(label_values, [0] * len(value))
+            for index, count in enumerate(value):
+                state[index] += count
+        return
+    pass
+
+
+class MetricsRegistry:
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+        self.metrics: dict[str, Metric] = {}
+        for metric in (
+            Metric('darc_request_duration_seconds', HISTOGRAM, 'Duration of the requests.', ('view', 'method'), LATENCY_BUCKETS),
+            Metric('darc_request_queries', HISTOGRAM, 'SQL statements by request.', ('view', 'method'), QUERY_BUCKETS),
+            Metric('darc_rows_serialized_total', COUNTER, 'Objects serialized in the responses.', ('view', 'method')),
+            Metric('darc_response_bytes_total', COUNTER, 'Bytes of the response bodies.', ('view', 'method')),
+            Metric('darc_cache_requests_total', COUNTER, 'Lookups of the caches by result.', ('view', 'method', 'cache', 'result')),
+            Metric('darc_errors_total', COUNTER, 'Errors of the requests by exception.', ('view', 'method', 'exception')),
+        ):
+            self.metrics[metric.name] = metric
+        return
+
+    def observe_request(self, view: str, method: str, duration: float, tracker: 'RequestTracker', response_bytes: int | None):
+        labels = (view, method)
+        with self._lock:
+            self.metrics['darc_request_duration_seconds'].observe(labels, duration)
+            self.metrics['darc_request_queries'].observe(labels, tracker.queries)
+            self.metrics['darc_rows_serialized_total'].inc(labels, tracker.rows)
+            if response_bytes is not None:
+                self.metrics['darc_response_bytes_total'].inc(labels, response_bytes)
+            for (cache, hit), count in tracker.caches.items():
+                self.metrics['darc_cache_requests_total'].inc((*labels, cache, 'hit' if hit else 'miss'), count)
+            for exception, count in tracker.errors.items():
+                self.metrics['darc_errors_total'].inc((*labels, exception), count)
+        return
+
+    def should_flush(self) -> bool:
+        """
+        If the caller must flush the metrics. The flush is claimed at once, so the
+        concurrent requests don't flush again until the next interval.
+        """
+        if not get_metrics_dir():
+            return False
+        with self._lock:
+            if monotonic() - self._last_flush < get_flush_interval():
+                return False
+            self._last_flush = monotonic()
+        return True
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                name: [[list(label_values), value] for label_values, value in metric.values.items()]
+                for name, metric in self.metrics.items()
+            }
+
+    def flush(self) -> bool:
+        """
+        Writes the metrics of the process to its file of `DARC_METRICS_DIR`.
+        Returns if the file was written, the errors of the file system don't fail the requests.
+        """
+        metrics_dir = get_metrics_dir()
+        path = os.path.join(metrics_dir, '%s.json'%os.getpid())
+        try:
+            # a temporal file by flush, replaced at once: the other processes never read a partial file
+            descriptor, temporal_path = tempfile.mkstemp(prefix='.%s-'%os.getpid(), suffix='.tmp', dir=metrics_dir)
+        except OSError:
+            return False
+        try:
+            with os.fdopen(descriptor, 'w') as metrics_file:
+                json.dump(self.snapshot(), metrics_file)
+            os.replace(temporal_path, path)
+        except OSError:
+            try:
+                os.remove(temporal_path)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def collect(self) -> dict[str, Metric]:
+        """
+        The metrics of this process, or the sum of all the processes with `DARC_METRICS_DIR`.
+        """
+        if not (metrics_dir := get_metrics_dir()):
+            snapshots = [self.snapshot()]
+        else:
+            self.flush()
+            snapshots = []
+            for entry in os.scandir(metrics_dir):
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    with open(entry.path) as metrics_file:
+                        snapshots.append(json.load(metrics_file))
+                except (OSError, json.JSONDecodeError):
+                    continue
+        collected = {
+            name: Metric(name, metric.kind, metric.help, metric.labels, metric.buckets)
+            for name, metric in self.metrics.items()
+        }
+        for snapshot in snapshots:
+            for name, values in snapshot.items():
+                if name in collected:
+                    collected[name].merge({tuple(label_values): value for label_values, value in values})
+        return collected
+
+    def exposition(self) -> str:
+        """
+        The metrics in the text format of Prometheus.
+        """
+        lines = []
+        for metric in self.collect().values():
+            lines.append('# HELP %s %s'%(metric.name, metric.help))
+            lines.append('# TYPE %s %s'%(metric.name, metric.kind))
+            for label_values, value in sorted(metric.values.items()):
+                labels = list(zip(metric.labels, label_values))
+                if metric.kind == COUNTER:
+                    lines.append('%s%s %s'%(metric.name, format_labels(labels), format_value(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip((*metric.buckets, '+Inf'), value):
+                    cumulative += count
+                    lines.append('%s_bucket%s %s'%(
+                        metric.name, format_labels([*labels, ('le', str(bound))]), format_value(cumulative)
+                    ))
+                lines.append('%s_sum%s %s'%(metric.name, format_labels(labels), format_value(value[-2])))
+                lines.append('%s_count%s %s'%(metric.name, format_labels(labels), format_value(value[-1])))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            for metric in self.metrics.values():
+                metric.values.clear()
+        return
+    pass
+
+
+class RequestTracker:
+    """
+    The measures of one request, collected from the event loop and the database threads.
+    """
+
+    def __init__(self) -> None:
+        self.queries = 0
+        self.rows = 0
+        self.caches: dict[tuple[str, bool], int] = {}
+        self.errors: dict[str, int] = {}
+        return
+
+    def __call__(self, execute, sql, params, many, context):
+        # the `execute_wrapper` of the database threads
+        self.queries += 1
+        return execute(sql, params, many, context)
+    pass
+
+
+def get_metrics_dir() -> str | None:
+    metrics_dir = getattr(settings, 'DARC_METRICS_DIR', None)
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+    return metrics_dir
+
+def get_flush_interval() -> float:
+    return getattr(settings, 'DARC_METRICS_FLUSH_INTERVAL', 1)
+
+def format_labels(labels) -> str:
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}'%','.join('%s="%s"'%(name, escape(value)) for name, value in labels)
+
+def format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def start() -> tuple[RequestTracker, object]:
+    tracker = RequestTracker()
+    return tracker, _tracker.set(tracker)
+
+def stop(token):
+    _tracker.reset(token)
+    return
+
+def add_rows(count: int):
+    if (tracker := _tracker.get()) is not None:
+        tracker.rows += count
+    return
+
+def record_cache(cache: str, hit: bool):
+    if (tracker := _tracker.get()) is not None:
+        tracker.caches[(cache, hit)] = tracker.caches.get((cache, hit), 0) + 1
+    return
+
+def record_error(exception: Exception):
+    if (tracker := _tracker.get()) is not None:
+        name = type(exception).__name__
+        tracker.errors[name] = tracker.errors.get(name, 0) + 1
+    return
+
+def counting_queries(func):
+    """
+    Wraps a function of the database threads for count its statements in the tracked request.
+    """
+    @wraps(func)
+    def inner(*args, **kwargs):
+        if (tracker := _tracker.get()) is None:
+            return func(*args, **kwargs)
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(tracker))
+            return func(*args, **kwargs)
+    return inner
+
+metrics_registry = MetricsRegistry()
+
+__all__ = [
+    'MetricsRegistry',
+    'RequestTracker',
+    'metrics_registry',
+    'start',
+    'stop',
+    'add_rows',
+    'record_cache',
+    'record_error',
+    'counting_queries',
+]
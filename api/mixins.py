@@ -1,75 +1,435 @@
+import json
+import time
+from datetime import timedelta
+
 from django.core.exceptions import FieldError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import Model
-from django.http import HttpRequest, JsonResponse
-from asgiref.sync import sync_to_async
+from django.http import HttpRequest, HttpResponse, JsonResponse
 from typing import Literal
 from api.base_rest import BaseREST
-from . import exceptions, utils
-from .async_transaction import async_atomic
+from . import counting, exceptions, explain, metrics, utils, registry, search, sync, validation
+from .coalescing import single_flight
+from .columns import ColumnPlan
+from .executor import db_sync_to_async
+from .unit_of_work import UnitOfWork
+
+COLUMNS_FORMAT = 'columns'
+COLUMNS_MEDIA_TYPE = 'application/vnd.darc.columns+json'
 
 class BaseRESTGetMixin(BaseREST):
+    coalesce_requests = False
+    """
+    On `True`, the identical GET requests in flight at the same time share
+    one computation and its encoded response.
+    """
+    format_url_param = 'format'
+    """
+    The GET request URL parameter for the format of the list. `columns` for the columnar format,
+    too requested with the `application/vnd.darc.columns+json` Accept header.
+    """
+    page_url_param = 'page'
+    """
+    The GET request URL parameter for the page number. With it, just the objects of the page are
+    fetched and the response has the total of objects (see `count_strategy`).
+    """
+    default_items_per_page = 50
+    """
+    The objects by page when the `page` URL param is given without `itemsPerPage`.
+    """
+    search_fields: tuple[str, ...] = ()
+    """
+    The text fields of the model for the full-text search with the `search` GET request URL param.
+    """
+    search_url_param = 'search'
+    """
+    The GET request URL parameter for the full-text search.
+    """
+    search_backend: str | None = None
+    """
+    The dotted path of the `api.search.BaseSearchBackend` of the view. By default, the backend
+    of the `DARC_SEARCH_BACKEND` setting or the one of the database.
+    """
+    search_config: str | None = None
+    """
+    The text search configuration (language) of the PostgreSQL backend, e.g. `english`.
+    """
+    max_rows: int | None = None
+    """
+    The maximum of objects by response. The lists over it are truncated, with the `X-Truncated`
+    header and a `Link` to the next objects. It's too the maximum of `itemsPerPage`, and of the
+    changed objects of a synchronization (the `since` token continues after the last sent object).
+    """
+    max_response_bytes: int | None = None
+    """
+    The maximum size of the serialized objects of a list response. The list is truncated
+    before the object that exceeds it, as with `max_rows`.
+    """
+    offset_url_param = 'offset'
+    """
+    The GET request URL parameter for the position of the first object of a truncated list.
+    """
+    budget_chunk_size = 500
+    """
+    The objects fetched and serialized at once while a response budget is enforced.
+    """
+    explain_url_param = 'explain'
+    """
+    The GET request URL parameter for the explain mode: with `1`, the response has the SQL statements
+    of the request with their plans and timing instead of the data. Only for staff users or with `DEBUG`.
+    """
 
     async def get(self, request : HttpRequest, *args, **kwargs):
+        if request.GET.get(self.explain_url_param) in ('1', 'true'):
+            return await self.build_explain_response(request, *args, **kwargs)
+        if not self.coalesce_requests:
+            return await self.build_get_response(request, *args, **kwargs)
+        key = await self.get_coalescing_key(request, kwargs.get('id', None))
+        status, content, headers = await single_flight.do(
+            key,
+            lambda: self._encode_get_response(request, *args, **kwargs)
+        )
+        return HttpResponse(content, status=status, headers=headers)
+
+    async def get_coalescing_key(self, request: HttpRequest, pk) -> tuple:
+        """
+        The normalized key of a GET request: view, pk, URL params, format, database and user.
+        """
+        user = await utils.get_request_user(request)
+        user_scope = user.pk if user is not None and user.is_authenticated else None
+        return (
+            registry.get_label(type(self)),
+            pk,
+            tuple(sorted(request.GET.lists())),
+            # the Accept header selects the format too
+            COLUMNS_FORMAT if self.wants_columns(request) else 'json',
+            self.get_read_using(),
+            user_scope,
+        )
+
+    async def build_explain_response(self, request: HttpRequest, *args, **kwargs):
+        """
+        Runs the request recording its statements, and responds them with their plans.
+        """
+        if not await explain.is_allowed(request):
+            return JsonResponse(
+                {'message': 'The explain mode is only for staff users'},
+                status=403
+            )
+        recorder, token = explain.start()
+        start = time.perf_counter()
+        try:
+            response = await self.build_get_response(request, *args, **kwargs)
+        finally:
+            explain.stop(token)
+        duration = time.perf_counter() - start
+        statements = await db_sync_to_async(explain.build_report)(recorder)
+        return JsonResponse({
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 3),
+            'statements': statements,
+        })
+
+    async def _encode_get_response(self, request: HttpRequest, *args, **kwargs):
+        response = await self.build_get_response(request, *args, **kwargs)
+        return response.status_code, response.content, dict(response.headers)
+
+    async def build_get_response(self, request : HttpRequest, *args, **kwargs):
         response = None
         try:
-            if self.allow_only_fields:
-                of_str = request.GET.get('onlyFields', None)
-                if of_str and not isinstance(of_str, str):
-                    of_str=str(of_str)
-                only_fields = self.resolve_only_fields(
-                    of_str
-                )
-                if only_fields:
-                    self.initialize_fields(only_fields)
+            self.initialize_request_fields(request)
             if pk := kwargs.get('id', None):
                 return await self.retrieve(pk)
-            query = self.build_query_relations(self.model.objects)
+            query = self.get_read_queryset()
             if filter_query:= self.get_filter_from_request(request):
                 query = query.filter(filter_query)
-            objects = await sync_to_async(list)(query.all())
+            if self.search_fields and (text := request.GET.get(self.search_url_param, '')):
+                query = await db_sync_to_async(self.apply_search)(query, text)
+            if ordering := self.get_ordering_from_request(request):
+                query = query.order_by(*ordering)
+            if self.sync_field and self.since_url_param in request.GET:
+                return await self.build_sync_response(request, query)
+            if self.wants_columns(request):
+                return await self.build_columns_response(request, query)
+            if self.allow_pagination and self.page_url_param in request.GET:
+                return await self.build_page_response(request, query)
+            if self.has_response_budget():
+                return await self.build_budget_response(request, query)
+            objects = await db_sync_to_async(list)(query.all())
             parsed_objects = await self.parse_objects(objects)
             if self.allow_pagination:
                 parsed_objects = self.resolve_pagination(request, parsed_objects)
             del objects, query
             response = JsonResponse(parsed_objects, safe=False)
-        except exceptions.ObjectDoesNotExist:
+        except exceptions.ObjectDoesNotExist as exp:
+            metrics.record_error(exp)
             response = JsonResponse({'message': 'not found'}, status=404)
         except (
             exceptions.FieldNotInModel,
             exceptions.MultipleLevelRelation,
-            exceptions.FieldIsPrivated
+            exceptions.FieldNotInView,
+            exceptions.FieldIsPrivated,
+            exceptions.InvalidSyncToken,
+            exceptions.InvalidOrderField,
+            exceptions.InvalidPage,
+            exceptions.InvalidOffset,
         ) as exp:
+            metrics.record_error(exp)
             response = JsonResponse({'message': exp.message}, status=400)
-        except FieldError:
+        except FieldError as exp:
+            metrics.record_error(exp)
             response = JsonResponse(
                 {'message': 'The provided fields for retrive, '\
                     'aren\'t available in the resource'},
                 status=400
             )
         return response
+
+    async def paginate_query(self, request: HttpRequest, query):
+        """
+        The query of the requested page, and the pagination data with the total of objects.
+        """
+        try:
+            page = int(request.GET.get(self.page_url_param))
+            items_per_page = int(request.GET.get('itemsPerPage', self.default_items_per_page))
+        except ValueError:
+            raise exceptions.InvalidPage(request.GET.get(self.page_url_param))
+        if page < 1 or items_per_page < 1:
+            raise exceptions.InvalidPage(page)
+        if self.max_rows is not None:
+            items_per_page = min(items_per_page, self.max_rows)
+        # the rest of a page truncated by `max_response_bytes`
+        page_offset = min(self.get_offset(request), items_per_page)
+        count, exact = await db_sync_to_async(counting.count)(
+            query,
+            self.count_strategy,
+            self.count_cache_ttl,
+            self.exact_count_threshold
+        )
+        if not query.ordered:
+            # the pages need a stable order
+            query = query.order_by('pk')
+        offset = (page - 1) * items_per_page
+        return query[offset + page_offset:offset + items_per_page], {
+            'count': count,
+            'count_exact': exact,
+            'page': page,
+            'items_per_page': items_per_page,
+        }
+
+    async def build_page_response(self, request: HttpRequest, query):
+        query, pagination = await self.paginate_query(request, query)
+        objects = await db_sync_to_async(list)(query)
+        results, truncated = self.clamp_to_bytes(await self.parse_objects(objects))
+        response = JsonResponse({**pagination, 'results': results})
+        if truncated:
+            self.set_continuation(request, response, truncated, self.get_offset(request) + len(results))
+        return response
+
+    def has_response_budget(self) -> bool:
+        return self.max_rows is not None or self.max_response_bytes is not None
+
+    def get_item_size(self, item) -> int:
+        # the item and its separator
+        return len(json.dumps(item, cls=DjangoJSONEncoder)) + 1
+
+    def get_offset(self, request: HttpRequest) -> int:
+        try:
+            offset = int(request.GET.get(self.offset_url_param, 0))
+        except ValueError:
+            raise exceptions.InvalidOffset(request.GET.get(self.offset_url_param))
+        if offset < 0:
+            raise exceptions.InvalidOffset(offset)
+        return offset
+
+    def clamp_to_bytes(self, items: list) -> tuple[list, str | None]:
+        """
+        The first serialized objects that fit in `max_response_bytes`, at least one, and
+        `bytes` when the list was truncated.
+        """
+        if self.max_response_bytes is None:
+            return items, None
+        size = 2
+        for position, item in enumerate(items):
+            size += self.get_item_size(item)
+            if position and size > self.max_response_bytes:
+                # at least one object by response, so the list always continues
+                return items[:position], 'bytes'
+        return items, None
+
+    async def fetch_within_budget(self, request: HttpRequest, query, serialize) -> tuple[list, str | None]:
+        """
+        The serialized objects from the `offset` URL param that fit in `max_rows` and
+        `max_response_bytes`, and the exceeded limit (`rows` or `bytes`) when the list was truncated.
+        The objects are fetched and serialized by chunks, so the objects after the limit aren't loaded.
+        `serialize` is an async callable that fetches and serializes a sliced query.
+        """
+        offset = self.get_offset(request)
+        if not query.ordered:
+            # the continuation needs a stable order
+            query = query.order_by('pk')
+        chunk_size = self.budget_chunk_size
+        if self.max_rows is not None:
+            # one more object tells if the list continues
+            chunk_size = min(chunk_size, self.max_rows + 1)
+        items = []
+        size = 2
+        truncated = None
+        position = offset
+        while truncated is None:
+            chunk = await serialize(query[position:position + chunk_size])
+            for item in chunk:
+                if self.max_rows is not None and len(items) >= self.max_rows:
+                    truncated = 'rows'
+                    break
+                item_size = self.get_item_size(item)
+                if self.max_response_bytes is not None and \
+                        items and size + item_size > self.max_response_bytes:
+                    # at least one object by response, so the list always continues
+                    truncated = 'bytes'
+                    break
+                items.append(item)
+                size += item_size
+            if len(chunk) < chunk_size:
+                break
+            position += chunk_size
+        return items, truncated
+
+    def set_continuation(
+        self,
+        request: HttpRequest,
+        response: HttpResponse,
+        truncated: str,
+        next_offset: int | str,
+        param: str | None = None,
+    ):
+        """
+        The headers of a truncated list, the next objects are from `next_offset` in the `param`
+        URL param (by default the `offset`).
+        """
+        params = request.GET.copy()
+        params[param or self.offset_url_param] = str(next_offset)
+        response['X-Truncated'] = truncated
+        response['Link'] = '<%s>; rel="next"'%request.build_absolute_uri(
+            '%s?%s'%(request.path, params.urlencode())
+        )
+        return response
+
+    async def build_budget_response(self, request: HttpRequest, query):
+        """
+        The list of objects within the response budget of the view.
+        """
+        async def serialize(query):
+            objects = await db_sync_to_async(list)(query)
+            return await self.parse_objects(objects)
+        parsed_objects, truncated = await self.fetch_within_budget(request, query, serialize)
+        next_offset = self.get_offset(request) + len(parsed_objects)
+        if self.allow_pagination:
+            parsed_objects = self.resolve_pagination(request, parsed_objects)
+        response = JsonResponse(parsed_objects, safe=False)
+        if truncated:
+            self.set_continuation(request, response, truncated, next_offset)
+        return response
+
+    def apply_search(self, query, text: str):
+        """
+        The objects of the query that match the text, ranked by the search backend.
+        Must be called in a synchronous context.
+        """
+        backend = search.get_search_backend(query.db, self.search_backend)
+        return backend.search(query, tuple(self.search_fields), text, self.search_config)
+
+    def wants_columns(self, request: HttpRequest) -> bool:
+        return request.GET.get(self.format_url_param) == COLUMNS_FORMAT or \
+            COLUMNS_MEDIA_TYPE in request.headers.get('Accept', '')
+
+    async def build_columns_response(self, request: HttpRequest, query):
+        """
+        The objects in the columnar format: the field names once and a tuple by object.
+        """
+        column_plan = ColumnPlan(self.local_fields | self.annotated_fields, self.relations)
+        pagination = {}
+        if self.allow_pagination and self.page_url_param in request.GET:
+            query, pagination = await self.paginate_query(request, query)
+        truncated = None
+        if not pagination and self.has_response_budget():
+            rows, truncated = await self.fetch_within_budget(
+                request, query, db_sync_to_async(column_plan.rows)
+            )
+        else:
+            # the query and the serialization in one call to the database thread
+            rows = await db_sync_to_async(column_plan.rows)(query.all())
+            if pagination:
+                # the page has at most `max_rows` objects
+                rows, truncated = self.clamp_to_bytes(rows)
+        metrics.add_rows(len(rows))
+        if self.allow_pagination and not pagination:
+            rows = self.resolve_pagination(request, rows)
+        response = JsonResponse({'fields': column_plan.header, 'rows': rows, **pagination})
+        if truncated:
+            next_offset = self.get_offset(request) + len(rows)
+            self.set_continuation(request, response, truncated, next_offset)
+        return response
+
+    async def build_sync_response(self, request: HttpRequest, query):
+        """
+        The objects changed and deleted after the token in the `since` URL param.
+        """
+        sync_field = self.model._meta.get_field(self.sync_field)
+        token = sync.SyncToken.decode(request.GET.get(self.since_url_param), sync_field)
+        if token.is_expired():
+            return JsonResponse({'message': exceptions.ExpiredSyncToken().message}, status=410)
+        overlap = sync.resolve_overlap(sync_field, self.sync_overlap)
+        # the tombstones have a timestamp, their window is the one of the timestamps
+        tombstone_overlap = overlap if isinstance(overlap, timedelta) else None
+        def fetch():
+            return (
+                sync.fetch_changes(query, self.sync_field, token, overlap, self.max_rows),
+                sync.fetch_deletions(self.model, token, self.get_read_using(), tombstone_overlap),
+            )
+        objects, (deleted, tombstone, seen_tombstones) = await db_sync_to_async(fetch)()
+        changed = await self.parse_objects(objects)
+        changed, truncated = self.clamp_to_bytes(changed)
+        if self.max_rows is not None and len(changed) > self.max_rows:
+            truncated = 'rows'
+            changed = changed[:self.max_rows]
+        # the next synchronization continues after the last sent object
+        token = sync.next_token(
+            token, objects[:len(changed)], self.sync_field, tombstone, overlap, seen_tombstones
+        ).encode()
+        response = JsonResponse({
+            'changed': changed,
+            'deleted': deleted,
+            self.since_url_param: token,
+        })
+        if truncated:
+            self.set_continuation(request, response, truncated, token, self.since_url_param)
+        return response
     pass
 
 class BaseRESTPostMixin(BaseREST):
 
+    @BaseREST.pin_reads_after_write
     @utils.validate_json_request_body
-    @utils.validate_data_fields()
+    @BaseREST.validate_request_data(validation.CREATE)
     async def post(self, request: HttpRequest, *args, **kwargs):
         data = request.json_data
         body_response = {}
         response = None
         status=200
         object_instance = self.model()
+        unit_of_work = UnitOfWork(self.get_write_using())
         self._update_local_fields_in_model_instance(object_instance, data)
-        _, gather_coroutine = self._update_relation_fields_in_model_instance(object_instance, data)
-        presave_action = getattr(self, 'pre_save', None)
-        if presave_action:
-            object_instance = presave_action(request, object_instance, *args, **kwargs)
         try:
-            async with async_atomic():
-                await object_instance.asave()
-                if gather_coroutine:
-                    await gather_coroutine
-                object_instance = await self.build_query_relations(self.model.objects).aget(pk=object_instance.pk)
+            self._update_relation_fields_in_model_instance(object_instance, data, unit_of_work)
+            presave_action = getattr(self, 'pre_save', None)
+            if presave_action:
+                object_instance = presave_action(request, object_instance, *args, **kwargs)
+            unit_of_work.add(object_instance.save, using=self.get_write_using())
+            unit_of_work.defer(
+                lambda: self.get_write_queryset().get(pk=object_instance.pk)
+            )
+            object_instance = (await unit_of_work.commit())[-1]
             body_response['message'] = f"{object_instance} has been saved sucessfully"
             parsed_object = await self.parse_object(object_instance)
             body_response['object'] = parsed_object
@@ -82,7 +442,9 @@ class BaseRESTPostMixin(BaseREST):
             exceptions.InvalidRelationField,
             exceptions.Invalid2ManyRelationMode,
             exceptions.ObjectToRelateDoesNotExists,
+            exceptions.Invalid2ManyRelationFormat,
         ) as exp:
+            metrics.record_error(exp)
             status=400
             body_response['error'] = str(exp)
         return JsonResponse(body_response, status = status)
@@ -90,16 +452,19 @@ class BaseRESTPostMixin(BaseREST):
 
 class BaseRESTPutMixin(BaseREST):
 
+    @BaseREST.pin_reads_after_write
     @utils.validate_json_request_body
-    @utils.validate_updatable_fields()
+    @BaseREST.validate_request_data(validation.REPLACE)
     @BaseREST.validate_pk_provided
     async def put(self, request: HttpRequest, *args, **kwargs):
         return await self.dispatch_update(request.json_data, kwargs.get('id'), False)
     pass
 
 class BaseRESTPatchMixin(BaseREST):
+    @BaseREST.pin_reads_after_write
     @utils.validate_json_request_body
     @BaseREST.clean_possible_fields
+    @BaseREST.validate_request_data(validation.PARTIAL)
     @BaseREST.validate_pk_provided
     async def patch(self, request : HttpRequest, *args, **kwargs):
         return await self.dispatch_update(request.json_data, kwargs.get('id'))
@@ -107,6 +472,7 @@ class BaseRESTPatchMixin(BaseREST):
 
 class BaseRESTDeleteMixin(BaseREST):
 
+    @BaseREST.pin_reads_after_write
     @utils.parse_possible_json_data
     @utils.validate_possible_json_keys(['pks'])
     async def delete(self, request: HttpRequest, *args, **kwargs):
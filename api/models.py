@@ -1,3 +1,20 @@
 from django.db import models
 
 # Create your models here.
+
+class Tombstone(models.Model):
+    """
+    Record of a deleted object, for the incremental synchronization of the views with `sync_field`.
+    """
+    model_label = models.CharField(max_length=100)
+    object_pk = models.CharField(max_length=255)
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['model_label', 'id']),
+        ]
+
+    def __str__(self) -> str:
+        return '%s %s'%(self.model_label, self.object_pk)
+    pass
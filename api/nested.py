@@ -0,0 +1,125 @@
+from django.db.models import F, Model
+from django.db.models.fields.reverse_related import ManyToOneRel, ManyToManyRel
+
+from api.local import LocalField
+from api.relation import Relation
+from api import counting, exceptions, versioning
+
+"""
+Goal:
+    POST /teams/    {"name": "Team A", "players": [{"first_name": "Ana"}, {"first_name": "Eva"}]}
+    PATCH /teams/1/ {"players": {"objects": [{"id": 3, "first_name": "Ana"}, {"first_name": "Lía"}], "delete_missing": true}}
+
+    The objects of a to many reverse relation (a foreign key to the model) are written
+    with the model in the same transaction: the objects without primary key are created,
+    the ones with primary key are updated, and with `delete_missing` the other objects of
+    the relation are deleted. One query by kind of write, for all the objects.
+"""
+
+OBJECTS = 'objects'; DELETE_MISSING = 'delete_missing'
+
+
+def is_nested_relation(relation: Relation) -> bool:
+    """
+    If the relation accepts nested objects: a to many reverse relation of a foreign key.
+    """
+    model_field = relation._model_field
+    # the many to many relations are `ManyToOneRel` too
+    return isinstance(model_field, ManyToOneRel) and not isinstance(model_field, ManyToManyRel)
+
+def get_nested_payload(value) -> tuple[list[dict], bool] | None:
+    """
+    The objects and the `delete_missing` flag of a nested payload, `None` for the lists of primary keys.
+    """
+    if isinstance(value, dict) and OBJECTS in value:
+        return value[OBJECTS], bool(value.get(DELETE_MISSING, False))
+    if isinstance(value, list) and value and all(isinstance(item, dict) for item in value):
+        return value, False
+    return None
+
+
+class OneToManyWriter:
+    """
+    Writes the objects of a to many reverse relation by bulk operations.
+    """
+
+    def __init__(self, relation: Relation) -> None:
+        self.relation = relation
+        self.fk = relation._model_field.field
+        self.model: type[Model] = self.fk.model
+        self.pk_name = self.model._meta.pk.name
+        # the versions of the objects are incremented by the updates, never written
+        self.version_fields = versioning.get_version_fields(self.model)
+        self.fields = {
+            field.name for field in relation.relation_fields or ()
+            if isinstance(field, LocalField) and not field.model_field.primary_key
+        } - self.version_fields
+        self.auto_now_fields = [
+            field for field in self.model._meta.concrete_fields if getattr(field, 'auto_now', False)
+        ]
+        return
+
+    def write(self, parent: Model, objects: list[dict], delete_missing: bool, using: str) -> dict:
+        """
+        Creates, updates and deletes the objects of the relation of `parent`.
+        Returns the number of objects by operation. Must be called in a synchronous context.
+        """
+        # the events module imports the views
+        from api import events
+        manager = self.model._default_manager.db_manager(using)
+        updates = {data[self.pk_name]: data for data in objects if data.get(self.pk_name) is not None}
+        creations = [data for data in objects if data.get(self.pk_name) is None]
+        existing = {
+            instance.pk: instance
+            for instance in manager.filter(**{self.fk.name: parent, 'pk__in': list(updates)})
+        } if updates else {}
+        for pk in updates:
+            if pk not in existing:
+                # the objects of other parents can't be taken
+                raise exceptions.ObjectToRelateDoesNotExists(self.relation._field_name, pk)
+        updated_fields = set()
+        for pk, data in updates.items():
+            instance = existing[pk]
+            for name in self.fields & set(data):
+                setattr(instance, name, data[name])
+                updated_fields.add(name)
+        if updated_fields and existing:
+            for field in self.auto_now_fields:
+                # as save(), the `auto_now` fields are updated
+                for instance in existing.values():
+                    field.pre_save(instance, False)
+                updated_fields.add(field.name)
+            manager.bulk_update(list(existing.values()), sorted(updated_fields))
+            if self.version_fields:
+                # as the updates of their views, the clients with the old versions lose
+                manager.filter(pk__in=list(existing)).update(**{
+                    name: F(name) + 1 for name in self.version_fields
+                })
+        deleted = 0
+        if delete_missing:
+            # before the creations, some databases don't return the primary keys of `bulk_create`
+            deleted, _ = manager.filter(**{self.fk.name: parent}).exclude(pk__in=list(existing)).delete()
+        created = manager.bulk_create([
+            self.model(**{self.fk.name: parent}, **{
+                name: value for name, value in data.items() if name in self.fields
+            })
+            for data in creations
+        ]) if creations else []
+        if created or updated_fields:
+            # the bulk operations don't send the signals that invalidate the cached counts and publish the events,
+            # the deletions send them
+            counting.invalidate_on_commit(self.model, using)
+            events.publish_changes(self.model, events.CREATED, [instance.pk for instance in created], using)
+            if updated_fields:
+                events.publish_changes(self.model, events.UPDATED, list(existing), using)
+        return {'created': len(created), 'updated': len(existing), 'deleted': deleted}
+    pass
+
+
+__all__ = [
+    'OBJECTS',
+    'DELETE_MISSING',
+    'is_nested_relation',
+    'get_nested_payload',
+    'OneToManyWriter',
+]
@@ -0,0 +1,274 @@
+import marshal
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.http import HttpRequest
+
+from api.explain import is_allowed
+
+"""
+Goal:
+    class TeamView(BaseRESTView):
+        ...
+        profile_sample_rate = 0.01      # or the `X-Darc-Profile: 1` header of a staff user
+
+    DARC_PROFILE_DIR/
+        teams.TeamView-<request id>.pstats       # python -m pstats, snakeviz
+        teams.TeamView-<request id>.collapsed    # flamegraph.pl, speedscope
+
+    While a profiled request runs, a thread samples the stacks of the event loop thread and of
+    the database threads that run the calls of the request. Both files are built from the
+    samples, and the oldest files are removed when the directory exceeds `DARC_PROFILE_MAX_BYTES`.
+
+    The samples of the event loop start at the callback or the task that it runs, and its idle
+    time isn't sampled. The loop runs the tasks of all the requests, so the samples of the loop
+    include the concurrent requests; the samples of the database threads are only of this request.
+"""
+
+_profiler: ContextVar['SamplingProfiler | None'] = ContextVar('darc_profiler', default=None)
+
+DEFAULT_INTERVAL = 0.005
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+
+
+def get_profile_dir() -> str:
+    profile_dir = getattr(settings, 'DARC_PROFILE_DIR', None) or \
+        os.path.join(tempfile.gettempdir(), 'darc-profiles')
+    os.makedirs(profile_dir, exist_ok=True)
+    return profile_dir
+
+def get_request_id(request: HttpRequest) -> str:
+    """
+    The `X-Request-ID` of the request, as safe file name, or a new one.
+    """
+    request_id = re.sub(r'[^A-Za-z0-9_.-]', '', request.headers.get('X-Request-ID', ''))[:64]
+    return request_id.strip('.') or uuid.uuid4().hex
+
+
+def _function_key(code) -> tuple[str, int, str]:
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of the threads of a request each `interval` seconds.
+    """
+
+    def __init__(self, interval: float = DEFAULT_INTERVAL) -> None:
+        self.interval = interval
+        self.samples: Counter[tuple] = Counter()
+        self._threads = Counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler: threading.Thread | None = None
+        self._loop_thread: int | None = None
+        return
+
+    def add_thread(self, ident: int):
+        with self._lock:
+            self._threads[ident] += 1
+        return
+
+    def remove_thread(self, ident: int):
+        with self._lock:
+            self._threads[ident] -= 1
+            if self._threads[ident] <= 0:
+                del self._threads[ident]
+        return
+
+    def sample(self):
+        with self._lock:
+            idents = set(self._threads)
+        frames = sys._current_frames()
+        for ident in idents:
+            frame = frames.get(ident)
+            stack = []
+            while frame is not None:
+                stack.append(_function_key(frame.f_code))
+                frame = frame.f_back
+            # from the root to the leaf
+            stack = tuple(reversed(stack))
+            if ident == self._loop_thread:
+                stack = trim_loop_stack(stack)
+            if stack:
+                self.samples[stack] += 1
+        return
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+        return
+
+    def start(self):
+        # the thread of the event loop that runs the request
+        self._loop_thread = threading.get_ident()
+        self.add_thread(self._loop_thread)
+        self._sampler = threading.Thread(target=self._run, name='darc-profiler', daemon=True)
+        self._sampler.start()
+        return
+
+    def stop(self):
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        return
+
+    def collapsed(self) -> str:
+        """
+        The samples in the collapsed stacks format of the flame graphs: `root;...;leaf count`.
+        """
+        def label(key):
+            filename, line, name = key
+            return '%s (%s:%d)'%(name, os.path.basename(filename), line)
+        return ''.join(
+            '%s %d\n'%(';'.join(label(key).replace(';', ':') for key in stack), count)
+            for stack, count in self.samples.most_common()
+        )
+
+    def stats(self) -> dict:
+        """
+        The samples as the stats of `pstats`: the calls are the samples, and the times are estimated by the interval.
+        """
+        stats = {}
+        callers: dict[tuple, Counter] = {}
+        for stack, count in self.samples.items():
+            elapsed = count * self.interval
+            seen = set()
+            for position, key in enumerate(stack):
+                primitive, calls, total_time, cumulative_time = stats.get(key, (0, 0, 0.0, 0.0))
+                if position == len(stack) - 1:
+                    total_time += elapsed
+                if key not in seen:
+                    # the recursive calls are counted once by sample
+                    cumulative_time += elapsed
+                    primitive += count
+                    seen.add(key)
+                stats[key] = (primitive, calls + count, total_time, cumulative_time)
+                if position:
+                    callers.setdefault(key, Counter())[stack[position - 1]] += count
+        return {
+            key: (primitive, calls, total_time, cumulative_time, {
+                caller: (caller_count, caller_count, 0.0, caller_count * self.interval)
+                for caller, caller_count in callers.get(key, {}).items()
+            })
+            for key, (primitive, calls, total_time, cumulative_time) in stats.items()
+        }
+
+    def dump(self, name: str, request_id: str) -> str | None:
+        """
+        Writes the `.pstats` and `.collapsed` files of the samples, and rotates the directory.
+        Returns the path of the files without extension, `None` if the request was shorter than a sample.
+        """
+        if not self.samples:
+            return None
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+        base_path = os.path.join(get_profile_dir(), '%s-%s'%(name, request_id))
+        with open('%s.pstats'%base_path, 'wb') as stats_file:
+            marshal.dump(self.stats(), stats_file)
+        with open('%s.collapsed'%base_path, 'w') as collapsed_file:
+            collapsed_file.write(self.collapsed())
+        rotate(getattr(settings, 'DARC_PROFILE_MAX_BYTES', DEFAULT_MAX_BYTES))
+        return base_path
+    pass
+
+
+def trim_loop_stack(stack: tuple) -> tuple:
+    """
+    The frames of a sample of the event loop thread that run a callback or a task: the frames of
+    the loop (`_run_once` and below) are removed, and the samples of the idle loop are discarded.
+    """
+    for position in range(len(stack) - 1, -1, -1):
+        filename, _, name = stack[position]
+        if name == '_run_once' and os.path.basename(filename) == 'base_events.py':
+            break
+    else:
+        # other loop implementation, the stack is kept
+        return stack
+    stack = stack[position + 1:]
+    if stack and stack[0][2] == '_run' and os.path.basename(stack[0][0]) == 'events.py':
+        # the `Handle` of the callback
+        stack = stack[1:]
+    if not stack or os.path.basename(stack[0][0]) == 'selectors.py':
+        # waiting for the sockets or the timers
+        return ()
+    return stack
+
+def rotate(max_bytes: int):
+    """
+    Removes the oldest files of the profile directory until its size is below `max_bytes`.
+    """
+    profile_dir = get_profile_dir()
+    files = []
+    for entry in os.scandir(profile_dir):
+        if entry.is_file() and entry.name.endswith(('.pstats', '.collapsed')):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # removed by other process
+            pass
+        total -= size
+    return
+
+async def should_profile(request: HttpRequest, sample_rate: float, header: str) -> bool:
+    if header and request.headers.get(header) in ('1', 'true'):
+        # as the explain mode, the profiles on demand are for the staff users
+        return await is_allowed(request)
+    return sample_rate > 0 and random.random() < sample_rate
+
+def start(interval: float = DEFAULT_INTERVAL) -> tuple[SamplingProfiler, object]:
+    """
+    Samples the current thread, and the database threads of the current context, until `stop`.
+    """
+    profiler = SamplingProfiler(interval)
+    profiler.start()
+    return profiler, _profiler.set(profiler)
+
+def stop(token):
+    profiler = _profiler.get()
+    _profiler.reset(token)
+    profiler.stop()
+    return profiler
+
+def tracking(func):
+    """
+    Wraps a function of the database threads for sample its thread
+    while it runs for a profiled context.
+    """
+    @wraps(func)
+    def inner(*args, **kwargs):
+        if (profiler := _profiler.get()) is None:
+            return func(*args, **kwargs)
+        ident = threading.get_ident()
+        profiler.add_thread(ident)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.remove_thread(ident)
+    return inner
+
+__all__ = [
+    'SamplingProfiler',
+    'get_profile_dir',
+    'get_request_id',
+    'trim_loop_stack',
+    'rotate',
+    'should_profile',
+    'start',
+    'stop',
+    'tracking',
+]
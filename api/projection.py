@@ -0,0 +1,73 @@
+from django.db.models import Model, Prefetch
+from django.db.models.fields.reverse_related import ForeignObjectRel, ManyToOneRel
+
+from api.relation import Relation, RelationManager
+
+"""
+Goal:
+    /players/?onlyFields=name,team.league.name
+
+    Player.objects.select_related('team__league').only(
+        'id', 'name', 'team', 'team__id', 'team__league', 'team__league__id', 'team__league__name'
+    )
+
+    The fields of the request are the columns of the query: the local fields with
+    `.only()`, the to one relations through `select_related` and the to many
+    relations through `Prefetch` objects with their own `.only()`.
+"""
+
+def is_forward(relation: Relation) -> bool:
+    return not isinstance(relation._model_field, ForeignObjectRel)
+
+def get_relation_columns(relation: Relation) -> set[str]:
+    """
+    The fields of the related model required for serialize the relation and its daughters.
+    """
+    model: type[Model] = relation.to_m
+    columns = {model._meta.pk.name}
+    columns |= {field.name for field in relation.relation_fields or ()}
+    for daughter in relation.daughters:
+        if is_forward(daughter):
+            # the foreign key for select or prefetch the related object
+            columns.add(daughter._field_name)
+    return columns
+
+def build_prefetch(relation: Relation) -> Prefetch:
+    columns = get_relation_columns(relation)
+    model_field = relation._model_field
+    if isinstance(model_field, ManyToOneRel):
+        # the related objects are matched with their parents by the foreign key
+        columns.add(model_field.field.name)
+    queryset = relation.to_m._default_manager.only(*columns)
+    return Prefetch(str(relation), queryset=queryset)
+
+def build_projection(
+    model: type[Model],
+    local_fields,
+    relations: RelationManager | None,
+    extra_fields = (),
+) -> tuple[list[str], list[Prefetch]]:
+    """
+    Returns the `.only()` fields of the main query and the `Prefetch` objects of the to many relations.
+    """
+    only_fields = {model._meta.pk.name, *(field.name for field in local_fields), *extra_fields}
+    prefetches = []
+    for relation in relations or ():
+        if relation in relations.prefetching_relations:
+            prefetches.append(build_prefetch(relation))
+            continue
+        if relation.parent is None:
+            if is_forward(relation):
+                only_fields.add(relation._field_name)
+            continue
+        # a to one relation selected through its parents
+        only_fields.add(str(relation))
+    for relation in relations.selecting_relations if relations else ():
+        only_fields |= {
+            '%s__%s'%(relation, column) for column in get_relation_columns(relation)
+        }
+    # the prefetches of the outer relations are done before
+    prefetches.sort(key=lambda prefetch: prefetch.prefetch_through.count('__'))
+    return sorted(only_fields), prefetches
+
+__all__ = ['build_projection']
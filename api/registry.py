@@ -0,0 +1,72 @@
+from weakref import WeakSet
+
+from api import projection
+
+"""
+Goal:
+    Every concrete subclass of BaseREST (with `model` and `fields`) is registered
+    when it's defined. In `AppConfig.ready` the field plans of the registered views
+    are compiled once, and the system checks report the invalid declarations.
+"""
+
+_views = WeakSet()
+
+def register(view_class):
+    _views.add(view_class)
+    return view_class
+
+def get_label(view_class) -> str:
+    return '%s.%s'%(view_class.__module__, view_class.__qualname__)
+
+def get_registered_views() -> list:
+    return sorted(_views, key=get_label)
+
+def compile_views() -> dict:
+    """
+    Compiles the field plan of all the registered views.
+    Returns the errors found by view.
+    """
+    errors = {}
+    for view_class in get_registered_views():
+        try:
+            view_class.compile_fields()
+        except Exception as exp:
+            errors[view_class] = exp
+    return errors
+
+def describe_view(view_class) -> dict:
+    """
+    The compiled field plan of a view, in a serializable way.
+    """
+    plan = view_class.compile_fields()
+    # the lookups of the reads, as `build_query_relations` builds them
+    _, prefetches = projection.build_projection(view_class.model, plan['local_fields'], plan['relations'])
+    relations = []
+    if plan['relations']:
+        relations = sorted(
+            '%s (%s): %s'%(
+                relation,
+                relation.type,
+                sorted(field.name for field in relation.relation_fields or ())
+            )
+            for relation in plan['relations']
+        )
+    return {
+        'view': get_label(view_class),
+        'model': view_class.model._meta.label,
+        'fields': sorted(field.name for field in plan['local_fields']),
+        'annotations': sorted(field.name for field in plan['annotated_fields']),
+        'relations': relations,
+        'select_related': sorted(plan['related_selections']),
+        'prefetch_related': sorted(prefetch.prefetch_to for prefetch in prefetches),
+        # the main query, with the annotations as subqueries, and one by each `Prefetch` (a level of a relation)
+        'queries': 1 + len(prefetches),
+    }
+
+__all__ = [
+    'register',
+    'get_label',
+    'get_registered_views',
+    'compile_views',
+    'describe_view',
+]
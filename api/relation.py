@@ -1,6 +1,5 @@
 from asyncio.tasks import gather
 from typing import Literal, Self, Union
-from asgiref.sync import sync_to_async
 from django.db.models import Model, ForeignKey, ObjectDoesNotExist, OneToOneField, ManyToManyField
 from django.db.models.fields.reverse_related import OneToOneRel, ManyToOneRel, ManyToManyRel, ForeignObjectRel
 from django.db.models.fields.related_descriptors import (
@@ -11,6 +10,7 @@ from django.db.models.fields.related_descriptors import (
     ManyToManyDescriptor,
 )
 from api import exceptions, local
+from api.executor import db_sync_to_async
 
 forward_descriptors= (ForwardOneToOneDescriptor,ForwardManyToOneDescriptor)
 reverse_descriptors= (ReverseOneToOneDescriptor,ReverseManyToOneDescriptor)
@@ -150,7 +150,7 @@ class Relation:
 
     async def get_relation_data(self, model_instance):
         try:
-            manager = await sync_to_async(getattr)(model_instance, self._field_name)
+            manager = await db_sync_to_async(getattr)(model_instance, self._field_name)
         except ObjectDoesNotExist:
             return {self._field_name: None}
 
@@ -158,7 +158,7 @@ class Relation:
         if getattr(self._model_field, O2M, False) or \
             getattr(self._model_field, M2M, False): # if my native field is to many
             parsed_object = []
-            items = await sync_to_async(list)(manager.all()) # recovery all items
+            items = await db_sync_to_async(list)(manager.all()) # recovery all items
             for item in items: # for each item..
                 parsed_data = self.parse_instance_data(item) # parse local info
                 relations = await self.__get_daughter_relations_data(item)
@@ -227,23 +227,16 @@ class RelationManager:
             return []
 
     def __iter__(self):
+        # a new iterator each time, the manager is shared by concurrent requests
         if getattr(self, '_rel_vector', None) is None:
-            self._rel_vector: set[Relation] = set()
+            rel_vector: set[Relation] = set()
             for relation_type in self._relations.values():
-                self._rel_vector |= relation_type
-        self._iter = iter(self._rel_vector)
-        return self
-
-    def __next__(self):
-        if self._iter is None:
-            raise StopIteration()
-        try:
-            return next(self._iter)
-        except StopIteration:
-            self._iter = None
-            raise
+                rel_vector |= relation_type
+            self._rel_vector = rel_vector
+        return iter(self._rel_vector)
 
     def add(self,relation: Relation):
+        self._rel_vector = None
         try:
             self._relations[relation.type].add(relation)
         except KeyError:
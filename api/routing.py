@@ -0,0 +1,45 @@
+import math
+import time
+from django.http import HttpRequest, HttpResponse
+
+"""
+Goal:
+    After a write, the reads of the same client are pinned to the primary
+    database for a window of seconds, so the client reads its own writes
+    although the replicas lag.
+
+    The pin is the timestamp until the reads are pinned. It's sent in a cookie,
+    and in a response header that the clients without cookies can send back.
+"""
+
+def get_pinned_until(request: HttpRequest, cookie_name: str, header_name: str, window: int | float) -> float:
+    """
+    The pin of the request, 0 without pin. The pin comes from the client, so the pins after
+    the window from now (forged, or of other clock) are invalid: a client can't pin itself forever.
+    """
+    value = request.headers.get(header_name) or request.COOKIES.get(cookie_name)
+    if not value:
+        return 0
+    try:
+        pinned_until = float(value)
+    except ValueError:
+        return 0
+    if pinned_until > time.time() + window:
+        return 0
+    return pinned_until
+
+def is_pinned_to_primary(request: HttpRequest, cookie_name: str, header_name: str, window: int | float) -> bool:
+    return get_pinned_until(request, cookie_name, header_name, window) > time.time()
+
+def pin_to_primary(response: HttpResponse, window: int | float, cookie_name: str, header_name: str):
+    # rounded down, to keep the pin within the window of `get_pinned_until`
+    pinned_until = '%.3f'%(math.floor((time.time() + window)*1000)/1000)
+    response.set_cookie(cookie_name, pinned_until, max_age=window, httponly=True, samesite='Lax')
+    response[header_name] = pinned_until
+    return response
+
+__all__ = [
+    'get_pinned_until',
+    'is_pinned_to_primary',
+    'pin_to_primary',
+]
@@ -0,0 +1,206 @@
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db.models import Model, Q, QuerySet, Value
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+"""
+Goal:
+    /my/url/path/?search=free text&filterBy=city[exact]3
+
+    The objects that match the text in the `search_fields` of the view, ranked
+    by the database (`search_rank`, the best first). The search is done by a
+    backend according to the database:
+
+    - PostgreSQL: `tsvector`/`tsquery`, backed by a GIN index on the same vector.
+    - SQLite: a FTS5 shadow table, kept in sync with the model table by triggers.
+    - Others: `icontains` in the fields, without ranking.
+
+    The requests never run DDL: the shadow tables are created in the write
+    database by the `darc_search_tables` command.
+"""
+
+SEARCH_RANK = 'search_rank'
+
+
+class BaseSearchBackend:
+
+    def setup(self, model: type[Model], fields: tuple[str, ...], using: str, recreate: bool = False):
+        """
+        Creates the database objects that the search of `fields` requires, by the `darc_search_tables`
+        command in the write database, never in the requests. Must be called in a synchronous context.
+        """
+        return
+
+    def search(self, queryset: QuerySet, fields: tuple[str, ...], text: str, config: str | None = None) -> QuerySet:
+        """
+        The objects of the queryset that match `text`, annotated with `search_rank` (greater is better)
+        and ordered by it. Must be called in a synchronous context.
+        """
+        raise NotImplementedError
+    pass
+
+
+class ContainsSearchBackend(BaseSearchBackend):
+
+    def search(self, queryset, fields, text, config=None):
+        terms = text.split()
+        if not terms:
+            return queryset.none()
+        for term in terms:
+            queryset = queryset.filter(reduce(or_, (
+                Q(**{'%s__icontains'%field: term}) for field in fields
+            )))
+        return queryset.annotate(**{SEARCH_RANK: Value(1.0)})
+    pass
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    For use the index, the migrations of the model must add a `GinIndex` with the same vector:
+    `GinIndex(SearchVector('name', 'bio', config='english'), name='player_search')`.
+    """
+
+    def search(self, queryset, fields, text, config=None):
+        # psycopg is only required with this backend
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+        vector = SearchVector(*fields, config=config)
+        query = SearchQuery(text, config=config, search_type='websearch')
+        return queryset.\
+            alias(_search_vector=vector).\
+            filter(_search_vector=query).\
+            annotate(**{SEARCH_RANK: SearchRank(vector, query)}).\
+            order_by('-%s'%SEARCH_RANK)
+    pass
+
+
+class SQLiteFTS5Backend(BaseSearchBackend):
+    """
+    The shadow table `<model table>_fts` is created by the `darc_search_tables` command, with the triggers
+    that keep it in sync with the model table (writes of the views, `bulk_create`, `update()` and raw SQL included).
+    The model must have an integer primary key. When the `search_fields` change, the shadow table
+    must be created again with `darc_search_tables --recreate`.
+    """
+
+    def __init__(self) -> None:
+        # the tables found by alias, the searches don't look for them again
+        self._tables: set[tuple[str, str]] = set()
+        return
+
+    def get_table_name(self, model: type[Model]) -> str:
+        return '%s_fts'%model._meta.db_table
+
+    def has_table(self, table: str, using: str) -> bool:
+        if (using, table) in self._tables:
+            return True
+        with connections[using].cursor() as cursor:
+            cursor.execute('SELECT 1 FROM sqlite_master WHERE type = %s AND name = %s', ['table', table])
+            if not cursor.fetchone():
+                return False
+        self._tables.add((using, table))
+        return True
+
+    def setup(self, model, fields, using, recreate=False):
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        table = self.get_table_name(model)
+        columns = [qn(model._meta.get_field(field).column) for field in fields]
+        new_values = ', '.join('new.%s'%column for column in columns)
+        old_values = ', '.join('old.%s'%column for column in columns)
+        pk = qn(model._meta.pk.column)
+        statements = []
+        if recreate:
+            statements += ['DROP TRIGGER IF EXISTS %s'%qn('%s_%s'%(table, suffix)) for suffix in ('ai', 'ad', 'au')]
+            statements.append('DROP TABLE IF EXISTS %s'%qn(table))
+            self._tables.discard((using, table))
+        elif self.has_table(table, using):
+            return
+        statements += [
+            'CREATE VIRTUAL TABLE %s USING fts5(%s, content=%s, content_rowid=%s)'%(
+                qn(table), ', '.join(columns), qn(model._meta.db_table), pk
+            ),
+            'CREATE TRIGGER %s AFTER INSERT ON %s BEGIN '
+            'INSERT INTO %s(rowid, %s) VALUES (new.%s, %s); END'%(
+                qn('%s_ai'%table), qn(model._meta.db_table),
+                qn(table), ', '.join(columns), pk, new_values
+            ),
+            'CREATE TRIGGER %s AFTER DELETE ON %s BEGIN '
+            'INSERT INTO %s(%s, rowid, %s) VALUES (\'delete\', old.%s, %s); END'%(
+                qn('%s_ad'%table), qn(model._meta.db_table),
+                qn(table), qn(table), ', '.join(columns), pk, old_values
+            ),
+            'CREATE TRIGGER %s AFTER UPDATE ON %s BEGIN '
+            'INSERT INTO %s(%s, rowid, %s) VALUES (\'delete\', old.%s, %s); '
+            'INSERT INTO %s(rowid, %s) VALUES (new.%s, %s); END'%(
+                qn('%s_au'%table), qn(model._meta.db_table),
+                qn(table), qn(table), ', '.join(columns), pk, old_values,
+                qn(table), ', '.join(columns), pk, new_values
+            ),
+            # the existing rows
+            'INSERT INTO %s(%s) VALUES (\'rebuild\')'%(qn(table), qn(table)),
+        ]
+        # without savepoints, SQLite can't roll back the creation of a virtual table to a savepoint
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+        return
+
+    def build_match(self, text: str) -> str:
+        """
+        The terms of the text as FTS5 strings, so its syntax can't be injected.
+        """
+        return ' '.join('"%s"'%term.replace('"', '""') for term in text.split())
+
+    def search(self, queryset, fields, text, config=None):
+        if not (match := self.build_match(text)):
+            return queryset.none()
+        model = queryset.model
+        if not self.has_table(self.get_table_name(model), queryset.db):
+            raise ImproperlyConfigured(
+                'The search table of %s doesn\'t exist, run the darc_search_tables command'%model._meta.label
+            )
+        qn = connections[queryset.db].ops.quote_name
+        table = qn(self.get_table_name(model))
+        # the rank of FTS5 (bm25) is lower for the best matches
+        rank = RawSQL(
+            '(SELECT -rank FROM %s WHERE %s MATCH %%s AND %s.rowid = %s.%s)'%(
+                table, table, table, qn(model._meta.db_table), qn(model._meta.pk.column)
+            ),
+            (match,)
+        )
+        matches = RawSQL('SELECT rowid FROM %s WHERE %s MATCH %%s'%(table, table), (match,))
+        return queryset.\
+            filter(pk__in=matches).\
+            annotate(**{SEARCH_RANK: rank}).\
+            order_by('-%s'%SEARCH_RANK)
+    pass
+
+
+VENDOR_BACKENDS = {
+    'postgresql': 'api.search.PostgresSearchBackend',
+    'sqlite': 'api.search.SQLiteFTS5Backend',
+}
+_backends: dict[str, BaseSearchBackend] = {}
+
+def get_search_backend(using: str, backend_path: str | None = None) -> BaseSearchBackend:
+    """
+    The backend of `backend_path`, or of the `DARC_SEARCH_BACKEND` setting, or the one for the database vendor.
+    """
+    backend_path = backend_path or getattr(settings, 'DARC_SEARCH_BACKEND', None) or \
+        VENDOR_BACKENDS.get(connections[using].vendor, 'api.search.ContainsSearchBackend')
+    if backend_path not in _backends:
+        _backends[backend_path] = import_string(backend_path)()
+    return _backends[backend_path]
+
+__all__ = [
+    'SEARCH_RANK',
+    'BaseSearchBackend',
+    'ContainsSearchBackend',
+    'PostgresSearchBackend',
+    'SQLiteFTS5Backend',
+    'get_search_backend',
+]
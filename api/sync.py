@@ -0,0 +1,276 @@
+import base64
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import DateTimeField, Model, Q
+from django.db.models.signals import post_delete
+from django.utils import timezone
+
+from api import exceptions
+
+"""
+Goal:
+    /my/url/path/?since=<token>
+
+    Returns the objects created or changed after the token (by the `sync_field`
+    of the view, a timestamp or a sequence), the identifiers of the objects deleted
+    after it (the tombstones), and the token for the next synchronization.
+    An empty token returns all the objects.
+
+    The values of the `sync_field` are taken before the commit, so a transaction can commit
+    a value older than the token. The objects of an overlap window before the token are
+    fetched again, and the ones the token has already sent are skipped. The same for the
+    tombstones, whose identifiers are taken before the commit too: the ones deleted in the
+    window before the token was issued are fetched again.
+"""
+
+DEFAULT_DATETIME_OVERLAP = timedelta(seconds=5)
+
+_bulk_deletions = threading.local()
+_tracked_models: set[type[Model]] = set()
+
+
+def _encode_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+class SyncToken:
+
+    def __init__(
+        self,
+        marker=None,
+        tombstone: int = 0,
+        full = False,
+        seen: set[tuple] = frozenset(),
+        issued: float | None = None,
+        seen_tombstones: set[int] = frozenset(),
+    ) -> None:
+        self.marker = marker
+        self.tombstone = tombstone
+        # without token, a full synchronization
+        self.full = full
+        # the (pk, value) of the objects already sent in the overlap window
+        self.seen = seen
+        # the tombstones of the overlap window already sent
+        self.seen_tombstones = seen_tombstones
+        self.issued = time.time() if issued is None and not full else issued
+        return
+
+    @classmethod
+    def decode(cls, token: str, sync_field) -> 'SyncToken':
+        if not token:
+            return cls(full=True)
+        try:
+            marker, tombstone, *rest = json.loads(base64.urlsafe_b64decode(token.encode()))
+            if marker is not None:
+                marker = sync_field.to_python(marker)
+            seen, issued, seen_tombstones = (rest + [[], 0, []][len(rest):])[:3]
+            return cls(
+                marker,
+                int(tombstone),
+                seen={(str(pk), sync_field.to_python(value)) for pk, value in seen},
+                # the tokens without issue time are as old as the oldest tombstone
+                issued=float(issued),
+                seen_tombstones={int(tombstone_id) for tombstone_id in seen_tombstones},
+            )
+        except (ValueError, TypeError, exceptions.ValidationError):
+            raise exceptions.InvalidSyncToken(token)
+
+    def encode(self) -> str:
+        return base64.urlsafe_b64encode(json.dumps([
+            _encode_value(self.marker),
+            self.tombstone,
+            sorted([pk, _encode_value(value)] for pk, value in self.seen),
+            int(self.issued),
+            sorted(self.seen_tombstones),
+        ]).encode()).decode()
+
+    def is_expired(self, retention: float | None = None) -> bool:
+        """
+        If the tombstones after the token can be pruned (see `DARC_TOMBSTONE_RETENTION`).
+        """
+        if retention is None:
+            retention = get_tombstone_retention()
+        return not self.full and retention is not None and self.issued < time.time() - retention
+    pass
+
+
+def get_tombstone_retention() -> float | None:
+    """
+    The seconds that the tombstones are kept, `None` for keep them forever.
+    """
+    retention = getattr(settings, 'DARC_TOMBSTONE_RETENTION', None)
+    if isinstance(retention, timedelta):
+        return retention.total_seconds()
+    return retention
+
+def resolve_overlap(sync_field, overlap=None):
+    """
+    The overlap window of the view, by default some seconds for the timestamps and none for the sequences.
+    """
+    if overlap is not None:
+        return overlap
+    return DEFAULT_DATETIME_OVERLAP if isinstance(sync_field, DateTimeField) else None
+
+def window_start(marker, overlap):
+    return marker - overlap if overlap else marker
+
+
+@contextmanager
+def bulk_deletion():
+    """
+    The tombstones of the deletions in the block, the cascaded ones too, are collected
+    from the `post_delete` signal and recorded with one insert by model at the end.
+    """
+    if getattr(_bulk_deletions, 'pending', None) is not None:
+        # recorded by the outer block
+        yield
+        return
+    pending = _bulk_deletions.pending = {}
+    try:
+        yield
+        for (model, using), pks in pending.items():
+            record_deletions(model, pks, using)
+    finally:
+        _bulk_deletions.pending = None
+
+def record_deletions(model: type[Model], pks, using=None):
+    from api.models import Tombstone
+    if not pks:
+        return
+    Tombstone.objects.using(using).bulk_create([
+        Tombstone(model_label=model._meta.label_lower, object_pk=str(pk))
+        for pk in pks
+    ])
+    return
+
+def _record_deletion(sender, instance, using, **kwargs):
+    pending = getattr(_bulk_deletions, 'pending', None)
+    if pending is not None:
+        pending.setdefault((sender, using), []).append(instance.pk)
+        return
+    record_deletions(sender, [instance.pk], using)
+
+def track_deletions(model: type[Model]):
+    """
+    Records a tombstone for each deleted object of `model`.
+    """
+    post_delete.connect(
+        _record_deletion,
+        sender=model,
+        weak=False,
+        dispatch_uid='darc_tombstone_%s'%model._meta.label_lower
+    )
+    _tracked_models.add(model)
+    return
+
+def is_tracked(model: type[Model]) -> bool:
+    return model in _tracked_models
+
+def prune_tombstones(retention: float, using=None) -> int:
+    """
+    Deletes the tombstones older than `retention` seconds. Returns the number of deleted tombstones.
+    """
+    from api.models import Tombstone
+    deleted, _ = Tombstone.objects.using(using).filter(
+        deleted_at__lt=timezone.now() - timedelta(seconds=retention)
+    ).delete()
+    return deleted
+
+def fetch_changes(queryset, sync_field: str, token: SyncToken, overlap=None, limit: int | None = None) -> list:
+    """
+    The objects changed after the token, by `sync_field` and primary key. The objects of the `overlap`
+    window before the token are fetched again, without the already sent ones. With `limit`, at most
+    `limit` objects and one more, that tells the changes continue. Must be called in a synchronous context.
+    """
+    if token.marker is not None:
+        queryset = queryset.filter(**{'%s__gte'%sync_field: window_start(token.marker, overlap)})
+    queryset = queryset.order_by(sync_field, 'pk')
+    if limit is not None:
+        # the objects already sent are skipped after the fetch
+        queryset = queryset[:limit + 1 + len(token.seen)]
+    objects = [
+        instance for instance in queryset
+        if (str(instance.pk), getattr(instance, sync_field)) not in token.seen
+    ]
+    return objects if limit is None else objects[:limit + 1]
+
+def fetch_deletions(
+    model: type[Model],
+    token: SyncToken,
+    using=None,
+    overlap: timedelta | None = None,
+) -> tuple[list, int, set[int]]:
+    """
+    The identifiers of the objects deleted after the token, the last tombstone and the tombstones
+    of the `overlap` window (by default 5 seconds) that the next token skips. The tombstones deleted
+    in the window before the token was issued are fetched again, without the already sent ones.
+    Must be called in a synchronous context.
+    """
+    from api.models import Tombstone
+    overlap = resolve_overlap(Tombstone._meta.get_field('deleted_at'), overlap)
+    now = timezone.now()
+    tombstones = Tombstone.objects.using(using).filter(model_label=model._meta.label_lower)
+    if token.full:
+        # a full synchronization doesn't need the previous deletions
+        recent = list(tombstones.filter(deleted_at__gte=now - overlap).values_list('id', flat=True))
+        last = tombstones.order_by('-id').values_list('id', flat=True).first() or 0
+        return [], last, set(recent)
+    issued = datetime.fromtimestamp(token.issued, dt_timezone.utc)
+    deleted = []
+    next_tombstone = token.tombstone
+    seen = set()
+    pk_field = model._meta.pk
+    for tombstone_id, object_pk, deleted_at in tombstones.filter(
+        Q(id__gt=token.tombstone) | Q(deleted_at__gte=issued - overlap)
+    ).order_by('id').values_list('id', 'object_pk', 'deleted_at'):
+        if tombstone_id not in token.seen_tombstones:
+            deleted.append(pk_field.to_python(object_pk))
+        next_tombstone = max(next_tombstone, tombstone_id)
+        if deleted_at >= now - overlap:
+            # the next token is issued now
+            seen.add(tombstone_id)
+    return deleted, next_tombstone, seen
+
+def next_token(
+    token: SyncToken,
+    objects: list,
+    sync_field: str,
+    tombstone: int,
+    overlap=None,
+    seen_tombstones: set[int] = frozenset(),
+) -> SyncToken:
+    """
+    The token after the sent `objects`, the changes continue from the last one.
+    `seen_tombstones` are the tombstones of the window of `fetch_deletions`.
+    """
+    next_marker = token.marker
+    if objects and (next_marker is None or getattr(objects[-1], sync_field) > next_marker):
+        next_marker = getattr(objects[-1], sync_field)
+    seen = set()
+    if next_marker is not None:
+        # the sent objects that the next window fetches again
+        start = window_start(next_marker, overlap)
+        seen = {
+            key for key in token.seen | {(str(instance.pk), getattr(instance, sync_field)) for instance in objects}
+            if key[1] >= start
+        }
+    return SyncToken(next_marker, tombstone, seen=seen, seen_tombstones=seen_tombstones)
+
+__all__ = [
+    'SyncToken',
+    'bulk_deletion',
+    'record_deletions',
+    'track_deletions',
+    'is_tracked',
+    'get_tombstone_retention',
+    'resolve_overlap',
+    'prune_tombstones',
+    'fetch_changes',
+    'fetch_deletions',
+    'next_token',
+]
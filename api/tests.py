@@ -1,17 +1,139 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+from unittest import skipUnless
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.test import Client, TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, connections, models
+from django.db.models import Value
+from django.db.models.functions import Cast, Concat, Length, Upper
+from django.urls import re_path
+from django.http import HttpResponse, JsonResponse
 from django.apps import apps
-from django.contrib.auth.models import Group, Permission
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.utils import timezone
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import Group, Permission, User
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.contrib.contenttypes.models import ContentType
 
-from asgiref.sync import sync_to_async
+from asgiref.sync import async_to_sync, sync_to_async
 
 from api.relation import Relation
 from api.local import LocalField
 from api.base_rest import BaseREST
 from api.filtersets import Filter, FilterURLBuilder
+from api.executor import DatabaseExecutor
+from api.unit_of_work import UnitOfWork
+from api import admission, checks, events, exceptions, exports, metrics, profiling, registry, routing, search, sync, versioning
+from api.admission import AdmissionController
+from api.coalescing import SingleFlight
+from api.base_views import BaseRESTView
+from api.models import Tombstone
+from api.events import BaseEventBroker, ChangeEvent, InProcessEventBroker
+from api.batch import BatchView
+from api.exports import ExportJob, export_manager
+from api.views import metrics_exposition
+
+
+class GroupREST(BaseRESTView):
+    model = Group
+    fields = {'id', 'name'}
+    pass
+
+class VersionedNote(models.Model):
+    title = models.CharField(max_length=50)
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    group = models.ForeignKey(Group, null=True, on_delete=models.DO_NOTHING, related_name='notes')
+    parent = models.ForeignKey('self', null=True, on_delete=models.CASCADE, related_name='replies')
+
+    class Meta:
+        app_label = 'api'
+    pass
+
+class VersionedNoteDetail(models.Model):
+    # without table, the deletions of the notes don't cascade to it
+    note = models.OneToOneField(VersionedNote, on_delete=models.DO_NOTHING)
+
+    class Meta:
+        app_label = 'api'
+    pass
+
+async def batch_echo(request):
+    """
+    An operation of the batches: responds the headers of its request, with a cookie.
+    """
+    if request.GET.get('fail'):
+        raise ValueError('The operation failed')
+    response = JsonResponse({
+        'content_type': request.META.get('CONTENT_TYPE'),
+        'if_match': request.headers.get('If-Match'),
+    })
+    response['X-Operation'] = 'echo'
+    response.set_cookie('batch_echo', '1')
+    return response
+
+urlpatterns = [
+    re_path(r'^groups(?:(/(?P<id>\d+))?)/$', GroupREST.as_view()),
+    re_path(r'^replica/groups(?:(/(?P<id>\d+))?)/$', GroupREST.as_view(write_using='replica')),
+    re_path(r'^echo/$', batch_echo),
+    re_path(r'^batch/$', BatchView.as_view()),
+]
+
+# the sessions in the cookies, without the sessions app
+signed_cookie_sessions = override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
 
+def get_session_cookie(user: User) -> str:
+    """
+    The session cookie of `user` logged in. Must be called in a synchronous context.
+    """
+    client = Client()
+    client.force_login(user)
+    return client.cookies[settings.SESSION_COOKIE_NAME].value
+
+def authenticate(request, session_cookie: str):
+    """
+    The request through the session and authentication middlewares, as served by Django:
+    `request.user` is lazy and loads the user from the database.
+    """
+    request.COOKIES[settings.SESSION_COOKIE_NAME] = session_cookie
+    SessionMiddleware(lambda request: None).process_request(request)
+    AuthenticationMiddleware(lambda request: None).process_request(request)
+    return request
 
 # Create your tests here.
 
+class VersionedNoteTestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # the model of the tests hasn't migration
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(VersionedNote)
+        cls.addClassCleanup(cls.drop_model)
+        super().setUpClass()
+        return
+
+    @classmethod
+    def drop_model(cls):
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(VersionedNote)
+        return
+    pass
+
 class RestApiTest(TestCase):
 
     def setUp(self) -> None:
@@ -110,3 +232,1790 @@ class TestFilterSetPermissions(TestCase):
         assert len(objects) <= 4
         return
     pass
+
+class TestDatabaseExecutor(TestCase):
+
+    async def test_disabled_executor_is_thread_sensitive(self):
+        executor = DatabaseExecutor()
+        assert not executor.enabled
+        assert await executor.wrap(lambda a, b: a + b)(1, 2) == 3
+        assert await executor.acquire_lane() is None
+        return
+
+    async def test_pinned_lane_runs_in_one_thread(self):
+        executor = DatabaseExecutor(2)
+        thread_name = lambda: threading.current_thread().name
+        assert (await executor.wrap(thread_name)()).startswith('darc-db')
+        token = await executor.acquire_lane()
+        try:
+            names = {await executor.wrap(thread_name)() for _ in range(5)}
+            assert len(names) == 1
+            assert names.pop().startswith('darc-db-lane')
+            # nested blocks keep the same lane
+            assert await executor.acquire_lane() is None
+        finally:
+            executor.release_lane(token)
+        executor.shutdown()
+        return
+
+    async def test_lane_is_resolved_when_awaited(self):
+        executor = DatabaseExecutor(4)
+        # the lanes are counted in the workers
+        assert (executor.pool_size, executor.max_lanes) == (2, 2)
+        thread_name = executor.wrap(lambda: threading.current_thread().name)
+        token = await executor.acquire_lane()
+        try:
+            assert (await thread_name()).startswith('darc-db-lane')
+        finally:
+            executor.release_lane(token)
+        assert not (await thread_name()).startswith('darc-db-lane')
+        executor.shutdown()
+        return
+    pass
+
+class TestUnitOfWork(TestCase):
+
+    async def test_operations_order_in_one_call(self):
+        unit_of_work = UnitOfWork()
+        calls = []
+        unit_of_work.defer(calls.append, 'deferred')
+        unit_of_work.add(calls.append, 'first')
+        unit_of_work.add(lambda: unit_of_work.add(calls.append, 'added'))
+        await unit_of_work.commit()
+        assert calls == ['first', 'added', 'deferred']
+        return
+
+    async def test_rollback_on_error(self):
+        unit_of_work = UnitOfWork()
+        unit_of_work.add(Group.objects.create, name='group_in_unit')
+        unit_of_work.add(Group.objects.get, name='not existing group')
+        with self.assertRaises(Group.DoesNotExist):
+            await unit_of_work.commit()
+        assert not await Group.objects.filter(name='group_in_unit').aexists()
+        return
+    pass
+
+class TestReadReplicaRouting(TestCase):
+
+    def setUp(self) -> None:
+        class GroupRest(BaseREST):
+            model = Group
+            fields = {'id', 'name'}
+            read_using = 'replica'
+            read_your_writes_window = 5
+            pass
+        self.group_rest = GroupRest()
+        self.factory = RequestFactory()
+        return
+
+    def test_reads_from_replica(self):
+        self.group_rest.request = self.factory.get('/')
+        assert self.group_rest.get_read_using() == 'replica'
+        assert self.group_rest.get_read_queryset().db == 'replica'
+        assert self.group_rest.get_write_queryset().db == 'default'
+        return
+
+    def test_reads_pinned_after_write(self):
+        GroupRest = type(self.group_rest)
+        response = routing.pin_to_primary(
+            HttpResponse(), 5, GroupRest.primary_pin_cookie, GroupRest.primary_pin_header
+        )
+        request = self.factory.get('/')
+        request.COOKIES[GroupRest.primary_pin_cookie] = response.cookies[GroupRest.primary_pin_cookie].value
+        self.group_rest.request = request
+        assert self.group_rest.get_read_using() == 'default'
+        expired = self.factory.get('/', headers={GroupRest.primary_pin_header: '1'})
+        self.group_rest.request = expired
+        assert self.group_rest.get_read_using() == 'replica'
+        # the pins after the window are invalid
+        for forged in ('%.3f'%(time.time() + 3600), 'inf'):
+            self.group_rest.request = self.factory.get('/', headers={GroupRest.primary_pin_header: forged})
+            assert self.group_rest.get_read_using() == 'replica'
+        return
+    pass
+
+@skipUnless('replica' in settings.DATABASES, 'requires a `replica` alias, e.g. with `TEST: {"MIRROR": "default"}`')
+class TestReplicaDatabases(TransactionTestCase):
+    # the mirror reads the writes of `default` only out of the transactions of `TestCase`,
+    # and the runner sets up the databases of the skipped tests too
+    databases = {'default', 'replica'} if 'replica' in settings.DATABASES else {'default'}
+
+    def setUp(self) -> None:
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name'}
+            read_using = 'replica'
+            read_your_writes_window = 5
+            pass
+        self.view = GroupView.as_view()
+        return
+
+    def request(self, request) -> tuple[HttpResponse, int, int]:
+        """
+        The response, and the statements executed in `default` and in `replica`.
+        """
+        with CaptureQueriesContext(connections['default']) as primary, \
+            CaptureQueriesContext(connections['replica']) as replica:
+            response = async_to_sync(self.view)(request)
+        return response, len(primary), len(replica)
+
+    def test_reads_and_writes_are_routed(self):
+        response, primary, replica = self.request(RequestFactory().post(
+            '/', data={'name': 'routed'}, content_type='application/json'
+        ))
+        assert response.status_code == 200 and primary and not replica
+        pin = response.cookies[GroupREST.primary_pin_cookie].value
+        # the client reads its own write from the primary
+        request = RequestFactory().get('/')
+        request.COOKIES[GroupREST.primary_pin_cookie] = pin
+        response, primary, replica = self.request(request)
+        assert [obj['name'] for obj in json.loads(response.content)] == ['routed']
+        assert primary and not replica
+        # the other clients read from the replica
+        response, primary, replica = self.request(RequestFactory().get('/'))
+        assert [obj['name'] for obj in json.loads(response.content)] == ['routed']
+        assert replica and not primary
+        return
+    pass
+
+class TestViewRegistry(TestCase):
+
+    def test_views_compiled_once(self):
+        class GroupRest(BaseREST):
+            model = Group
+            fields = {'id', 'name', ('permissions', ('id',))}
+            pass
+        assert GroupRest in registry.get_registered_views()
+        plan = GroupRest.compile_fields()
+        assert GroupRest().relations is plan['relations']
+        assert registry.describe_view(GroupRest)['queries'] == 2
+        return
+
+    def test_expected_queries(self):
+        group = Group.objects.create(name='described')
+        group.permissions.set(Permission.objects.order_by('pk')[:2])
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name', ('permissions', '__count__'), ('permissions', ('id', ('content_type', ('model',))))}
+            pass
+        queries = registry.describe_view(GroupView)['queries']
+        with CaptureQueriesContext(connection) as context:
+            async_to_sync(GroupView.as_view())(RequestFactory().get('/', {'filterBy': 'name[exact]described'}))
+        assert queries == len(context.captured_queries)
+        return
+
+    def test_invalid_fields_reported_by_checks(self):
+        class GroupRest(BaseREST):
+            model = Group
+            fields = {'id', 'unknown_field'}
+            pass
+        errors = [
+            error for error in checks.check_rest_views()
+            if error.obj is GroupRest
+        ]
+        assert len(errors) == 1 and errors[0].id == 'darc.E002'
+        return
+    pass
+
+class TestAdmissionControl(TestCase):
+
+    async def test_reject_after_queue_timeout(self):
+        controller = AdmissionController('test_admission', 1, 0.01)
+        async with controller.admit():
+            with self.assertRaises(exceptions.QueueTimeout):
+                async with controller.admit():
+                    pass
+        async with controller.admit():
+            pass
+        stats = admission.get_stats()['test_admission']
+        assert stats['admitted'] == 2 and stats['rejected'] == 1
+        assert stats['in_flight'] == 0 and stats['max_queue_depth'] == 1
+        return
+
+    async def test_dispatch_responds_503(self):
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name'}
+            max_concurrency = 1
+            queue_timeout = 0.01
+            retry_after = 3
+            pass
+        async with GroupView.get_admission_controller().admit():
+            response = await GroupView.as_view()(RequestFactory().get('/'))
+        assert response.status_code == 503
+        assert response['Retry-After'] == '3'
+        response = await GroupView.as_view()(RequestFactory().get('/'))
+        assert response.status_code == 200
+        return
+    pass
+
+class TestRequestCoalescing(TestCase):
+
+    async def test_concurrent_calls_share_one_flight(self):
+        flight = SingleFlight()
+        calls = []
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return b'payload'
+        results = await asyncio.gather(*[flight.do(('key',), compute) for _ in range(5)])
+        assert results == [b'payload'] * 5
+        assert len(calls) == 1 and flight.shared == 4
+        assert not len(flight)
+        await flight.do(('key',), compute)
+        assert len(calls) == 2
+        return
+
+    async def test_coalescing_key_is_normalized(self):
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name'}
+            coalesce_requests = True
+            pass
+        view = GroupView()
+        key_a = await view.get_coalescing_key(RequestFactory().get('/?a=1&b=2'), None)
+        key_b = await view.get_coalescing_key(RequestFactory().get('/?b=2&a=1'), None)
+        assert key_a == key_b
+        # the JSON and the columnar responses aren't shared
+        key_columns = await view.get_coalescing_key(RequestFactory().get(
+            '/?a=1&b=2', headers={'Accept': 'application/vnd.darc.columns+json'}
+        ), None)
+        assert key_columns != key_a
+        await Group.objects.acreate(name='coalesced')
+        response = await GroupView.as_view()(RequestFactory().get('/'))
+        assert response.status_code == 200
+        assert json.loads(response.content)[0]['name'] == 'coalesced'
+        return
+
+    @signed_cookie_sessions
+    def test_authenticated_requests(self):
+        user = User.objects.create_user('coalesced_user')
+        session_cookie = get_session_cookie(user)
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name'}
+            coalesce_requests = True
+            pass
+        view = GroupView()
+        request = authenticate(RequestFactory().get('/'), session_cookie)
+        key = async_to_sync(view.get_coalescing_key)(request, None)
+        assert key[-1] == user.pk
+        response = async_to_sync(GroupView.as_view())(authenticate(RequestFactory().get('/'), session_cookie))
+        assert response.status_code == 200
+        return
+    pass
+
+class TestDeltaSync(TestCase):
+
+    def setUp(self) -> None:
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name'}
+            # the creation sequence, as change sequence
+            sync_field = 'id'
+            pass
+        self.view = GroupView.as_view()
+        self.group1 = Group.objects.create(name='sync_A')
+        self.group2 = Group.objects.create(name='sync_B')
+        return
+
+    async def sync(self, token=''):
+        response = await self.view(RequestFactory().get('/', {'since': token}))
+        assert response.status_code == 200
+        return json.loads(response.content)
+
+    async def test_changes_and_tombstones_since_token(self):
+        full = await self.sync()
+        assert {obj['name'] for obj in full['changed']} == {'sync_A', 'sync_B'}
+        assert full['deleted'] == []
+        group3 = await Group.objects.acreate(name='sync_C')
+        response = await self.view(RequestFactory().delete('/'), id=self.group1.pk)
+        assert response.status_code == 200
+        await Group.objects.filter(pk=self.group2.pk).adelete()
+        delta = await self.sync(full['since'])
+        assert [obj['id'] for obj in delta['changed']] == [group3.pk]
+        assert delta['deleted'] == [self.group1.pk, self.group2.pk]
+        assert await Tombstone.objects.acount() == 2
+        empty = await self.sync(delta['since'])
+        assert empty['changed'] == [] and empty['deleted'] == []
+        return
+
+    async def test_tombstones_committed_late(self):
+        full = await self.sync()
+        response = await self.view(RequestFactory().delete('/'), id=self.group2.pk)
+        assert response.status_code == 200
+        tombstone = await Tombstone.objects.aget()
+        await Tombstone.objects.filter(pk=tombstone.pk).aupdate(id=tombstone.pk + 10)
+        delta = await self.sync(full['since'])
+        assert delta['deleted'] == [self.group2.pk]
+        # committed after the token with a lower identificator
+        await Tombstone.objects.acreate(id=tombstone.pk + 5, model_label='auth.group', object_pk=str(self.group1.pk))
+        late = await self.sync(delta['since'])
+        assert late['deleted'] == [self.group1.pk]
+        empty = await self.sync(late['since'])
+        assert empty['deleted'] == []
+        return
+
+    async def test_invalid_token(self):
+        response = await self.view(RequestFactory().get('/', {'since': 'invalid'}))
+        assert response.status_code == 400
+        return
+
+    async def test_overlap_window_sends_late_commits_once(self):
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name'}
+            sync_field = 'id'
+            sync_overlap = 10
+            pass
+        self.view = GroupView.as_view()
+        # committed after the token with a lower value of the sequence
+        await Group.objects.filter(pk=self.group2.pk).aupdate(id=self.group1.pk + 5)
+        full = await self.sync()
+        assert len(full['changed']) == 2
+        late = await Group.objects.acreate(pk=self.group1.pk + 2, name='sync_late')
+        delta = await self.sync(full['since'])
+        assert [obj['id'] for obj in delta['changed']] == [late.pk]
+        empty = await self.sync(delta['since'])
+        assert empty['changed'] == []
+        return
+
+    async def test_expired_token_and_prune(self):
+        field = Group._meta.get_field('id')
+        old_token = sync.SyncToken(self.group1.pk, 0, issued=time.time() - 120).encode()
+        with self.settings(DARC_TOMBSTONE_RETENTION=60):
+            response = await self.view(RequestFactory().get('/', {'since': old_token}))
+            assert response.status_code == 410
+            assert sync.SyncToken.decode((await self.sync())['since'], field).seen
+            await self.group1.adelete()
+            await Tombstone.objects.aupdate(deleted_at=timezone.now() - timedelta(seconds=120))
+            recent_pk = self.group2.pk
+            await self.group2.adelete()
+            await sync_to_async(call_command)('darc_prune_tombstones', stdout=io.StringIO())
+        assert [tombstone.object_pk async for tombstone in Tombstone.objects.all()] == [str(recent_pk)]
+        return
+
+    async def test_response_budget(self):
+        await Group.objects.abulk_create([Group(name='sync_%s'%name) for name in 'CDE'])
+        expected = [pk async for pk in Group.objects.order_by('pk').values_list('pk', flat=True)]
+        for initkwargs, page_size in (({'max_rows': 2}, 2), ({'max_response_bytes': 1}, 1)):
+            view = self.view.view_class.as_view(**initkwargs)
+            received, token = [], ''
+            while True:
+                response = await view(RequestFactory().get('/', {'since': token}))
+                body = json.loads(response.content)
+                assert len(body['changed']) <= page_size
+                received += [obj['id'] for obj in body['changed']]
+                token = body['since']
+                if 'X-Truncated' not in response:
+                    break
+                assert urlencode({'since': token}) in response['Link']
+            # the next synchronization continues from the last sent object
+            assert received == expected
+        return
+    pass
+
+class TestEventStream(TestCase):
+
+    async def test_broker_delivers_to_subscribers(self):
+        broker = InProcessEventBroker()
+        async with broker.subscribe('auth.group') as subscription:
+            broker.publish(ChangeEvent('auth.group', 'created', 1))
+            broker.publish(ChangeEvent('auth.permission', 'created', 1))
+            event = await asyncio.wait_for(subscription.get(), 1)
+            assert event.pk == 1 and event.action == 'created'
+            assert subscription.queue.empty()
+        return
+
+    async def test_stream_serializes_with_view_fields(self):
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name'}
+            pass
+        response = await GroupView.as_events_view()(RequestFactory().get('/?filterBy=name[exact]streamed'))
+        assert response['Content-Type'] == 'text/event-stream'
+        stream = aiter(response.streaming_content)
+        assert (await anext(stream)).startswith(b'retry')
+        await sync_to_async(self._commit)(Group.objects.create, name='not streamed')
+        group = await sync_to_async(self._commit)(Group.objects.create, name='streamed')
+        chunk = await asyncio.wait_for(anext(stream), 1)
+        assert chunk.startswith(b'event: created\n')
+        assert json.loads(chunk.split(b'data: ')[1]) == {'id': group.pk, 'name': 'streamed'}
+        await sync_to_async(self._commit)(group.delete)
+        chunk = await asyncio.wait_for(anext(stream), 1)
+        assert chunk.startswith(b'event: deleted')
+        await stream.aclose()
+        return
+
+    def _commit(self, func, *args, **kwargs):
+        # the test transaction is never committed
+        with self.captureOnCommitCallbacks(execute=True):
+            return func(*args, **kwargs)
+
+    def test_closed_loop_subscription_is_dropped(self):
+        broker = InProcessEventBroker()
+        loop = asyncio.new_event_loop()
+        subscribe = broker.subscribe('auth.group')
+        loop.run_until_complete(subscribe.__aenter__())
+        loop.close()
+        broker.publish(ChangeEvent('auth.group', 'created', 1))
+        assert not broker._subscriptions['auth.group']
+        return
+
+    def test_bulk_writes_publish_changes(self):
+        published = []
+        class RecordingBroker(BaseEventBroker):
+            def publish(self, event):
+                published.append((event.model_label, event.action, event.pk))
+            pass
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name', ('permissions', ('id',))}
+            pass
+        events.publish_model_changes(Group)
+        events.publish_model_changes(Permission)
+        self.addCleanup(setattr, events, '_broker', events._broker)
+        events._broker = RecordingBroker()
+        group = Group.objects.create(name='bulk_events')
+        permission = Permission.objects.order_by('pk').first()
+        request = RequestFactory().patch('/', json.dumps({'permissions': [permission.pk]}), content_type='application/json')
+        with self.captureOnCommitCallbacks(execute=True):
+            async_to_sync(GroupView.as_view())(request, id=group.pk)
+        # the save of the group, and both sides of the links
+        assert ('auth.permission', 'updated', permission.pk) in published
+        assert ('auth.group', 'updated', group.pk) in published
+        published.clear()
+        request = RequestFactory().post(
+            '/imports/', data='{"id": %d, "name": "bulk_renamed"}\n{"name": "bulk_new"}'%group.pk,
+            content_type='application/x-ndjson'
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            async_to_sync(GroupView.as_import_view())(request)
+        new_pk = Group.objects.get(name='bulk_new').pk
+        assert sorted(published) == [('auth.group', 'created', new_pk), ('auth.group', 'updated', group.pk)]
+        return
+    pass
+
+@override_settings(ROOT_URLCONF='api.tests')
+class TestBatchView(TestCase):
+
+    async def batch(self, operations, atomic=False, headers=None, response=False):
+        batch_response = await BatchView.as_view()(RequestFactory().post(
+            '/batch/?atomic=true' if atomic else '/batch/',
+            data=json.dumps(operations),
+            content_type='application/json',
+            headers=headers,
+        ))
+        if response:
+            return batch_response
+        return batch_response.status_code, json.loads(batch_response.content)
+
+    async def test_reads_and_writes_in_one_call(self):
+        group = await Group.objects.acreate(name='batch_A')
+        status, body = await self.batch([
+            {'method': 'GET', 'path': '/groups/%d/'%group.pk},
+            {'method': 'POST', 'path': '/groups/', 'body': {'name': 'batch_B'}},
+            {'method': 'GET', 'path': '/groups/?filterBy=name[exact]batch_B'},
+            {'method': 'GET', 'path': '/unknown/'},
+        ])
+        assert status == 200
+        statuses = [result['status'] for result in body['results']]
+        assert statuses == [200, 200, 200, 404]
+        assert body['results'][0]['body']['name'] == 'batch_A'
+        assert body['results'][2]['body'][0]['name'] == 'batch_B'
+        return
+
+    async def test_atomic_writes_rolled_back(self):
+        status, body = await self.batch([
+            {'method': 'POST', 'path': '/groups/', 'body': {'name': 'batch_C'}},
+            {'method': 'PATCH', 'path': '/groups/999999/', 'body': {'name': 'batch_D'}},
+        ], atomic=True)
+        assert status == 200 and body['committed'] is False
+        assert [result['status'] for result in body['results']] == [200, 404]
+        assert not await Group.objects.filter(name='batch_C').aexists()
+        return
+
+    async def test_invalid_batches(self):
+        status, _ = await self.batch({'method': 'GET'})
+        assert status == 400
+        status, _ = await self.batch([{'method': 'TRACE', 'path': '/groups/'}])
+        assert status == 400
+        status, _ = await self.batch([{'method': 'GET', 'path': '/echo/', 'headers': {'If-Match': 1}}])
+        assert status == 400
+        return
+
+    async def test_failed_operations(self):
+        with self.assertLogs('django.request', 'ERROR'):
+            status, body = await self.batch([
+                {'method': 'GET', 'path': '/echo/?fail=1'},
+                {'method': 'GET', 'path': '/echo/'},
+            ])
+        assert status == 200
+        assert [result['status'] for result in body['results']] == [500, 200]
+        with self.assertLogs('django.request', 'ERROR'):
+            status, body = await self.batch([
+                {'method': 'POST', 'path': '/groups/', 'body': {'name': 'batch_E'}},
+                {'method': 'POST', 'path': '/echo/?fail=1'},
+            ], atomic=True)
+        assert body['committed'] is False and body['results'][1]['status'] == 500
+        assert not await Group.objects.filter(name='batch_E').aexists()
+        return
+
+    async def test_headers_and_cookies_of_operations(self):
+        response = await self.batch([
+            {'method': 'GET', 'path': '/echo/'},
+            {'method': 'GET', 'path': '/echo/', 'headers': {'If-Match': '"3"'}},
+        ], headers={'If-Match': '"1"'}, response=True)
+        first, second = json.loads(response.content)['results']
+        # the body and the conditions of the batch request aren't of its operations
+        assert first['body'] == {'content_type': None, 'if_match': None}
+        assert second['body']['if_match'] == '"3"'
+        assert first['headers']['X-Operation'] == 'echo'
+        assert response.cookies['batch_echo'].value == '1'
+        return
+
+    async def test_atomic_writes_of_one_database(self):
+        status, body = await self.batch([
+            {'method': 'POST', 'path': '/groups/', 'body': {'name': 'batch_F'}},
+            {'method': 'POST', 'path': '/replica/groups/', 'body': {'name': 'batch_G'}},
+        ], atomic=True)
+        assert status == 400 and 'replica' in body['message']
+        assert not await Group.objects.filter(name='batch_F').aexists()
+        return
+    pass
+
+class TestColumnsFormat(TestCase):
+
+    def setUp(self) -> None:
+        self.group = Group.objects.create(name='columns_A')
+        self.group.permissions.set(Permission.objects.order_by('pk')[:2])
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name', ('permissions', ('id', 'codename', ('content_type', ('model',))))}
+            pass
+        self.view = GroupView.as_view()
+        return
+
+    async def test_columns_match_objects(self):
+        response = await self.view(RequestFactory().get('/', {'format': 'columns'}))
+        columns = json.loads(response.content)
+        assert columns['fields'] == [
+            'id', 'name', {'permissions': ['codename', 'id', {'content_type': ['model']}]}
+        ]
+        response = await self.view(RequestFactory().get('/'))
+        objects = json.loads(response.content)
+        assert len(columns['rows']) == len(objects) == 1
+        (pk, name, permissions), = columns['rows']
+        assert pk == objects[0]['id'] and name == objects[0]['name']
+        assert sorted(permissions) == sorted(
+            [permission['codename'], permission['id'], [permission['content_type']['model']]]
+            for permission in objects[0]['permissions']
+        )
+        return
+
+    async def test_columns_by_accept_header(self):
+        response = await self.view(RequestFactory().get(
+            '/', headers={'Accept': 'application/vnd.darc.columns+json'}
+        ))
+        assert 'rows' in json.loads(response.content)
+        return
+    pass
+
+class TestExportJobs(TestCase):
+
+    def setUp(self) -> None:
+        self.export_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.export_dir)
+        for name in ('export_A', 'export_B', 'export_C'):
+            Group.objects.create(name=name)
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name', ('permissions', ('codename',))}
+            pass
+        self.view = GroupView.as_export_view(export_chunk_size=2)
+        return
+
+    async def export(self, export_format):
+        with self.settings(DARC_EXPORT_DIR=self.export_dir):
+            response = await self.view(RequestFactory().post(
+                '/exports/?filterBy=name[startswith]export_&onlyFields=name',
+                data=json.dumps({'format': export_format}),
+                content_type='application/json'
+            ))
+            assert response.status_code == 202
+            job = json.loads(response.content)
+            await export_manager.get_task(job['id'])
+            response = await self.view(RequestFactory().get('/'), job=job['id'])
+            status = json.loads(response.content)
+            assert status['status'] == 'done', status
+            assert status['total'] == status['written'] == 3
+            response = await self.view(RequestFactory().get('/', {'download': 1}), job=job['id'])
+            content = b''.join(response.streaming_content).decode()
+            response.close()
+            return content
+
+    async def test_export_ndjson(self):
+        lines = (await self.export('ndjson')).splitlines()
+        assert [json.loads(line) for line in lines] == [
+            {'name': 'export_A'}, {'name': 'export_B'}, {'name': 'export_C'}
+        ]
+        return
+
+    async def test_export_csv(self):
+        content = await self.export('csv')
+        assert content.splitlines() == ['name', 'export_A', 'export_B', 'export_C']
+        return
+
+    async def test_unknown_job(self):
+        with self.settings(DARC_EXPORT_DIR=self.export_dir):
+            response = await self.view(RequestFactory().get('/'), job='abc123')
+        assert response.status_code == 404
+        return
+
+    async def test_jobs_of_other_views(self):
+        class UserView(BaseRESTView):
+            model = User
+            fields = {'id', 'username'}
+            pass
+        with self.settings(DARC_EXPORT_DIR=self.export_dir):
+            response = await self.view(RequestFactory().post('/exports/', data='{}', content_type='application/json'))
+            job_id = json.loads(response.content)['id']
+            await export_manager.get_task(job_id)
+            user_view = UserView.as_export_view()
+            for params in ({}, {'download': 1}):
+                response = await user_view(RequestFactory().get('/', params), job=job_id)
+                assert response.status_code == 404
+        return
+
+    async def test_cancelled_job_fails(self):
+        with self.settings(DARC_EXPORT_DIR=self.export_dir):
+            response = await self.view(RequestFactory().post('/exports/', data='{}', content_type='application/json'))
+            job_id = json.loads(response.content)['id']
+            task = export_manager.get_task(job_id)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            response = await self.view(RequestFactory().get('/'), job=job_id)
+        status = json.loads(response.content)
+        assert status['status'] == 'failed' and status['error'] == 'The export was cancelled'
+        return
+
+    def test_interrupted_and_expired_jobs(self):
+        with self.settings(DARC_EXPORT_DIR=self.export_dir):
+            # a job whose worker stopped while it was running
+            job = ExportJob('group', 'ndjson', status='running')
+            job.save()
+            with open(job.status_path) as status_file:
+                state = json.load(status_file)
+            state['updated_at'] -= exports.STALE_AFTER + 1
+            with open(job.status_path, 'w') as status_file:
+                json.dump(state, status_file)
+            loaded = ExportJob.load(job.id)
+            assert loaded.status == 'failed' and loaded.error == 'The export was interrupted'
+            finished = ExportJob('group', 'ndjson')
+            finished.finish('done')
+            finished.save()
+            open(finished.path, 'w').close()
+            assert exports.remove_expired_jobs(retention=exports.STALE_AFTER) == 1
+            assert not os.path.exists(job.status_path)
+            assert os.path.exists(finished.path) and os.path.exists(finished.status_path)
+            assert exports.remove_expired_jobs(retention=-1) == 1
+            assert not os.listdir(self.export_dir)
+        return
+    pass
+
+class TestBulkImport(TestCase):
+
+    def setUp(self) -> None:
+        self.existing = Group.objects.create(name='import_existing')
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name'}
+            pass
+        self.GroupView = GroupView
+        return
+
+    async def post_lines(self, view, lines: list):
+        body = '\n'.join(line if isinstance(line, str) else json.dumps(line) for line in lines)
+        response = await view(RequestFactory().post(
+            '/imports/', data=body, content_type='application/x-ndjson'
+        ))
+        return response.status_code, json.loads(response.content)
+
+    async def test_upsert_by_pk(self):
+        view = self.GroupView.as_import_view(import_batch_size=2)
+        status, summary = await self.post_lines(view, [
+            {'id': self.existing.pk, 'name': 'import_renamed'},
+            {'name': 'import_new_A'},
+            '{not json',
+            {'name': 'import_new_B', 'unknown': 1},
+            {'name': 'x' * 200},
+            [],
+            {'name': 'import_new_C'},
+        ])
+        assert status == 200
+        assert summary['inserted'] == 2 and summary['updated'] == 1 and summary['rejected'] == 4
+        assert [error['line'] for error in summary['errors']] == [3, 4, 5, 6]
+        assert 'unknown' in summary['errors'][1]['error']
+        names = await sync_to_async(lambda: set(
+            Group.objects.filter(name__startswith='import_').values_list('name', flat=True)
+        ))()
+        assert names == {'import_renamed', 'import_new_A', 'import_new_C'}
+        return
+
+    async def test_upsert_by_unique_field(self):
+        await Permission.objects.acreate(
+            name='import_permission',
+            codename='import_codename',
+            content_type=await sync_to_async(ContentType.objects.get_for_model)(Group)
+        )
+        class PermissionView(BaseRESTView):
+            model = Permission
+            fields = {'name', 'codename', ('content_type', ('id',))}
+            pass
+        content_type = await sync_to_async(ContentType.objects.get_for_model)(Group)
+        view = PermissionView.as_import_view(import_unique_fields=('content_type', 'codename'))
+        status, summary = await self.post_lines(view, [
+            {'codename': 'import_codename', 'content_type': content_type.pk, 'name': 'renamed'},
+            {'codename': 'import_other', 'content_type': content_type.pk, 'name': 'other'},
+            {'codename': 'import_other', 'content_type': content_type.pk, 'name': 'other again'},
+        ])
+        assert status == 200
+        assert (summary['inserted'], summary['updated'], summary['rejected']) == (1, 2, 0)
+        names = await sync_to_async(lambda: dict(
+            Permission.objects.filter(codename__startswith='import_').values_list('codename', 'name')
+        ))()
+        assert names == {'import_codename': 'renamed', 'import_other': 'other again'}
+        return
+
+    async def test_rejected_lines_of_a_batch(self):
+        view = self.GroupView.as_import_view(import_batch_size=5)
+        status, summary = await self.post_lines(view, [
+            {'name': 'import_new_A'},
+            # the name is unique
+            {'name': 'import_existing'},
+            {'name': 'import_new_B'},
+            {'name': 'import_new_C'},
+        ])
+        assert status == 200
+        assert (summary['inserted'], summary['updated'], summary['rejected']) == (3, 0, 1)
+        assert [error['line'] for error in summary['errors']] == [2]
+        names = await sync_to_async(lambda: set(
+            Group.objects.filter(name__startswith='import_').values_list('name', flat=True)
+        ))()
+        assert names == {'import_existing', 'import_new_A', 'import_new_B', 'import_new_C'}
+        # the existing objects without fields to update aren't written
+        view = self.GroupView.as_import_view(import_unique_fields=('name',))
+        status, summary = await self.post_lines(view, [{'name': 'import_existing'}, {'name': 'import_new_D'}])
+        assert (summary['inserted'], summary['updated'], summary['unchanged']) == (1, 0, 1)
+        return
+
+    async def test_requires_ndjson(self):
+        response = await self.GroupView.as_import_view()(RequestFactory().post(
+            '/imports/', data={'name': 'x'}, content_type='application/json'
+        ))
+        assert response.status_code == 400
+        return
+
+    def test_invalid_unique_fields(self):
+        with self.assertRaises(exceptions.InvalidImportUniqueFields):
+            self.GroupView.as_import_view(import_unique_fields=('permissions',))
+        return
+    pass
+
+class TestImportSynchronization(VersionedNoteTestCase):
+
+    def test_upsert_refreshes_sync_field(self):
+        note = VersionedNote.objects.create(title='import_sync')
+        class NoteView(BaseRESTView):
+            model = VersionedNote
+            fields = {'id', 'title'}
+            sync_field = 'updated_at'
+            pass
+        full = json.loads(async_to_sync(NoteView.as_view())(RequestFactory().get('/', {'since': ''})).content)
+        VersionedNote.objects.filter(pk=note.pk).update(updated_at=note.updated_at - timedelta(minutes=1))
+        response = async_to_sync(NoteView.as_import_view())(RequestFactory().post(
+            '/imports/', data=json.dumps({'id': note.pk, 'title': 'import_synced'}),
+            content_type='application/x-ndjson'
+        ))
+        assert json.loads(response.content)['updated'] == 1
+        assert VersionedNote.objects.get(pk=note.pk).updated_at > note.updated_at
+        delta = json.loads(async_to_sync(NoteView.as_view())(RequestFactory().get('/', {'since': full['since']})).content)
+        assert [obj['title'] for obj in delta['changed']] == ['import_synced']
+        return
+
+    def test_upsert_increments_version(self):
+        note = VersionedNote.objects.create(title='import_version')
+        class NoteView(BaseRESTView):
+            model = VersionedNote
+            fields = {'id', 'title', 'version'}
+            version_field = 'version'
+            pass
+        import_view = NoteView.as_import_view()
+        # the version isn't written by the lines
+        response = async_to_sync(import_view)(RequestFactory().post(
+            '/imports/', data=json.dumps({'id': note.pk, 'title': 'import_versioned', 'version': 9}),
+            content_type='application/x-ndjson'
+        ))
+        assert json.loads(response.content)['rejected'] == 1
+        lines = '\n'.join([
+            json.dumps({'id': note.pk, 'title': 'import_versioned'}),
+            json.dumps({'title': 'import_created'}),
+        ])
+        response = async_to_sync(import_view)(RequestFactory().post(
+            '/imports/', data=lines, content_type='application/x-ndjson'
+        ))
+        assert json.loads(response.content)['updated'] == 1
+        assert VersionedNote.objects.get(pk=note.pk).version == 1
+        assert VersionedNote.objects.get(title='import_created').version == 0
+        return
+    pass
+
+class TestCascadedTombstones(VersionedNoteTestCase):
+
+    def test_cascaded_deletions_of_the_same_model(self):
+        parent = VersionedNote.objects.create(title='parent')
+        reply = VersionedNote.objects.create(title='reply', parent=parent)
+        class NoteView(BaseRESTView):
+            model = VersionedNote
+            fields = {'id', 'title'}
+            sync_field = 'updated_at'
+            pass
+        view = NoteView.as_view()
+        full = json.loads(async_to_sync(view)(RequestFactory().get('/', {'since': ''})).content)
+        response = async_to_sync(view)(RequestFactory().delete('/'), id=parent.pk)
+        assert response.status_code == 200
+        delta = json.loads(async_to_sync(view)(RequestFactory().get('/', {'since': full['since']})).content)
+        assert sorted(delta['deleted']) == [parent.pk, reply.pk]
+        return
+    pass
+
+class TestCachedCountInitkwargs(VersionedNoteTestCase):
+
+    def test_cached_count_is_invalidated(self):
+        VersionedNote.objects.create(title='count_first')
+        class NoteView(BaseRESTView):
+            model = VersionedNote
+            fields = {'id', 'title'}
+            pass
+        view = NoteView.as_view(count_strategy='cached')
+        get = lambda: json.loads(async_to_sync(view)(RequestFactory().get('/', {'page': 1})).content)
+        assert get()['count'] == 1
+        with self.captureOnCommitCallbacks(execute=True):
+            VersionedNote.objects.create(title='count_second')
+        assert get()['count'] == 2
+        return
+    pass
+
+class TestOptimisticConcurrency(VersionedNoteTestCase):
+
+    def setUp(self) -> None:
+        self.note = VersionedNote.objects.create(title='first')
+        class NoteView(BaseRESTView):
+            model = VersionedNote
+            fields = {'id', 'title', 'version'}
+            version_field = 'version'
+            pass
+        self.view = NoteView.as_view()
+        return
+
+    async def patch(self, data: dict, if_match: str | None = None):
+        headers = {'If-Match': if_match} if if_match else {}
+        return await self.view(RequestFactory().patch(
+            '/', data=json.dumps(data), content_type='application/json', headers=headers
+        ), id=self.note.pk)
+
+    async def test_etag_and_conditional_update(self):
+        response = await self.view(RequestFactory().get('/'), id=self.note.pk)
+        assert response['ETag'] == '"0"'
+        response = await self.patch({'title': 'second'}, response['ETag'])
+        assert response.status_code == 200
+        assert response['ETag'] == '"1"'
+        # a client with the old version loses
+        response = await self.patch({'title': 'lost'}, '"0"')
+        assert response.status_code == 412
+        note = await VersionedNote.objects.aget(pk=self.note.pk)
+        assert (note.title, note.version) == ('second', 1)
+        return
+
+    async def test_version_isnt_writable(self):
+        response = await self.patch({'title': 'second', 'version': 0})
+        assert response.status_code == 200
+        response = await self.patch({'title': 'third', 'version': 0})
+        assert response.status_code == 412
+        response = await self.patch({'title': 'third'}, '*')
+        assert response['ETag'] == '"2"'
+        return
+
+    async def test_concurrent_update_after_read(self):
+        # other client updates between the read and the write of the request
+        await VersionedNote.objects.filter(pk=self.note.pk).aupdate(version=5)
+        self.note.title = 'stale'
+        with self.assertRaises(exceptions.PreconditionFailed):
+            await sync_to_async(versioning.save_versioned)(self.note, 'version', {'title'}, 0, 'default')
+        note = await VersionedNote.objects.aget(pk=self.note.pk)
+        assert note.title == 'first'
+        return
+    pass
+
+class TestRelationAggregates(TestCase):
+
+    def setUp(self) -> None:
+        content_type = ContentType.objects.get_for_model(Group)
+        self.permissions = Permission.objects.filter(content_type=content_type).order_by('id')
+        self.group = Group.objects.create(name='aggregate_A')
+        self.group.permissions.set(self.permissions)
+        self.empty_group = Group.objects.create(name='aggregate_B')
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {
+                'id',
+                'name',
+                ('permissions', '__count__'),
+                ('permissions', '__max__', 'id'),
+            }
+            pass
+        self.GroupView = GroupView
+        return
+
+    async def get(self, path='/', **params):
+        response = await self.GroupView.as_view()(RequestFactory().get(path, params))
+        return response.status_code, json.loads(response.content)
+
+    def test_aggregates_in_one_query(self):
+        expected_max = self.permissions.last().id
+        with self.assertNumQueries(1):
+            status, objects = async_to_sync(self.get)(filterBy='name[startswith]aggregate_')
+        assert status == 200
+        objects = {obj['name']: obj for obj in objects}
+        assert objects['aggregate_A']['permissions_count'] == 4
+        assert objects['aggregate_A']['permissions_max_id'] == expected_max
+        assert objects['aggregate_B']['permissions_count'] == 0
+        assert objects['aggregate_B']['permissions_max_id'] is None
+        assert 'permissions' not in objects['aggregate_A']
+        return
+
+    async def test_filter_and_only_fields(self):
+        status, objects = await self.get(
+            filterBy='permissions_count[gt]0',
+            onlyFields='name,permissions.__count__'
+        )
+        assert status == 200
+        assert objects == [{'name': 'aggregate_A', 'permissions_count': 4}]
+        return
+
+    def test_invalid_aggregates(self):
+        view = object.__new__(self.GroupView)
+        for fields in (
+            {('permissions', '__count__', 'id')},
+            {('permissions', '__sum__')},
+            {('permissions', ('content_type', '__count__'))},
+        ):
+            with self.assertRaises((exceptions.InvalidAggregateField, exceptions.FieldNotInModel)):
+                view.initialize_fields(fields)
+        return
+
+    def test_annotation_name_conflicts(self):
+        class GroupView(self.GroupView):
+            computed_fields = {'permissions_count': Value(0)}
+            pass
+        view = object.__new__(GroupView)
+        for fields in (
+            {('permissions', '__count__')},
+            {'permissions_count', ('permissions', '__count__')},
+        ):
+            with self.assertRaises(exceptions.AnnotationNameConflict):
+                view.initialize_fields(fields)
+        return
+    pass
+
+class TestComputedFields(TestCase):
+
+    def setUp(self) -> None:
+        for name in ('computed_long', 'computed_x', 'computed_mid'):
+            Group.objects.create(name=name)
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name', 'name_length', 'label'}
+            computed_fields = {
+                'name_length': Length('name'),
+                'label': Concat(Upper('name'), Value('#'), Cast('id', models.CharField())),
+            }
+            pass
+        self.GroupView = GroupView
+        return
+
+    async def get(self, **params):
+        response = await self.GroupView.as_view()(RequestFactory().get('/', params))
+        return response.status_code, json.loads(response.content)
+
+    async def test_serialized_filtered_and_ordered(self):
+        status, objects = await self.get(
+            filterBy='name[startswith]computed_;name_length[gt]10',
+            orderBy='-name_length'
+        )
+        assert status == 200
+        assert [obj['name'] for obj in objects] == ['computed_long', 'computed_mid']
+        assert objects[0]['name_length'] == 13
+        assert objects[0]['label'] == 'COMPUTED_LONG#%s'%objects[0]['id']
+        return
+
+    async def test_out_of_only_fields(self):
+        status, objects = await self.get(
+            onlyFields='name',
+            filterBy='name[startswith]computed_',
+            orderBy='name_length,name'
+        )
+        assert status == 200
+        assert objects == [{'name': 'computed_x'}, {'name': 'computed_mid'}, {'name': 'computed_long'}]
+        return
+
+    async def test_invalid_order(self):
+        status, body = await self.get(orderBy='unknown')
+        assert status == 400
+        return
+
+    def test_conflict_check(self):
+        class ConflictView(BaseRESTView):
+            model = Group
+            fields = {'id'}
+            computed_fields = {'name': Upper('name')}
+            pass
+        errors = [error for error in checks.check_rest_views() if error.obj is ConflictView]
+        assert [error.id for error in errors] == ['darc.E005']
+        return
+    pass
+
+class TestFullTextSearch(TransactionTestCase):
+    # SQLite can't roll back the creation of the FTS5 table to the savepoints of `TestCase`
+
+    def setUp(self) -> None:
+        for name in ('search red team', 'search blue team', 'search red red squad', 'other'):
+            Group.objects.create(name=name)
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name'}
+            search_fields = ('name',)
+            pass
+        self.GroupView = GroupView
+        call_command('darc_search_tables', stdout=io.StringIO())
+        return
+
+    def tearDown(self) -> None:
+        with connection.cursor() as cursor:
+            for suffix in ('ai', 'ad', 'au'):
+                cursor.execute('DROP TRIGGER IF EXISTS auth_group_fts_%s'%suffix)
+            cursor.execute('DROP TABLE IF EXISTS auth_group_fts')
+        search.get_search_backend('default')._tables.clear()
+        return
+
+    async def get(self, view=None, **params):
+        response = await (view or self.GroupView.as_view())(RequestFactory().get('/', params))
+        return response.status_code, json.loads(response.content)
+
+    async def test_fts5_ranked_and_filtered(self):
+        status, objects = await self.get(search='red')
+        assert status == 200
+        assert [obj['name'] for obj in objects] == ['search red red squad', 'search red team']
+        status, objects = await self.get(search='red', filterBy='name[endswith]team')
+        assert [obj['name'] for obj in objects] == ['search red team']
+        # the shadow table follows the writes
+        await Group.objects.filter(name='search blue team').aupdate(name='search red blue team')
+        status, objects = await self.get(search='blue "red')
+        assert [obj['name'] for obj in objects] == ['search red blue team']
+        return
+
+    def test_fts5_requires_table(self):
+        self.tearDown()
+        # the requests don't create the table
+        with self.assertRaises(ImproperlyConfigured):
+            async_to_sync(self.get)(search='red')
+        return
+
+    async def test_contains_backend(self):
+        view = self.GroupView.as_view(search_backend='api.search.ContainsSearchBackend')
+        status, objects = await self.get(view, search='team RED', orderBy='name')
+        assert status == 200
+        assert [obj['name'] for obj in objects] == ['search red team']
+        return
+    pass
+
+class TestOnlyFieldsProjection(TestCase):
+
+    def setUp(self) -> None:
+        self.group = Group.objects.create(name='projection_A')
+        self.group.permissions.set(Permission.objects.filter(codename__in=('add_group', 'view_group')))
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {
+                'id',
+                'name',
+                ('permissions', ('id', 'codename', ('content_type', ('model', 'app_label')))),
+            }
+            pass
+        self.view = GroupView.as_view()
+        return
+
+    async def get(self, only_fields: str):
+        response = await self.view(RequestFactory().get('/', {
+            'onlyFields': only_fields,
+            'filterBy': 'name[exact]projection_A',
+        }))
+        return response.status_code, json.loads(response.content)
+
+    def test_deep_path_fetches_narrow_rows(self):
+        with CaptureQueriesContext(connection) as queries:
+            status, objects = async_to_sync(self.get)('name,permissions.content_type.model')
+        assert status == 200
+        assert objects == [{
+            'name': 'projection_A',
+            'permissions': [{'content_type': {'model': 'group'}}] * 2,
+        }]
+        assert len(queries) == 3
+        group_query, permission_query, content_type_query = [query['sql'] for query in queries]
+        assert '"auth_group"."name"' in group_query
+        assert '"auth_permission"."codename"' not in permission_query.split('FROM')[0]
+        assert '"django_content_type"."app_label"' not in content_type_query.split('FROM')[0]
+        return
+
+    async def test_relation_and_all(self):
+        status, objects = await self.get('permissions.codename,permissions.content_type')
+        assert status == 200
+        assert sorted(objects[0]['permissions'], key=lambda item: item['codename']) == [
+            {'codename': 'add_group', 'content_type': {'model': 'group', 'app_label': 'auth'}},
+            {'codename': 'view_group', 'content_type': {'model': 'group', 'app_label': 'auth'}},
+        ]
+        status, objects = await self.get('permissions.__all__')
+        assert set(objects[0]['permissions'][0]) == {'id', 'codename', 'content_type'}
+        return
+
+    async def test_undeclared_paths(self):
+        for only_fields in ('permissions.name', 'name.length', 'permissions.content_type.id', 'users'):
+            status, body = await self.get(only_fields)
+            assert status == 400, only_fields
+            assert 'is not a field of the view' in body['message']
+        return
+    pass
+
+class TestPaginationCounts(TestCase):
+
+    def setUp(self) -> None:
+        Group.objects.bulk_create([Group(name='page_%s_%d'%(self._testMethodName, i)) for i in range(5)])
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name'}
+            pass
+        self.GroupView = GroupView
+        return
+
+    def get(self, view, **params):
+        response = async_to_sync(view)(RequestFactory().get('/', params))
+        return response.status_code, json.loads(response.content)
+
+    def test_exact_page(self):
+        status, body = self.get(
+            self.GroupView.as_view(),
+            page=3, itemsPerPage=2, filterBy='name[startswith]page_test_exact_page'
+        )
+        assert status == 200
+        assert (body['count'], body['count_exact'], body['page'], body['items_per_page']) == (5, True, 3, 2)
+        assert [obj['name'] for obj in body['results']] == ['page_test_exact_page_4']
+        status, body = self.get(self.GroupView.as_view(), page=0)
+        assert status == 400
+        return
+
+    def test_cached_count(self):
+        class CachedGroupView(self.GroupView):
+            count_strategy = 'cached'
+            pass
+        view = CachedGroupView.as_view()
+        params = {'page': 1, 'filterBy': 'name[startswith]page_test_cached_count'}
+        assert self.get(view, **params)[1]['count'] == 5
+        # without signals, the cached count isn't invalidated
+        Group.objects.bulk_create([Group(name='page_test_cached_count_5')])
+        assert self.get(view, **params)[1]['count'] == 5
+        with self.captureOnCommitCallbacks(execute=True):
+            Group.objects.create(name='page_test_cached_count_6')
+        assert self.get(view, **params)[1]['count'] == 7
+        return
+
+    def test_estimated_count(self):
+        view = self.GroupView.as_view(count_strategy='estimated', exact_count_threshold=1)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        total = Group.objects.count()
+        Group.objects.create(name='page_test_estimated_count_5')
+        status, body = self.get(view, page=1)
+        assert (body['count'], body['count_exact']) == (total, False)
+        # the statistics don't estimate the filters
+        status, body = self.get(view, page=1, filterBy='name[startswith]page_test_estimated_count')
+        assert (body['count'], body['count_exact']) == (6, True)
+        return
+    pass
+
+class TestResponseBudget(TestCase):
+
+    def setUp(self) -> None:
+        Group.objects.bulk_create([Group(name='budget_%d'%i) for i in range(7)])
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name'}
+            pass
+        self.GroupView = GroupView
+        return
+
+    def get(self, view, **params):
+        params.setdefault('filterBy', 'name[startswith]budget_')
+        return async_to_sync(view)(RequestFactory().get('/groups/', params))
+
+    def follow(self, view, **params) -> list:
+        names = []
+        while True:
+            response = self.get(view, **params)
+            names += [obj['name'] for obj in json.loads(response.content)]
+            if 'Link' not in response:
+                return names
+            params['offset'] = int(response['Link'].split('offset=')[1].split('>')[0].split('&')[0])
+
+    def test_max_rows(self):
+        view = self.GroupView.as_view(max_rows=3, budget_chunk_size=2)
+        response = self.get(view)
+        assert [obj['name'] for obj in json.loads(response.content)] == ['budget_0', 'budget_1', 'budget_2']
+        assert response['X-Truncated'] == 'rows'
+        assert 'offset=3' in response['Link'] and response['Link'].endswith('rel="next"')
+        assert self.follow(view) == ['budget_%d'%i for i in range(7)]
+        # itemsPerPage can't exceed the budget
+        body = json.loads(self.get(view, page=1, itemsPerPage=100).content)
+        assert body['items_per_page'] == 3
+        assert self.get(view, offset=-1).status_code == 400
+        return
+
+    def test_max_response_bytes(self):
+        view = self.GroupView.as_view(max_response_bytes=80)
+        response = self.get(view)
+        assert len(response.content) <= 80
+        assert response['X-Truncated'] == 'bytes'
+        assert self.follow(view) == ['budget_%d'%i for i in range(7)]
+        # the first object is always served
+        response = self.get(self.GroupView.as_view(max_response_bytes=1))
+        assert len(json.loads(response.content)) == 1
+        return
+
+    def test_columns_budget(self):
+        view = self.GroupView.as_view(max_rows=5)
+        response = self.get(view, format='columns')
+        body = json.loads(response.content)
+        assert len(body['rows']) == 5 and response['X-Truncated'] == 'rows'
+        response = self.get(view, format='columns', offset=5)
+        assert len(json.loads(response.content)['rows']) == 2 and 'Link' not in response
+        return
+
+    def test_page_budget(self):
+        view = self.GroupView.as_view(max_response_bytes=80)
+        names = []
+        params = {'page': 1, 'itemsPerPage': 5}
+        while True:
+            response = self.get(view, **params)
+            body = json.loads(response.content)
+            assert body['count'] == 7
+            names += [obj['name'] for obj in body['results']]
+            if 'Link' not in response:
+                break
+            assert response['X-Truncated'] == 'bytes'
+            params['offset'] = int(response['Link'].split('offset=')[1].split('>')[0].split('&')[0])
+        # the rest of the page is served with the `offset`, without the next page
+        assert names == ['budget_%d'%i for i in range(5)]
+        view = self.GroupView.as_view(max_response_bytes=1)
+        response = self.get(view, page=2, itemsPerPage=5, format='columns')
+        assert len(json.loads(response.content)['rows']) == 1 and response['X-Truncated'] == 'bytes'
+        response = self.get(view, page=2, itemsPerPage=5, format='columns', offset=1)
+        assert len(json.loads(response.content)['rows']) == 1 and 'Link' not in response
+        return
+    pass
+
+class TestExplainMode(TestCase):
+
+    def setUp(self) -> None:
+        self.group = Group.objects.create(name='explained')
+        self.group.permissions.set(Permission.objects.order_by('pk')[:2])
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name', ('permissions', ('codename',))}
+            pass
+        self.view = GroupView.as_view()
+        return
+
+    def get(self, user=None, **params):
+        request = RequestFactory().get('/', {'explain': '1', **params})
+        if user is not None:
+            request.user = user
+        response = async_to_sync(self.view)(request)
+        return response.status_code, json.loads(response.content)
+
+    def test_explain_requires_staff(self):
+        status, body = self.get()
+        assert status == 403
+        user = User(username='explainer', is_staff=True)
+        status, body = self.get(user, filterBy='name[exact]explained')
+        assert status == 200 and 'statements' in body
+        return
+
+    @signed_cookie_sessions
+    def test_explain_through_middlewares(self):
+        staff = User.objects.create_user('explain_staff', is_staff=True)
+        other = User.objects.create_user('explain_other')
+        for user, expected_status in ((staff, 200), (other, 403)):
+            request = authenticate(RequestFactory().get('/', {'explain': '1'}), get_session_cookie(user))
+            response = async_to_sync(self.view)(request)
+            assert response.status_code == expected_status
+        return
+
+    @override_settings(DEBUG=True)
+    def test_explain_statements(self):
+        status, body = self.get(filterBy='name[exact]explained', page=1)
+        assert status == 200 and body['status'] == 200
+        statements = body['statements']
+        sqls = [statement['sql'] for statement in statements]
+        # the count, the page and the prefetch of the permissions
+        assert any('COUNT(' in sql for sql in sqls)
+        assert any('auth_group_permissions' in sql for sql in sqls)
+        assert any('explained' in statement['params'] for statement in statements)
+        assert all(statement['plan'] for statement in statements)
+        assert all(statement['duration_ms'] >= 0 for statement in statements)
+        return
+    pass
+
+class TestRequestProfiling(TestCase):
+
+    def setUp(self) -> None:
+        self.profile_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(DARC_PROFILE_DIR=self.profile_dir)
+        self.settings_override.enable()
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name'}
+
+            async def parse_objects(self, objects):
+                # the request lasts some samples of the event loop
+                time.sleep(0.01)
+                return await super().parse_objects(objects)
+            pass
+        self.GroupView = GroupView
+        return
+
+    def tearDown(self) -> None:
+        self.settings_override.disable()
+        shutil.rmtree(self.profile_dir)
+        return
+
+    def test_profiled_request(self):
+        view = self.GroupView.as_view(profile_sample_rate=1, profile_interval=0.0001)
+        request = RequestFactory().get('/', HTTP_X_REQUEST_ID='req/42')
+        response = async_to_sync(view)(request)
+        assert response.status_code == 200
+        assert response['X-Darc-Profile'] == 'req42'
+        files = sorted(os.listdir(self.profile_dir))
+        assert len(files) == 2 and all('GroupView-req42.' in name for name in files)
+        stats = pstats.Stats(os.path.join(self.profile_dir, files[1]))
+        assert stats.total_tt >= 0
+        with open(os.path.join(self.profile_dir, files[0])) as collapsed_file:
+            # the frames of the event loop aren't sampled
+            assert '_run_once' not in collapsed_file.read()
+        # the header profiles just the requests of the staff users
+        response = async_to_sync(self.GroupView.as_view())(RequestFactory().get('/', HTTP_X_DARC_PROFILE='1'))
+        assert 'X-Darc-Profile' not in response
+        return
+
+    @signed_cookie_sessions
+    def test_profile_header_through_middlewares(self):
+        view = self.GroupView.as_view(profile_interval=0.0001)
+        staff = User.objects.create_user('profile_staff', is_staff=True)
+        other = User.objects.create_user('profile_other')
+        for user, profiled in ((staff, True), (other, False)):
+            request = authenticate(
+                RequestFactory().get('/', HTTP_X_DARC_PROFILE='1', HTTP_X_REQUEST_ID=user.username),
+                get_session_cookie(user)
+            )
+            response = async_to_sync(view)(request)
+            assert response.status_code == 200
+            assert ('X-Darc-Profile' in response) == profiled
+        return
+
+    def test_loop_stack(self):
+        loop = [('/asyncio/base_events.py', 1, 'run_forever'), ('/asyncio/base_events.py', 2, '_run_once')]
+        handle = ('/asyncio/events.py', 3, '_run')
+        task = [('/api/mixins.py', 4, 'get'), ('/api/base_rest.py', 5, 'parse_objects')]
+        assert profiling.trim_loop_stack((*loop, handle, *task)) == tuple(task)
+        assert profiling.trim_loop_stack((*loop, ('/selectors.py', 6, 'select'))) == ()
+        assert profiling.trim_loop_stack(tuple(loop)) == ()
+        assert profiling.trim_loop_stack(tuple(task)) == tuple(task)
+        return
+
+    def test_samples_and_rotation(self):
+        profiler = profiling.SamplingProfiler(interval=0.01)
+        profiler.add_thread(threading.get_ident())
+        def leaf():
+            profiler.sample()
+        leaf(); leaf()
+        (stack, count), = profiler.samples.items()
+        # the sample is taken by the leaf
+        leaf_key = stack[-2]
+        assert count == 2 and leaf_key[2] == 'leaf'
+        stats = profiler.stats()
+        assert stats[leaf_key][:4] == (2, 2, 0.0, 0.02)
+        assert stats[stack[-1]][4] == {leaf_key: (2, 2, 0.0, 0.02)}
+        assert 'leaf (tests.py:%d);sample'%leaf_key[1] in profiler.collapsed()
+        for request_id in ('a', 'b', 'c'):
+            profiler.dump('view', request_id)
+            os.utime(
+                os.path.join(self.profile_dir, 'view-%s.pstats'%request_id),
+                (0, {'a': 1, 'b': 2, 'c': 3}[request_id])
+            )
+        size = sum(os.path.getsize(os.path.join(self.profile_dir, name)) for name in os.listdir(self.profile_dir))
+        profiling.rotate(size - 1)
+        assert 'view-a.pstats' not in os.listdir(self.profile_dir)
+        assert 'view-c.pstats' in os.listdir(self.profile_dir)
+        return
+    pass
+
+class TestMetricsRegistry(TestCase):
+
+    def setUp(self) -> None:
+        metrics.metrics_registry.reset()
+        Group.objects.bulk_create([Group(name='metrics_%d'%i) for i in range(3)])
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name', ('permissions', ('codename',))}
+            pass
+        self.GroupView = GroupView
+        self.label = registry.get_label(GroupView)
+        return
+
+    def exposition(self) -> dict:
+        response = async_to_sync(metrics_exposition)(RequestFactory().get('/metrics/'))
+        assert response['Content-Type'].startswith('text/plain; version=0.0.4')
+        samples = {}
+        for line in response.content.decode().splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_request_metrics(self):
+        view = self.GroupView.as_view()
+        response = async_to_sync(view)(RequestFactory().get('/', {'filterBy': 'name[startswith]metrics_'}))
+        async_to_sync(view)(RequestFactory().get('/', {'orderBy': 'unknown'}))
+        samples = self.exposition()
+        labels = 'view="%s",method="GET"'%self.label
+        assert samples['darc_request_duration_seconds_count{%s}'%labels] == 2
+        assert samples['darc_request_duration_seconds_bucket{%s,le="+Inf"}'%labels] == 2
+        # the objects and the prefetch of the permissions
+        assert samples['darc_request_queries_bucket{%s,le="2"}'%labels] == 2
+        assert samples['darc_rows_serialized_total{%s}'%labels] == 3
+        assert samples['darc_response_bytes_total{%s}'%labels] >= len(response.content)
+        assert samples['darc_errors_total{%s,exception="InvalidOrderField"}'%labels] == 1
+        return
+
+    def test_cache_metrics(self):
+        view = self.GroupView.as_view(count_strategy='cached')
+        for _ in range(2):
+            async_to_sync(view)(RequestFactory().get('/', {'page': 1}))
+        samples = self.exposition()
+        labels = 'view="%s",method="GET"'%self.label
+        assert samples['darc_cache_requests_total{%s,cache="count",result="miss"}'%labels] == 1
+        assert samples['darc_cache_requests_total{%s,cache="count",result="hit"}'%labels] == 1
+        return
+
+    def test_multiprocess_aggregation(self):
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        with override_settings(DARC_METRICS_DIR=metrics_dir):
+            async_to_sync(self.GroupView.as_view())(RequestFactory().get('/'))
+            # the file of other process
+            other = metrics.MetricsRegistry()
+            other.metrics['darc_errors_total'].inc((self.label, 'GET', 'QueueTimeout'), 4)
+            other.metrics['darc_request_duration_seconds'].observe((self.label, 'GET'), 0.02)
+            with open(os.path.join(metrics_dir, '0.json'), 'w') as metrics_file:
+                json.dump(other.snapshot(), metrics_file)
+            samples = self.exposition()
+        labels = 'view="%s",method="GET"'%self.label
+        assert samples['darc_errors_total{%s,exception="QueueTimeout"}'%labels] == 4
+        assert samples['darc_request_duration_seconds_count{%s}'%labels] == 2
+        assert samples['darc_request_duration_seconds_bucket{%s,le="0.025"}'%labels] >= 1
+        return
+
+    def test_concurrent_flushes(self):
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        registry = metrics.MetricsRegistry()
+        with override_settings(DARC_METRICS_DIR=metrics_dir, DARC_METRICS_FLUSH_INTERVAL=60):
+            # one request of the interval flushes
+            assert [registry.should_flush() for _ in range(3)] == [True, False, False]
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(registry.flush())) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert results == [True] * 8
+            assert os.listdir(metrics_dir) == ['%s.json'%os.getpid()]
+            # the errors of the file system aren't raised
+            os.remove(os.path.join(metrics_dir, '%s.json'%os.getpid()))
+            os.mkdir(os.path.join(metrics_dir, '%s.json'%os.getpid()))
+            assert registry.flush() is False
+            assert os.listdir(metrics_dir) == ['%s.json'%os.getpid()]
+        return
+    pass
+
+class TestRequestValidation(TestCase):
+
+    def setUp(self) -> None:
+        class PermissionView(BaseRESTView):
+            model = Permission
+            fields = {'id', 'name', 'codename', ('content_type', ('id',))}
+            nonupdatable_fields = {'codename'}
+            pass
+        self.view = PermissionView.as_view()
+        self.content_type = ContentType.objects.get_for_model(Group)
+        return
+
+    def send(self, method, data, **kwargs):
+        request = getattr(RequestFactory(), method)('/', json.dumps(data), content_type='application/json')
+        response = async_to_sync(self.view)(request, **kwargs)
+        return response.status_code, json.loads(response.content)
+
+    def test_all_errors_before_queries(self):
+        with self.assertNumQueries(0):
+            status, body = self.send('post', {'name': 'x' * 300, 'content_type': 'abc'})
+        assert status == 400
+        assert set(body['errors']) == {'name', 'content_type', 'codename'}
+        assert body['errors']['codename'] == ['This field is required.']
+        assert 'at most 255 characters' in body['errors']['name'][0]
+        with self.assertNumQueries(0):
+            status, body = self.send('post', {'name': '', 'codename': 'c', 'content_type': None})
+        assert status == 400 and set(body['errors']) == {'name', 'content_type'}
+        return
+
+    def test_coercion(self):
+        status, body = self.send('post', {
+            'name': 'Can validate', 'codename': 'validate', 'content_type': str(self.content_type.pk)
+        })
+        assert status == 200
+        permission = Permission.objects.get(codename='validate')
+        assert permission.content_type == self.content_type
+        # the nonupdatable fields aren't required by PUT, and PATCH requires nothing
+        status, body = self.send('put', {'name': 'Can revalidate', 'content_type': self.content_type.pk}, id=permission.pk)
+        assert status == 200
+        status, body = self.send('patch', {'content_type': 'x'}, id=permission.pk)
+        assert status == 400 and list(body['errors']) == ['content_type']
+        return
+
+    def test_blank_values(self):
+        user = User.objects.create_user('blank_user', first_name='Ana')
+        class UserView(BaseRESTView):
+            model = User
+            fields = {'id', 'username', 'first_name'}
+            pass
+        request = RequestFactory().patch('/', json.dumps({'first_name': ''}), content_type='application/json')
+        response = async_to_sync(UserView.as_view())(request, id=user.pk)
+        # blank, but not null
+        assert response.status_code == 200
+        user.refresh_from_db()
+        assert user.first_name == ''
+        return
+
+    def test_reverse_to_one_isnt_written(self):
+        class NoteView(BaseRESTView):
+            model = VersionedNote
+            fields = {'id', 'title', ('versionednotedetail', ('id',))}
+            pass
+        assert set(NoteView.compile_fields()['request_validator'].validators) == {'title'}
+        return
+    pass
+
+class TestManyToManyWrites(TestCase):
+
+    def setUp(self) -> None:
+        self.group = Group.objects.create(name='m2m')
+        self.permissions = list(Permission.objects.order_by('pk')[:4])
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name', ('permissions', ('id',))}
+            pass
+        class PermissionView(BaseRESTView):
+            model = Permission
+            # the content type is selected for `str(permission)`
+            fields = {'id', 'codename', ('content_type', ('id',)), ('group_set', ('id',))}
+            pass
+        self.GroupView = GroupView
+        self.PermissionView = PermissionView
+        self.signals = []
+        def receiver(sender, instance, action, reverse, pk_set, **kwargs):
+            self.signals.append((action, reverse, pk_set))
+        models.signals.m2m_changed.connect(receiver, sender=Group.permissions.through, weak=False)
+        self.addCleanup(models.signals.m2m_changed.disconnect, receiver, sender=Group.permissions.through)
+        return
+
+    def patch(self, view, pk, data):
+        request = RequestFactory().patch('/', json.dumps(data), content_type='application/json')
+        with CaptureQueriesContext(connection) as context:
+            response = async_to_sync(view.as_view())(request, id=pk)
+        assert response.status_code == 200
+        return [
+            query['sql'].split()[0] for query in context.captured_queries
+            if 'auth_group_permissions' in query['sql'] and 'INNER JOIN' not in query['sql']
+        ]
+
+    def test_set_by_diff(self):
+        pks = [permission.pk for permission in self.permissions]
+        self.group.permissions.set(pks[:2])
+        self.signals.clear()
+        statements = self.patch(self.GroupView, self.group.pk, {'permissions': pks[1:3]})
+        # the current links, the removed and the added ones
+        assert statements == ['SELECT', 'DELETE', 'INSERT']
+        assert sorted(self.group.permissions.values_list('pk', flat=True)) == pks[1:3]
+        assert self.signals == [
+            ('pre_remove', False, {pks[0]}), ('post_remove', False, {pks[0]}),
+            ('pre_add', False, {pks[2]}), ('post_add', False, {pks[2]}),
+        ]
+        # nothing to write
+        assert self.patch(self.GroupView, self.group.pk, {'permissions': {'to': pks[1:3], 'mode': 'add'}}) == ['SELECT']
+        self.patch(self.GroupView, self.group.pk, {'permissions': {'to': [pks[1]], 'mode': 'remove'}})
+        assert list(self.group.permissions.values_list('pk', flat=True)) == [pks[2]]
+        return
+
+    def test_reverse_relation(self):
+        permission = self.permissions[0]
+        other = Group.objects.create(name='m2m_other')
+        self.signals.clear()
+        self.patch(self.PermissionView, permission.pk, {'group_set': {'to': [self.group.pk, other.pk], 'mode': 'add'}})
+        assert set(permission.group_set.values_list('pk', flat=True)) == {self.group.pk, other.pk}
+        assert self.signals[-1] == ('post_add', True, {self.group.pk, other.pk})
+        self.signals.clear()
+        class QuietPermissionView(self.PermissionView):
+            send_m2m_signals = False
+            pass
+        self.patch(QuietPermissionView, permission.pk, {'group_set': [other.pk]})
+        assert list(permission.group_set.values_list('pk', flat=True)) == [other.pk]
+        assert self.signals == []
+        return
+
+    def test_links_of_many_objects(self):
+        pks = [permission.pk for permission in self.permissions]
+        groups = [self.group] + [Group.objects.create(name='m2m_%d'%index) for index in range(3)]
+        for group in groups:
+            group.permissions.set(pks[:2])
+        view = self.GroupView()
+        unit_of_work = UnitOfWork('default', savepoint=False)
+        for group in groups:
+            view._update_relation_fields_in_model_instance(group, {'permissions': pks[1:3]}, unit_of_work)
+        # the same object twice, its changes apply in order
+        view._update_relation_fields_in_model_instance(groups[0], {'permissions': {'to': [pks[3]], 'mode': 'add'}}, unit_of_work)
+        with CaptureQueriesContext(connection) as context:
+            unit_of_work.execute()
+        # the current links, the removed and the added ones of all the objects
+        assert [query['sql'].split()[0] for query in context.captured_queries] == ['SELECT', 'DELETE', 'INSERT']
+        for group in groups:
+            expected = pks[1:4] if group is self.group else pks[1:3]
+            assert sorted(group.permissions.values_list('pk', flat=True)) == expected
+        return
+    pass
+
+class TestNestedWrites(TestCase):
+
+    def setUp(self) -> None:
+        class ContentTypeView(BaseRESTView):
+            model = ContentType
+            fields = {'id', 'app_label', 'model', ('permission_set', ('id', 'name', 'codename'))}
+            pass
+        self.view = ContentTypeView.as_view()
+        return
+
+    def send(self, method, data, **kwargs):
+        request = getattr(RequestFactory(), method)('/', json.dumps(data), content_type='application/json')
+        with CaptureQueriesContext(connection) as context:
+            response = async_to_sync(self.view)(request, **kwargs)
+        inserts = [query for query in context.captured_queries if query['sql'].startswith('INSERT INTO "auth_permission"')]
+        return response.status_code, json.loads(response.content), len(inserts)
+
+    def test_create_with_children(self):
+        status, body, inserts = self.send('post', {
+            'app_label': 'nested', 'model': 'thing',
+            'permission_set': [{'name': 'Can a', 'codename': 'a'}, {'name': 'Can b', 'codename': 'b'}],
+        })
+        assert status == 200 and inserts == 1
+        assert sorted(permission['codename'] for permission in body['object']['permission_set']) == ['a', 'b']
+        content_type = ContentType.objects.get(app_label='nested', model='thing')
+        assert content_type.permission_set.count() == 2
+        # the invalid children are reported before any query
+        status, body, _ = self.send('post', {
+            'app_label': 'nested', 'model': 'other', 'permission_set': [{'name': 'Can c'}],
+        })
+        assert status == 400 and body['errors'] == {'permission_set.0.codename': ['This field is required.']}
+        return
+
+    def test_update_and_delete_missing(self):
+        content_type = ContentType.objects.create(app_label='nested', model='update')
+        kept, dropped = Permission.objects.bulk_create([
+            Permission(name='Can kept', codename='kept', content_type=content_type),
+            Permission(name='Can dropped', codename='dropped', content_type=content_type),
+        ])
+        status, body, inserts = self.send('patch', {'permission_set': {
+            'objects': [{'id': kept.pk, 'name': 'Can keep'}, {'name': 'Can new', 'codename': 'new'}],
+            'delete_missing': True,
+        }}, id=content_type.pk)
+        assert status == 200 and inserts == 1
+        assert sorted(content_type.permission_set.values_list('codename', 'name')) == [
+            ('kept', 'Can keep'), ('new', 'Can new')
+        ]
+        assert sorted(permission['codename'] for permission in body['object']['permission_set']) == ['kept', 'new']
+        # the objects of other parents can't be taken
+        other = Permission.objects.exclude(content_type=content_type).first()
+        status, body, _ = self.send('patch', {'permission_set': [{'id': other.pk, 'name': 'taken'}]}, id=content_type.pk)
+        assert status == 400
+        assert Permission.objects.get(pk=other.pk).name != 'taken'
+        return
+
+    def test_required_children_fields_out_of_view(self):
+        class ContentTypeView(BaseRESTView):
+            model = ContentType
+            fields = {'id', 'app_label', 'model', ('permission_set', ('id', 'name'))}
+            pass
+        self.view = ContentTypeView.as_view()
+        status, body, inserts = self.send('post', {
+            'app_label': 'nested', 'model': 'unwritable', 'permission_set': [{'name': 'Can a', 'codename': 'a'}],
+        })
+        assert status == 400 and inserts == 0
+        assert list(body['errors']) == ['permission_set.0.codename']
+        return
+    pass
+
+class TestNestedVersions(VersionedNoteTestCase):
+
+    def test_children_versions_are_incremented(self):
+        group = Group.objects.create(name='nested_versions')
+        note = VersionedNote.objects.create(title='first', group=group)
+        class NoteView(BaseRESTView):
+            model = VersionedNote
+            fields = {'id', 'title', 'version'}
+            version_field = 'version'
+            pass
+        class GroupView(BaseRESTView):
+            model = Group
+            fields = {'id', 'name', ('notes', ('id', 'title', 'version'))}
+            pass
+        request = RequestFactory().patch(
+            '/', json.dumps({'notes': [{'id': note.pk, 'title': 'second', 'version': 7}]}), content_type='application/json'
+        )
+        response = async_to_sync(GroupView.as_view())(request, id=group.pk)
+        assert response.status_code == 200
+        note.refresh_from_db()
+        # the version isn't written, but incremented
+        assert (note.title, note.version) == ('second', 1)
+        # the clients of the note view with the old version lose
+        request = RequestFactory().patch(
+            '/', json.dumps({'title': 'lost'}), content_type='application/json', headers={'If-Match': '"0"'}
+        )
+        assert async_to_sync(NoteView.as_view())(request, id=note.pk).status_code == 412
+        return
+    pass
@@ -0,0 +1,65 @@
+from django.db import transaction
+from api.executor import db_sync_to_async
+
+class UnitOfWork:
+    """
+    Collects the writes of a request for execute them, transaction included,
+    in one synchronous call (one thread and one connection).
+
+    The operations run in the order they were added, and the deferred ones after them.
+    An operation can add more operations while the unit is executing. The batched items
+    of a function are written by one deferred call, e.g. the links of many objects.
+    """
+
+    def __init__(self, using=None, savepoint=True, durable=False) -> None:
+        self.using = using
+        self.savepoint = savepoint
+        self.durable = durable
+        self._operations: list[tuple] = []
+        self._deferred: list[tuple] = []
+        self._batches: dict[tuple, list] = {}
+        return
+
+    def add(self, func, *args, **kwargs):
+        self._operations.append((func, args, kwargs))
+        return self
+
+    def defer(self, func, *args, **kwargs):
+        self._deferred.append((func, args, kwargs))
+        return self
+
+    def batch(self, func, item, *args):
+        """
+        Defers one `func(items, *args)` call for all the items batched with the same function and arguments.
+        """
+        if (items := self._batches.get((func, args))) is None:
+            items = self._batches[(func, args)] = []
+            self.defer(func, items, *args)
+        items.append(item)
+        return self
+
+    def __len__(self):
+        return len(self._operations) + len(self._deferred)
+
+    def __bool__(self):
+        return True
+
+    def execute(self) -> list:
+        """
+        Runs all the operations in an atomic block. Returns their results.
+        """
+        results = []
+        with transaction.atomic(self.using, self.savepoint, self.durable):
+            for operations in (self._operations, self._deferred):
+                index = 0
+                while index < len(operations):
+                    func, args, kwargs = operations[index]
+                    results.append(func(*args, **kwargs))
+                    index += 1
+        return results
+
+    async def commit(self) -> list:
+        return await db_sync_to_async(self.execute)()
+    pass
+
+__all__ = ['UnitOfWork']
@@ -9,6 +9,15 @@ def get_model_fields(model):
 def get_required_model_fields(model) -> set[str]:
     return {field.name for field in model._meta.fields if field.blank == False}
 
+async def get_request_user(request: HttpRequest):
+    """
+    The user of the request, `None` without authentication. With `AuthenticationMiddleware`,
+    `request.user` loads the session synchronously, so it's loaded by `request.auser()`.
+    """
+    if (auser := getattr(request, 'auser', None)) is not None:
+        return await auser()
+    return getattr(request, 'user', None)
+
 def validate_json_request_body(view_func):
     @wraps(view_func)
     async def wrapper(*args, **kwargs):
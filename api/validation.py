@@ -0,0 +1,240 @@
+from django.core.exceptions import ValidationError
+from django.db.models import Field, Model
+from django.db.models.fields.reverse_related import ForeignObjectRel
+
+from api.local import LocalField
+from api.relation import Relation, RelationManager
+from api import exceptions, nested, utils
+
+"""
+Goal:
+    POST /teams/    {"name": "", "founded": "19x5", "league": "abc"}
+
+    400 {
+        "message": "The request data is invalid",
+        "errors": {
+            "name": ["This field cannot be blank."],
+            "founded": ["“19x5” value must be an integer."],
+            "league": ["“abc” value must be an integer."],
+            "city": ["This field is required."]
+        }
+    }
+
+    The validators of the fields are compiled once by view, from the model fields:
+    types, `null`, `blank`, `max_length`, `choices`, the validators of the fields
+    (e.g. numeric ranges) and the primary key types of the relations. The data is
+    validated and coerced in one pass, before any query, and all the errors are reported.
+"""
+
+CREATE = 'create'; REPLACE = 'replace'; PARTIAL = 'partial'
+
+
+class FieldValidator:
+
+    def __init__(self, model_field: Field) -> None:
+        self.model_field = model_field
+        return
+
+    def check_null(self, value):
+        if value is None and not self.model_field.null:
+            raise ValidationError(self.model_field.error_messages['null'], code='null')
+        return
+
+    def clean(self, value):
+        """
+        Returns the value coerced to the type of the field, raises `ValidationError`.
+        """
+        self.check_null(value)
+        if value is None:
+            return None
+        value = self.model_field.to_python(value)
+        # the choices, the blank values and the validators (max_length, ranges...)
+        self.model_field.validate(value, None)
+        self.model_field.run_validators(value)
+        return value
+    pass
+
+
+class ToOneValidator(FieldValidator):
+    """
+    The primary key of the related object.
+    """
+
+    def clean(self, value):
+        self.check_null(value)
+        if value is None:
+            return None
+        if not isinstance(value, (str, int)):
+            raise ValidationError('Must be the primary key of the related object.', code='invalid')
+        return self.model_field.target_field.to_python(value)
+    pass
+
+
+class ToManyValidator(FieldValidator):
+    """
+    The primary keys of the related objects: a list or `{"to": [...], "mode": "add"|"set"|"remove"}`.
+    """
+    MODES = ('add', 'set', 'remove')
+
+    def __init__(self, model_field, related_model: type[Model]) -> None:
+        super().__init__(model_field)
+        self.related_pk = related_model._meta.pk
+        return
+
+    def clean_pks(self, pks):
+        if not isinstance(pks, list):
+            raise ValidationError('Must be a list of primary keys.', code='invalid')
+        return [self.related_pk.to_python(pk) for pk in pks]
+
+    def clean(self, value):
+        if isinstance(value, dict):
+            if (mode := value.get('mode', None) or 'set') not in self.MODES:
+                raise ValidationError(
+                    'Invalid mode \'%s\', the valid modes are %s.'%(mode, ', '.join(self.MODES)),
+                    code='invalid'
+                )
+            if not value.get('to', None):
+                raise ValidationError('The primary keys of the objects to relate are required.', code='required')
+            return {**value, 'to': self.clean_pks(value['to'])}
+        return self.clean_pks(value)
+    pass
+
+
+class NestedValidator(ToManyValidator):
+    """
+    The objects of a to many reverse relation (see `api.nested`), or the primary keys of the related objects.
+    The objects without primary key must have the required fields, and the view must expose them.
+    """
+
+    def __init__(self, relation: Relation) -> None:
+        super().__init__(relation._model_field, relation.to_m)
+        fk = relation._model_field.field
+        self.fields = {
+            field.name: FieldValidator(field.model_field)
+            for field in relation.relation_fields or ()
+            if isinstance(field, LocalField) and not field.model_field.primary_key
+        }
+        required = utils.get_required_model_fields(relation.to_m) - {fk.name}
+        self.required = frozenset(required & set(self.fields))
+        # the required fields without default that the view can't write, the objects can't be created
+        self.unwritable = frozenset(
+            name for name in required - set(self.fields)
+            if not (field := relation.to_m._meta.get_field(name)).has_default() and not field.primary_key
+        )
+        return
+
+    def clean_object(self, data) -> tuple[dict, dict[str, list[str]]]:
+        errors = {}
+        if not isinstance(data, dict):
+            return data, {'': ['Must be an object.']}
+        if data.get(self.related_pk.name) is None:
+            for name in self.required - set(data):
+                errors[name] = ['This field is required.']
+            for name in self.unwritable:
+                errors[name] = ['This field is required, but it isn\'t a field of the view.']
+        else:
+            try:
+                data[self.related_pk.name] = self.related_pk.to_python(data[self.related_pk.name])
+            except ValidationError as exp:
+                errors[self.related_pk.name] = exp.messages
+        for name, validator in self.fields.items():
+            if name not in data:
+                continue
+            try:
+                data[name] = validator.clean(data[name])
+            except ValidationError as exp:
+                errors[name] = exp.messages
+        return data, errors
+
+    def clean(self, value):
+        if (payload := nested.get_nested_payload(value)) is None:
+            return super().clean(value)
+        objects, _ = payload
+        if not isinstance(objects, list):
+            raise ValidationError('Must be a list of objects.', code='invalid')
+        errors = {}
+        for index, data in enumerate(objects):
+            objects[index], object_errors = self.clean_object(data)
+            for name, messages in object_errors.items():
+                errors['.'.join(str(part) for part in (index, name) if part != '')] = messages
+        if errors:
+            raise ValidationError(errors)
+        return value
+    pass
+
+
+class RequestValidator:
+    """
+    The validators of the writable fields of a view.
+    """
+
+    def __init__(
+        self,
+        local_fields: set[LocalField],
+        relations: RelationManager | None,
+        required_fields: set[str],
+        nonupdatable_fields: set[str],
+    ) -> None:
+        self.validators: dict[str, FieldValidator] = {}
+        for local_field in local_fields:
+            if local_field.model_field.primary_key:
+                # the primary keys aren't written
+                continue
+            self.validators[local_field.name] = FieldValidator(local_field.model_field)
+        for relation in relations or ():
+            if relation.parent is not None:
+                continue
+            if validator := self.build_relation_validator(relation):
+                self.validators[relation._field_name] = validator
+        self.required = {
+            CREATE: frozenset(required_fields),
+            REPLACE: frozenset(required_fields - nonupdatable_fields),
+            PARTIAL: frozenset(),
+        }
+        return
+
+    def build_relation_validator(self, relation: Relation) -> FieldValidator | None:
+        if relation.is_to_many and nested.is_nested_relation(relation):
+            return NestedValidator(relation)
+        if relation.is_to_many:
+            return ToManyValidator(relation._model_field, relation.to_m)
+        if isinstance(relation._model_field, ForeignObjectRel):
+            # the reverse to one relations aren't written
+            return None
+        return ToOneValidator(relation._model_field)
+
+    def validate(self, data: dict, mode: str = CREATE) -> dict:
+        """
+        Coerces the values of `data` in place. Raises `InvalidRequestData` with all the errors.
+        """
+        errors: dict[str, list[str]] = {}
+        for name in self.required[mode]:
+            if name not in data:
+                errors[name] = ['This field is required.']
+        for name, validator in self.validators.items():
+            if name not in data:
+                continue
+            try:
+                data[name] = validator.clean(data[name])
+            except ValidationError as exp:
+                if not hasattr(exp, 'error_dict'):
+                    errors[name] = exp.messages
+                    continue
+                # the errors of the nested objects, e.g. `players.0.first_name`
+                for key, messages in exp.message_dict.items():
+                    errors['%s.%s'%(name, key)] = messages
+        if errors:
+            raise exceptions.InvalidRequestData(errors)
+        return data
+    pass
+
+__all__ = [
+    'CREATE',
+    'REPLACE',
+    'PARTIAL',
+    'FieldValidator',
+    'ToOneValidator',
+    'ToManyValidator',
+    'NestedValidator',
+    'RequestValidator',
+]
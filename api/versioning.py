@@ -0,0 +1,99 @@
+from django.db.models import F, Model, IntegerField
+from django.db.models.signals import pre_save, post_save
+from django.http import HttpRequest
+
+from api import exceptions, registry
+
+"""
+Goal:
+    GET   /teams/1/                     ETag: "3"
+    PATCH /teams/1/  If-Match: "3"      200, ETag: "4"
+    PATCH /teams/1/  If-Match: "3"      412, the object was changed by another client
+
+    With the `version_field` of a view (an integer field), the updates are one
+    conditional `UPDATE ... WHERE pk = %s AND version = %s` that increments the version.
+"""
+
+def get_etag(version) -> str:
+    return '"%s"'%version
+
+def get_expected_version(request: HttpRequest | None, version_field: IntegerField, data: dict):
+    """
+    The version that the client expects to update: the `If-Match` header,
+    or the version field in the body. `None` without precondition.
+    """
+    expected = None
+    if request is not None and (if_match := request.headers.get('If-Match')):
+        expected = if_match.split(',')[0].strip()
+        if expected == '*':
+            return None
+        expected = expected.removeprefix('W/').strip('"')
+    elif data.get(version_field.name) is not None:
+        expected = data[version_field.name]
+    if expected is None:
+        return None
+    try:
+        return version_field.to_python(expected)
+    except exceptions.ValidationError:
+        raise exceptions.PreconditionFailed(expected)
+
+def is_version_field(model: type[Model], field_name: str) -> bool:
+    return isinstance(model._meta.get_field(field_name), IntegerField)
+
+def get_version_fields(model: type[Model]) -> set[str]:
+    """
+    The version fields of the registered views of `model`, incremented by the writes out of those views.
+    """
+    return {
+        view_class.version_field for view_class in registry.get_registered_views()
+        if view_class.model is model and view_class.version_field
+    }
+
+def save_versioned(model_instance: Model, version_field: str, update_fields: set[str], expected, using: str):
+    """
+    Saves the `update_fields` of the instance if its version in the database is `expected`,
+    and increments it. Raises `PreconditionFailed` if the version changed.
+    Must be called in a synchronous context.
+    """
+    model = type(model_instance)
+    pre_save.send(
+        sender=model,
+        instance=model_instance,
+        raw=False,
+        using=using,
+        update_fields=frozenset(update_fields),
+    )
+    values = {}
+    for field in model._meta.concrete_fields:
+        if field.primary_key or field.name == version_field:
+            continue
+        if getattr(field, 'auto_now', False):
+            # as save(), the `auto_now` fields are updated
+            values[field.attname] = field.pre_save(model_instance, False)
+            continue
+        if field.name in update_fields:
+            values[field.attname] = getattr(model_instance, field.attname)
+    updated = model._default_manager.db_manager(using).filter(
+        pk=model_instance.pk,
+        **{version_field: expected}
+    ).update(**values, **{version_field: F(version_field) + 1})
+    if not updated:
+        raise exceptions.PreconditionFailed(expected)
+    setattr(model_instance, version_field, expected + 1)
+    post_save.send(
+        sender=model,
+        instance=model_instance,
+        created=False,
+        update_fields=frozenset(update_fields),
+        raw=False,
+        using=using,
+    )
+    return model_instance
+
+__all__ = [
+    'get_etag',
+    'get_expected_version',
+    'is_version_field',
+    'get_version_fields',
+    'save_versioned',
+]
@@ -1,5 +1,7 @@
-from django.http.response import JsonResponse
+from asgiref.sync import sync_to_async
+from django.http.response import HttpResponse, JsonResponse
 from django.views.decorators.csrf import ensure_csrf_cookie
+from api import admission, metrics
 
 
 # Create your views here.
@@ -9,3 +11,11 @@ async def root(req):
         {'message': 'ok'},
         status=200
         )
+
+async def admission_stats(req):
+    return JsonResponse(admission.get_stats(), status=200)
+
+async def metrics_exposition(req):
+    # with DARC_METRICS_DIR, the files of the processes are read out of the event loop
+    content = await sync_to_async(metrics.metrics_registry.exposition, thread_sensitive=False)()
+    return HttpResponse(content, content_type='text/plain; version=0.0.4; charset=utf-8')